@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Control de admisión por memoria
+Antes de decodificar una imagen se estima lo que ocuparán sus píxeles (ancho x
+alto x bandas, leído de la cabecera) y se reserva esa cantidad de un
+presupuesto por proceso. Una imagen que no cabe ni sola se rechaza; si no cabe
+ahora porque otras ocupan el presupuesto, se espera un poco y después se
+rechaza con un tiempo de reintento, en lugar de que el contenedor muera por OOM.
+"""
+
+import os
+import time
+import threading
+import logging
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Iterator, Tuple
+
+from PIL import ImageMode
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_BUDGET_BYTES = 1024 * 1024 * 1024  # 1GB por proceso
+# Máximo de una sola imagen decodificada (más grande: se reduce al decodificar o se rechaza)
+DEFAULT_MAX_DECODED_BYTES = 256 * 1024 * 1024
+DEFAULT_ADMISSION_TIMEOUT = 10.0
+DEFAULT_RETRY_AFTER = 5
+
+
+class ImageTooLargeError(ValueError):
+    """La imagen supera el tamaño máximo permitido"""
+
+
+class MemoryBudgetExceeded(Exception):
+    """El presupuesto de memoria está ocupado: reintentar pasados `retry_after` segundos"""
+
+    def __init__(self, message: str, retry_after: int = DEFAULT_RETRY_AFTER):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def estimate_decoded_bytes(size: Tuple[int, int], mode: str) -> int:
+    """Bytes de los píxeles decodificados: ancho x alto x bandas x bytes por banda"""
+    try:
+        descriptor = ImageMode.getmode(mode)
+        bands, band_bytes = len(descriptor.bands), int(descriptor.typestr[-1])
+    except (KeyError, ValueError):
+        bands, band_bytes = 4, 1
+    return size[0] * size[1] * bands * band_bytes
+
+
+class MemoryBudget:
+    """Semáforo por bytes: las imágenes en proceso no superan `capacity` en total
+
+    `reserve(n)` espera hasta `timeout` segundos a que haya sitio y si no lanza
+    MemoryBudgetExceeded; una reserva mayor que `capacity` lanza
+    ImageTooLargeError sin esperar (no cabría nunca).
+    """
+
+    def __init__(self, capacity: int = DEFAULT_MEMORY_BUDGET_BYTES, timeout: float = DEFAULT_ADMISSION_TIMEOUT,
+                 retry_after: int = DEFAULT_RETRY_AFTER):
+        self.capacity = capacity
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.in_use = 0
+        self.peak = 0
+        self.admitted = 0
+        self.waited = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes: int) -> None:
+        if nbytes > self.capacity:
+            metrics.inc("cropper_admission_total", result="too_large")
+            raise ImageTooLargeError(f"La imagen ocuparía {nbytes // 2 ** 20} MB decodificada "
+                                     f"(presupuesto de {self.capacity // 2 ** 20} MB)")
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            waited = self.in_use + nbytes > self.capacity
+            while self.in_use + nbytes > self.capacity:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    metrics.inc("cropper_admission_total", result="rejected")
+                    raise MemoryBudgetExceeded(
+                        f"Memoria ocupada por otras imágenes ({self.in_use // 2 ** 20} de "
+                        f"{self.capacity // 2 ** 20} MB); reintentar en {self.retry_after}s",
+                        self.retry_after
+                    )
+                self._cond.wait(remaining)
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+            self.admitted += 1
+            self.waited += waited
+        metrics.inc("cropper_admission_total", result="waited" if waited else "admitted")
+
+    def release(self, nbytes: int) -> None:
+        with self._cond:
+            self.in_use -= nbytes
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes: int) -> Iterator[None]:
+        """Reservar `nbytes` mientras dure el bloque"""
+        self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "capacity_bytes": self.capacity,
+                "in_use_bytes": self.in_use,
+                "peak_bytes": self.peak,
+                "admitted": self.admitted,
+                "waited": self.waited,
+                "rejected": self.rejected,
+            }
+
+
+def get_memory_budget() -> Optional[MemoryBudget]:
+    """Presupuesto de memoria del proceso a partir de variables de entorno (MEMORY_BUDGET_BYTES=0 lo desactiva)"""
+    capacity = int(os.getenv("MEMORY_BUDGET_BYTES", str(DEFAULT_MEMORY_BUDGET_BYTES)))
+    if capacity <= 0:
+        return None
+    return MemoryBudget(
+        capacity,
+        timeout=float(os.getenv("MEMORY_ADMISSION_TIMEOUT", str(DEFAULT_ADMISSION_TIMEOUT))),
+        retry_after=int(os.getenv("MEMORY_RETRY_AFTER", str(DEFAULT_RETRY_AFTER))),
+    )
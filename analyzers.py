@@ -0,0 +1,782 @@
+#!/usr/bin/env python3
+"""
+Backends de análisis de imágenes
+El procesador pide el análisis (las claves de ANALYSIS_PROMPT) a un backend
+intercambiable: Gemini con el modelo que se configure, el motor local de
+saliencia, uno simulado con respuestas fijas o uno que reproduce análisis
+grabados. Se eligen con una especificación `backend[:argumento]` (ANALYZER y,
+por ruta de la API, ANALYZER_ROUTES). Los backends que lo soportan analizan
+varias imágenes en una sola petición (`analyze_many`) y BatchingAnalyzer
+agrupa en esas peticiones las imágenes que se analizan a la vez.
+"""
+
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+import logging
+from abc import ABC, abstractmethod
+from io import BytesIO
+from types import SimpleNamespace
+from typing import Optional, Dict, Any, List, Tuple
+
+from PIL import Image
+
+from metrics import metrics
+from ratelimit import RateLimiter, bucket_key
+from crop_solver import normalize_box
+
+logger = logging.getLogger(__name__)
+
+# Backends disponibles y especificación por defecto (p. ej. "gemini:gemini-2.5-flash-lite")
+BACKENDS = ("gemini", "local", "fake", "replay", "record")
+DEFAULT_GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+DEFAULT_ANALYZER = os.getenv("ANALYZER", "gemini")
+
+# Timeout por petición a Gemini (s)
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "30"))
+
+# Respuesta de Gemini: compact (solo los campos del corte, con esquema JSON) o
+# full (ANALYSIS_PROMPT con las descripciones). GEMINI_SUBJECT_BOX pide además
+# la caja del sujeto principal en modo compact.
+RESPONSE_MODES = ("compact", "full")
+GEMINI_RESPONSE_MODE = os.getenv("GEMINI_RESPONSE_MODE", "compact").lower()
+GEMINI_SUBJECT_BOX = os.getenv("GEMINI_SUBJECT_BOX", "false").lower() in ("1", "true", "yes")
+
+# Agrupación de análisis simultáneos: imágenes por petición (1 la desactiva) y
+# espera máxima (s) a que lleguen más imágenes antes de enviar el lote
+ANALYZER_BATCH_SIZE = int(os.getenv("ANALYZER_BATCH_SIZE", "1"))
+ANALYZER_BATCH_WINDOW = float(os.getenv("ANALYZER_BATCH_WINDOW", "0.05"))
+
+ANALYSIS_PROMPT = """
+Analiza esta imagen y proporciona información detallada en formato JSON:
+
+1. ¿Cuál es el contenido principal de la imagen?
+2. ¿Hay elementos importantes en los bordes que no deben cortarse?
+3. ¿La imagen parece estar dividida en dos partes distintas (como dos fotos fusionadas o un díptico)?
+4. Si está dividida, analiza cada lado por separado:
+   - Lado izquierdo: ¿qué contiene? ¿hay personas visibles?
+   - Lado derecho: ¿qué contiene? ¿hay personas visibles?
+   - ¿Cuál lado tiene personas?
+   - ¿Cuál lado tiene más contenido visual interesante o importante?
+   - ¿Cuál lado tiene mejor composición para Instagram?
+5. ¿Cuál es el punto focal principal de la imagen?
+6. ¿Hay texto visible que debe mantenerse?
+
+REGLAS DE PRIORIDAD PARA DÍPTICOS:
+- Si solo UN lado tiene personas: SIEMPRE elige ese lado
+- Si AMBOS lados tienen personas: SIEMPRE elige el lado izquierdo
+- Si NINGÚN lado tiene personas: elige el más visualmente interesante
+
+IMPORTANTE: Si la imagen está dividida, NO cortes por la mitad. Elige UN lado completo (izquierda o derecha) que sea más interesante para Instagram.
+
+Responde SOLO en formato JSON válido con estas claves:
+{
+    "contenido_principal": "descripción",
+    "elementos_bordes": "descripción de elementos en bordes",
+    "imagen_dividida": true/false,
+    "lado_izquierdo": "descripción del contenido del lado izquierdo",
+    "lado_derecho": "descripción del contenido del lado derecho",
+    "personas_izquierda": true/false,
+    "personas_derecha": true/false,
+    "lado_importante": "izquierda/derecha/centro",
+    "razon_lado_elegido": "explicación de por qué se eligió ese lado",
+    "punto_focal": "descripción del punto focal",
+    "texto_visible": "texto encontrado o 'ninguno'",
+    "recomendacion_corte": "descripción específica de cómo cortar"
+}
+"""
+
+# Solo lo que usa el cálculo del corte; el esquema de la respuesta fija los tipos
+COMPACT_PROMPT = """
+Analiza esta imagen para recortarla en formato cuadrado para Instagram.
+
+- imagen_dividida: true si son dos fotos distintas lado a lado (un díptico)
+- personas_izquierda / personas_derecha: si hay personas visibles en cada lado del díptico
+- lado_importante: "izquierda", "derecha" o "centro" (si no está dividida)
+- posicion_division: si está dividida, posición de la línea de división de 0 a 1 respecto al ancho
+
+REGLAS DE PRIORIDAD PARA DÍPTICOS:
+- Si solo UN lado tiene personas: SIEMPRE elige ese lado
+- Si AMBOS lados tienen personas: SIEMPRE elige el lado izquierdo
+- Si NINGÚN lado tiene personas: elige el más visualmente interesante
+{subject_box}
+Responde SOLO con el JSON.
+"""
+
+SUBJECT_BOX_PROMPT = """- caja_sujeto: [x0, y0, x1, y1] del sujeto principal, de 0 a 1 respecto al ancho y al alto
+- zonas_conservar: lista de cajas [x0, y0, x1, y1] (de 0 a 1) que no se deben cortar, como
+  textos, logos u otras personas importantes; lista vacía si no hay
+"""
+
+# Segunda petición (solo texto) cuando la respuesta no se puede interpretar
+REPAIR_PROMPT = """
+El siguiente texto debía ser {expected} pero no es JSON válido o le faltan
+campos. Devuelve SOLO el JSON corregido, sin texto adicional:
+
+{text}
+"""
+REPAIR_MAX_CHARS = 4000
+
+# Cabecera de las peticiones con varias imágenes; después va el prompt de análisis
+BATCH_PROMPT = """
+Vas a recibir {count} imágenes numeradas ("Imagen 1", "Imagen 2", ...). Analiza
+cada una por separado siguiendo las instrucciones de abajo y responde SOLO con
+un array JSON de {count} objetos, uno por imagen y en el mismo orden.
+"""
+
+# Respuestas del backend simulado (fake) si no se indica un archivo
+CANNED_ANALYSES = [
+    {
+        "contenido_principal": "retrato", "elementos_bordes": "ninguno", "imagen_dividida": False,
+        "lado_izquierdo": "no aplicable", "lado_derecho": "no aplicable",
+        "personas_izquierda": False, "personas_derecha": False, "lado_importante": "centro",
+        "razon_lado_elegido": "imagen no dividida", "punto_focal": "rostro",
+        "texto_visible": "ninguno", "recomendacion_corte": "corte centrado",
+    },
+    {
+        "contenido_principal": "díptico", "elementos_bordes": "ninguno", "imagen_dividida": True,
+        "lado_izquierdo": "persona", "lado_derecho": "paisaje",
+        "personas_izquierda": True, "personas_derecha": False, "lado_importante": "izquierda",
+        "razon_lado_elegido": "solo la izquierda tiene personas", "punto_focal": "persona",
+        "texto_visible": "ninguno", "recomendacion_corte": "lado izquierdo",
+    },
+    {
+        "contenido_principal": "díptico", "elementos_bordes": "ninguno", "imagen_dividida": True,
+        "lado_izquierdo": "paisaje", "lado_derecho": "persona",
+        "personas_izquierda": False, "personas_derecha": True, "lado_importante": "derecha",
+        "razon_lado_elegido": "solo la derecha tiene personas", "punto_focal": "persona",
+        "texto_visible": "ninguno", "recomendacion_corte": "lado derecho",
+    },
+]
+
+
+_FENCE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+_TRUE_VALUES = ("true", "sí", "si", "yes", "1")
+_SIDES = {"izquierda": "izquierda", "izquierdo": "izquierda", "left": "izquierda",
+          "derecha": "derecha", "derecho": "derecha", "right": "derecha"}
+
+
+def analysis_schema(subject_box: bool = False) -> Dict[str, Any]:
+    """Esquema JSON de la respuesta compacta (response_schema de Gemini)"""
+    properties: Dict[str, Any] = {
+        "imagen_dividida": {"type": "boolean"},
+        "personas_izquierda": {"type": "boolean"},
+        "personas_derecha": {"type": "boolean"},
+        "lado_importante": {"type": "string", "enum": ["izquierda", "derecha", "centro"]},
+    }
+    if subject_box:
+        properties["caja_sujeto"] = {"type": "array", "items": {"type": "number"}}
+        properties["zonas_conservar"] = {"type": "array", "items": {"type": "array", "items": {"type": "number"}}}
+    required = list(properties)
+    # Opcional: solo tiene sentido en los dípticos
+    properties["posicion_division"] = {"type": "number"}
+    return {"type": "object", "properties": properties, "required": required}
+
+
+def parse_analysis_text(text: str) -> Any:
+    """JSON de la respuesta del modelo, tolerando lo que suele rodearlo
+
+    Acepta el JSON tal cual, dentro de un bloque ```json (aunque haya texto
+    antes o después) o como primer objeto/array de un texto, y quita las
+    comas finales. Lanza ValueError si no encuentra JSON válido.
+    """
+    text = text.strip()
+    candidates = [text]
+    fence = _FENCE.search(text)
+    if fence:
+        candidates.insert(0, fence.group(1).strip())
+    for candidate in candidates:
+        try:
+            return json.loads(candidate)
+        except ValueError:
+            pass
+
+    decoder = json.JSONDecoder()
+    for candidate in candidates:
+        cleaned = _TRAILING_COMMA.sub(r"\1", candidate)
+        starts = sorted(index for index in (cleaned.find("{"), cleaned.find("[")) if index >= 0)
+        for start in starts:
+            try:
+                return decoder.raw_decode(cleaned, start)[0]
+            except ValueError:
+                continue
+    raise ValueError(f"La respuesta no contiene JSON válido: {text[:200]!r}")
+
+
+def _as_bool(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in _TRUE_VALUES
+    return bool(value)
+
+
+def normalize_analysis(data: Any) -> Dict[str, Any]:
+    """Campos del corte con tipos y valores válidos; lanza ValueError si no es un objeto
+
+    Convierte "true"/"sí" en booleanos, lleva lado_importante a izquierda,
+    derecha o centro y descarta las cajas (caja_sujeto, zonas_conservar) y la
+    posicion_division que no sean válidas. El resto de campos (las
+    descripciones del modo full) se conservan.
+    """
+    if not isinstance(data, dict):
+        raise ValueError(f"El análisis no es un objeto JSON: {type(data).__name__}")
+    analysis = dict(data)
+    for key in ("imagen_dividida", "personas_izquierda", "personas_derecha"):
+        analysis[key] = _as_bool(analysis.get(key, False))
+    side = str(analysis.get("lado_importante") or "centro").strip().lower()
+    analysis["lado_importante"] = _SIDES.get(side, "centro")
+    if "caja_sujeto" in analysis:
+        box = normalize_box(analysis.pop("caja_sujeto"))
+        if box is not None:
+            analysis["caja_sujeto"] = box
+    if "zonas_conservar" in analysis:
+        zones = analysis.pop("zonas_conservar")
+        zones = [normalize_box(zone) for zone in zones] if isinstance(zones, list) else []
+        analysis["zonas_conservar"] = [zone for zone in zones if zone is not None]
+    if "posicion_division" in analysis:
+        try:
+            seam = float(analysis.pop("posicion_division"))
+        except (TypeError, ValueError):
+            seam = None
+        if seam is not None and 1 < seam < 1000:
+            seam /= 1000  # Misma escala 0-1000 que las cajas
+        if seam is not None and 0 < seam < 1:
+            analysis["posicion_division"] = round(seam, 4)
+    return analysis
+
+
+def payload_key(payload: bytes) -> str:
+    """Clave de una imagen de análisis (los bytes del JPEG que se envía al modelo)"""
+    return hashlib.sha256(payload).hexdigest()
+
+
+def load_genai():
+    """Importar el SDK de Gemini (genai y su cliente generativelanguage) en el primer uso
+
+    Importarlo cuesta cerca de un segundo, así que no se hace al cargar el
+    módulo: `--help`, el motor local y los backends sin red no lo pagan.
+    """
+    import google.generativeai as genai
+    import google.ai.generativelanguage as glm
+    return genai, glm
+
+
+class GeminiModel:
+    """Modelo de Gemini con su propio cliente y API key
+
+    `genai.configure` es global: la última API key configurada valdría para
+    todos los modelos. Aquí cada modelo crea su GenerativeServiceClient con su
+    key (al primer uso: sin API key no se crea cliente) y arma la petición con
+    los conversores públicos de `genai.types`, igual que
+    `GenerativeModel.generate_content`.
+    """
+
+    def __init__(self, api_key: str, model_name: str):
+        self.api_key = api_key
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        self._client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                _, glm = load_genai()
+                self._client = glm.GenerativeServiceClient(client_options={"api_key": self.api_key})
+            return self._client
+
+    def generate_content(self, contents: List[Any], generation_config: Optional[Dict[str, Any]] = None,
+                         request_options: Optional[Dict[str, Any]] = None):
+        genai, _ = load_genai()
+        from google.generativeai.types import content_types, generation_types
+        request = genai.protos.GenerateContentRequest(
+            model=self.model_name,
+            contents=content_types.to_contents(contents),
+            generation_config=generation_types.to_generation_config_dict(generation_config),
+        )
+        if request.contents and not request.contents[-1].role:
+            request.contents[-1].role = "user"
+        response = self.client().generate_content(request, **(request_options or {}))
+        return generation_types.GenerateContentResponse.from_response(response)
+
+
+def preload_genai() -> None:
+    """Importar el SDK de Gemini en un hilo en segundo plano (p. ej. al arrancar un worker)"""
+    def load():
+        try:
+            load_genai()
+        except ImportError as e:
+            logger.warning(f"No se pudo importar el SDK de Gemini: {e}")
+
+    threading.Thread(target=load, name="precarga-genai", daemon=True).start()
+
+
+class Analyzer(ABC):
+    """Backend de análisis
+
+    `analyze` recibe el JPEG de la copia reducida de la imagen y devuelve el
+    análisis con las claves de ANALYSIS_PROMPT; lanza excepción si falla (el
+    procesador reintenta los errores transitorios y recurre al respaldo).
+    `analyze_many` analiza varias imágenes y devuelve los análisis en el mismo
+    orden; por defecto, una a una.
+    """
+
+    name = "base"
+    model_name = ""
+    # Si analyze_many envía las imágenes juntas en una sola petición
+    supports_batch = False
+
+    def __init__(self, spec: str = ""):
+        self.spec = spec or self.name
+
+    @abstractmethod
+    def analyze(self, payload: bytes) -> Dict[str, Any]:
+        """Analizar una imagen (el JPEG de su copia reducida)"""
+
+    def analyze_many(self, payloads: List[bytes]) -> List[Dict[str, Any]]:
+        return [self.analyze(payload) for payload in payloads]
+
+    def describe(self) -> Dict[str, Any]:
+        """Configuración del backend para /health y /models"""
+        return {"backend": self.name, "model": self.model_name or None, "spec": self.spec,
+                "batch": self.supports_batch}
+
+
+class GeminiAnalyzer(Analyzer):
+    """Análisis con un modelo de Gemini
+
+    Cada petición (también cada reintento) consume un token del limitador de
+    la API key; una petición con varias imágenes consume uno solo. En modo
+    `compact` la respuesta se limita con un esquema JSON a los campos del
+    corte; en `full` se piden también las descripciones. Si la respuesta no se
+    puede interpretar se pide una vez, solo con texto, que la corrija. `model`
+    sustituye al modelo de genai por cualquier objeto con su `generate_content`
+    (p. ej. el modelo simulado de los benchmarks).
+    """
+
+    name = "gemini"
+    supports_batch = True
+
+    def __init__(self, api_key: str, model_name: str = DEFAULT_GEMINI_MODEL,
+                 rate_limiter: Optional[RateLimiter] = None, timeout: float = GEMINI_TIMEOUT,
+                 model: Optional[Any] = None, spec: str = "", response_mode: str = GEMINI_RESPONSE_MODE,
+                 subject_box: bool = GEMINI_SUBJECT_BOX):
+        super().__init__(spec or f"gemini:{model_name}")
+        if response_mode not in RESPONSE_MODES:
+            raise ValueError(f"Modo de respuesta desconocido: {response_mode} ({', '.join(RESPONSE_MODES)})")
+        self.model_name = model_name
+        self.rate_limiter = rate_limiter
+        self.limiter_key = bucket_key(api_key)
+        self.timeout = timeout
+        self.response_mode = response_mode
+        self.subject_box = subject_box
+        self.model = model if model is not None else GeminiModel(api_key, model_name)
+
+    @property
+    def prompt(self) -> str:
+        if self.response_mode == "full":
+            return ANALYSIS_PROMPT
+        return COMPACT_PROMPT.format(subject_box=SUBJECT_BOX_PROMPT if self.subject_box else "")
+
+    def generation_config(self, count: Optional[int] = None) -> Dict[str, Any]:
+        """Respuesta en JSON; en modo compact, con el esquema (un array si `count`)"""
+        config: Dict[str, Any] = {"response_mime_type": "application/json"}
+        if self.response_mode == "compact":
+            schema = analysis_schema(self.subject_box)
+            config["response_schema"] = schema if count is None else {"type": "array", "items": schema}
+        return config
+
+    def _generate(self, contents: List[Any], generation_config: Dict[str, Any]) -> str:
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(self.limiter_key)
+        try:
+            response = self.model.generate_content(contents, generation_config=generation_config,
+                                                   request_options={"timeout": self.timeout})
+        except Exception as e:
+            metrics.inc("cropper_gemini_requests_total", result=type(e).__name__)
+            raise
+        metrics.inc("cropper_gemini_requests_total", result="success")
+        return response.text
+
+    @staticmethod
+    def _validate(data: Any, count: Optional[int]) -> List[Dict[str, Any]]:
+        """Análisis de la respuesta normalizados; lanza ValueError si faltan o sobran"""
+        items = [data] if count is None else data
+        if not isinstance(items, list) or len(items) != (count or 1):
+            raise ValueError(f"Respuesta por lotes no válida: se esperaban {count} análisis")
+        analyses = [normalize_analysis(item) for item in items]
+        if not all("imagen_dividida" in item for item in items):
+            raise ValueError("Falta imagen_dividida en la respuesta")
+        return analyses
+
+    def _parse(self, text: str, count: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Interpretar la respuesta; si no se puede, pedir una vez que se corrija"""
+        try:
+            return self._validate(parse_analysis_text(text), count)
+        except ValueError as e:
+            logger.warning(f"Respuesta de Gemini no válida ({e}): se pide corregirla")
+            error = e
+        expected = "un objeto JSON" if count is None else f"un array JSON de {count} objetos"
+        prompt = REPAIR_PROMPT.format(expected=expected, text=text[:REPAIR_MAX_CHARS])
+        try:
+            analyses = self._validate(parse_analysis_text(self._generate([prompt], self.generation_config(count))),
+                                      count)
+        except ValueError:
+            metrics.inc("cropper_gemini_repairs_total", result="failure")
+            raise error
+        metrics.inc("cropper_gemini_repairs_total", result="success")
+        return analyses
+
+    def analyze(self, payload: bytes) -> Dict[str, Any]:
+        logger.info(f"Analizando imagen con {self.model_name}...")
+        text = self._generate([self.prompt, {"mime_type": "image/jpeg", "data": payload}], self.generation_config())
+        return self._parse(text)[0]
+
+    def analyze_many(self, payloads: List[bytes]) -> List[Dict[str, Any]]:
+        """Analizar varias imágenes en una sola petición multimodal
+
+        Lanza ValueError si la respuesta (tras el intento de corregirla) no es
+        un array con un análisis por imagen.
+        """
+        if len(payloads) == 1:
+            return [self.analyze(payloads[0])]
+        contents: List[Any] = [BATCH_PROMPT.format(count=len(payloads)) + self.prompt]
+        for index, payload in enumerate(payloads, start=1):
+            contents += [f"Imagen {index}:", {"mime_type": "image/jpeg", "data": payload}]
+        logger.info(f"Analizando {len(payloads)} imágenes en una petición a {self.model_name}...")
+        text = self._generate(contents, self.generation_config(len(payloads)))
+        return self._parse(text, len(payloads))
+
+    def describe(self) -> Dict[str, Any]:
+        info = super().describe()
+        info.update(response_mode=self.response_mode, subject_box=self.subject_box)
+        return info
+
+
+class LocalAnalyzer(Analyzer):
+    """Heurística local (costura del díptico, piel y saliencia), sin modelo ni red
+
+    Devuelve solo el lado y las personas, como un modelo: el corte lo calculan
+    las mismas reglas que para Gemini.
+    """
+
+    name = "local"
+
+    def analyze(self, payload: bytes) -> Dict[str, Any]:
+        from local_analysis import local_crop_analysis  # NumPy, solo con este backend
+        proxy = Image.open(BytesIO(payload))
+        analysis = local_crop_analysis(proxy, min_output_side=0)
+        analysis.pop("caja_corte", None)
+        return analysis
+
+
+class FakeAnalyzer(Analyzer):
+    """Respuestas fijas por turnos, para pruebas y entornos sin API key
+
+    Con `latency`, cada petición (una o varias imágenes) tarda esos segundos.
+    """
+
+    name = "fake"
+    supports_batch = True
+
+    def __init__(self, responses: Optional[List[Dict[str, Any]]] = None, latency: float = 0.0, spec: str = ""):
+        super().__init__(spec)
+        self.responses = responses or CANNED_ANALYSES
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def analyze_many(self, payloads: List[bytes]) -> List[Dict[str, Any]]:
+        with self._lock:
+            start = self.calls
+            self.calls += len(payloads)
+        if self.latency:
+            time.sleep(self.latency)
+        return [dict(self.responses[(start + offset) % len(self.responses)]) for offset in range(len(payloads))]
+
+    def analyze(self, payload: bytes) -> Dict[str, Any]:
+        return self.analyze_many([payload])[0]
+
+
+class FakeGeminiModel:
+    """Modelo simulado con el `generate_content` de genai, sin red ni API key
+
+    Sirve para ejercitar GeminiAnalyzer (lotes, reintentos) en los benchmarks.
+    Devuelve por turnos las respuestas enlatadas (como JSON en un bloque
+    ```json, igual que Gemini) tras una latencia normal de media `latency` y
+    desviación `jitter` segundos. Con `error_rate` lanza un error transitorio.
+    Si la petición trae varias imágenes responde un array con un análisis por
+    imagen, como en las peticiones por lotes de GeminiAnalyzer.
+    """
+
+    def __init__(self, responses: Optional[List[Dict[str, Any]]] = None, latency: float = 0.0,
+                 jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.responses = responses or CANNED_ANALYSES
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self.images = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents, generation_config=None, request_options=None):
+        images = sum(1 for part in contents if isinstance(part, dict))
+        with self._lock:
+            index = self.images
+            self.calls += 1
+            self.images += images
+            delay = max(0.0, self._random.gauss(self.latency, self.jitter)) if self.latency else 0.0
+            fail = self._random.random() < self.error_rate
+        time.sleep(delay)
+        if fail:
+            from google.api_core import exceptions as google_exceptions
+            raise google_exceptions.ServiceUnavailable("Error simulado")
+        analyses = [self.responses[(index + offset) % len(self.responses)] for offset in range(images)]
+        data = analyses[0] if images == 1 else analyses
+        return SimpleNamespace(text=f"```json\n{json.dumps(data, ensure_ascii=False)}\n```")
+
+
+class ReplayAnalyzer(Analyzer):
+    """Reproducir análisis grabados en un archivo JSONL (una línea por imagen)
+
+    Las imágenes se identifican por los bytes de su copia de análisis, así que
+    la grabación vale mientras no cambie ANALYSIS_MAX_SIDE. Con `inner`
+    (backend `record`) las imágenes que faltan se analizan con él y se añaden
+    al archivo; sin él, una imagen no grabada lanza KeyError.
+    """
+
+    name = "replay"
+
+    def __init__(self, path: str, inner: Optional[Analyzer] = None, spec: str = ""):
+        super().__init__(spec or f"{'record' if inner is not None else 'replay'}:{path}")
+        self.path = path
+        self.inner = inner
+        if inner is not None:
+            self.name = "record"
+            self.model_name = inner.model_name
+            self.supports_batch = inner.supports_batch
+        self._records: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._records[record["key"]] = record["analysis"]
+        logger.info(f"Análisis grabados cargados: {len(self._records)} ({path})")
+
+    def _record(self, key: str, analysis: Dict[str, Any]) -> None:
+        with self._lock:
+            self._records[key] = analysis
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "analysis": analysis}, ensure_ascii=False) + "\n")
+
+    def analyze_many(self, payloads: List[bytes]) -> List[Dict[str, Any]]:
+        keys = [payload_key(payload) for payload in payloads]
+        with self._lock:
+            found = {key: self._records[key] for key in keys if key in self._records}
+        missing = [index for index, key in enumerate(keys) if key not in found]
+        if missing:
+            if self.inner is None:
+                raise KeyError(f"Imagen sin análisis grabado: {keys[missing[0]]}")
+            analyses = self.inner.analyze_many([payloads[index] for index in missing])
+            for index, analysis in zip(missing, analyses):
+                self._record(keys[index], analysis)
+                found[keys[index]] = analysis
+        return [dict(found[key]) for key in keys]
+
+    def analyze(self, payload: bytes) -> Dict[str, Any]:
+        return self.analyze_many([payload])[0]
+
+
+class _PendingAnalysis:
+    """Imagen esperando a que su lote se envíe"""
+
+    def __init__(self, payload: bytes):
+        self.payload = payload
+        self.leader = False
+        self.finished = False
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[BaseException] = None
+
+
+class BatchingAnalyzer(Analyzer):
+    """Agrupar en una petición `analyze_many` los análisis que llegan a la vez
+
+    La primera imagen que llega hace de líder: espera hasta `window` segundos
+    (o a que haya `max_batch` imágenes) y envía el lote; mientras tanto, la
+    siguiente imagen pendiente ya reúne el lote siguiente. Un error transitorio
+    se devuelve a todas las imágenes del lote (cada una lo reintenta); si la
+    respuesta del lote no es válida, sus imágenes se analizan una a una.
+    """
+
+    def __init__(self, inner: Analyzer, max_batch: int = ANALYZER_BATCH_SIZE, window: float = ANALYZER_BATCH_WINDOW):
+        super().__init__(inner.spec)
+        self.inner = inner
+        self.name = inner.name
+        self.model_name = inner.model_name
+        self.supports_batch = True
+        self.max_batch = max_batch
+        self.window = window
+        self.batches = 0
+        self.batched_images = 0
+        self._pending: List[_PendingAnalysis] = []
+        self._collecting = False
+        self._cond = threading.Condition()
+
+    def analyze(self, payload: bytes) -> Dict[str, Any]:
+        item = _PendingAnalysis(payload)
+        with self._cond:
+            self._pending.append(item)
+            if not self._collecting:
+                self._collecting = True
+                item.leader = True
+            self._cond.notify_all()
+            while not item.leader and not item.finished:
+                self._cond.wait()
+        if not item.finished:
+            self._send_batch()
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def analyze_many(self, payloads: List[bytes]) -> List[Dict[str, Any]]:
+        return self.inner.analyze_many(payloads)
+
+    def _send_batch(self) -> None:
+        deadline = time.monotonic() + self.window
+        with self._cond:
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            if self._pending:
+                # La siguiente imagen reúne el próximo lote mientras se envía este
+                self._pending[0].leader = True
+                self._cond.notify_all()
+            else:
+                self._collecting = False
+            self.batches += 1
+            self.batched_images += len(batch)
+
+        payloads = [item.payload for item in batch]
+        try:
+            try:
+                results: List[Any] = self.inner.analyze_many(payloads)
+            except ValueError as e:
+                if len(batch) == 1:
+                    raise
+                logger.warning(f"Lote de {len(batch)} imágenes no válido ({e}): se analizan una a una")
+                results = []
+                for payload in payloads:
+                    try:
+                        results.append(self.inner.analyze(payload))
+                    except Exception as item_error:
+                        results.append(item_error)
+        except Exception as e:
+            results = [e] * len(batch)
+
+        with self._cond:
+            for item, result in zip(batch, results):
+                if isinstance(result, BaseException):
+                    item.error = result
+                else:
+                    item.result = result
+                item.finished = True
+            self._cond.notify_all()
+
+    def describe(self) -> Dict[str, Any]:
+        info = self.inner.describe()
+        with self._cond:
+            info.update(batch=True, max_batch=self.max_batch, window=self.window, batches=self.batches,
+                        images_per_batch=round(self.batched_images / self.batches, 2) if self.batches else None)
+        return info
+
+
+def parse_analyzer_spec(spec: str) -> Tuple[str, str]:
+    """(backend, argumento) de una especificación; lanza ValueError si no es válida"""
+    backend, _, argument = (spec or DEFAULT_ANALYZER).strip().partition(":")
+    backend = backend.lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend de análisis desconocido: {backend} (disponibles: {', '.join(BACKENDS)})")
+    if backend in ("replay", "record") and not argument:
+        raise ValueError(f"El backend {backend} necesita la ruta del archivo: {backend}:<ruta.jsonl>")
+    return backend, argument
+
+
+def model_for(spec: str) -> str:
+    """Modelo que usa una especificación (para los backends sin modelo, el propio backend)"""
+    backend, argument = parse_analyzer_spec(spec)
+    if backend == "gemini":
+        return argument or DEFAULT_GEMINI_MODEL
+    if backend == "record":
+        return DEFAULT_GEMINI_MODEL
+    return backend
+
+
+def analysis_identity(spec: str) -> str:
+    """Lo que determina el análisis de una especificación: backend, modelo y formato de respuesta de Gemini"""
+    backend, _ = parse_analyzer_spec(spec)
+    if backend in ("gemini", "record"):
+        return f"gemini:{model_for(spec)}:{GEMINI_RESPONSE_MODE}{':caja' if GEMINI_SUBJECT_BOX else ''}"
+    return (spec or DEFAULT_ANALYZER).strip()
+
+
+def requires_api_key(spec: str) -> bool:
+    """Si el backend llama a Gemini (y por tanto necesita API key)"""
+    return parse_analyzer_spec(spec)[0] in ("gemini", "record")
+
+
+def parse_route_analyzers(value: str) -> Dict[str, str]:
+    """Backends por ruta de la API: "batch=gemini:gemini-2.5-flash-lite,jobs=fake" -> dict"""
+    routes = {}
+    for part in (value or "").split(","):
+        if not part.strip():
+            continue
+        route, separator, spec = part.partition("=")
+        if not separator:
+            raise ValueError(f"Entrada no válida en ANALYZER_ROUTES: {part.strip()} (ruta=backend[:argumento])")
+        parse_analyzer_spec(spec)
+        routes[route.strip()] = spec.strip()
+    return routes
+
+
+def create_analyzer(spec: Optional[str] = None, api_key: str = "", rate_limiter: Optional[RateLimiter] = None,
+                    batch_size: int = ANALYZER_BATCH_SIZE) -> Analyzer:
+    """Crear el backend de una especificación `backend[:argumento]`
+
+    gemini[:modelo], local, fake[:respuestas.json], replay:<grabación.jsonl> o
+    record:<grabación.jsonl> (Gemini con el modelo por defecto, grabando). Con
+    `batch_size` > 1 los backends con lotes agrupan los análisis simultáneos.
+    """
+    spec = (spec or DEFAULT_ANALYZER).strip()
+    backend, argument = parse_analyzer_spec(spec)
+    if backend == "gemini":
+        analyzer: Analyzer = GeminiAnalyzer(api_key, argument or DEFAULT_GEMINI_MODEL, rate_limiter, spec=spec)
+    elif backend == "local":
+        analyzer = LocalAnalyzer(spec)
+    elif backend == "fake":
+        responses = None
+        if argument:
+            with open(argument, encoding="utf-8") as f:
+                responses = json.load(f)
+        analyzer = FakeAnalyzer(responses, spec=spec)
+    elif backend == "replay":
+        analyzer = ReplayAnalyzer(argument, spec=spec)
+    else:
+        analyzer = ReplayAnalyzer(argument, inner=GeminiAnalyzer(api_key, DEFAULT_GEMINI_MODEL, rate_limiter),
+                                  spec=spec)
+    if batch_size > 1 and analyzer.supports_batch:
+        return BatchingAnalyzer(analyzer, max_batch=batch_size)
+    return analyzer
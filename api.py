@@ -4,28 +4,71 @@ API REST para el servicio de corte de imágenes para Instagram
 Usando FastAPI para crear endpoints profesionales
 """
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
+from fastapi.responses import FileResponse, StreamingResponse, Response, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel, HttpUrl
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Literal, Tuple, AsyncIterator
 import uvicorn
 import os
-import tempfile
+import time
+import asyncio
+import functools
+import threading
+import json
 import logging
-from main import ImageProcessor
+import uuid
+import hashlib
+import dataclasses
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from main import (ImageProcessor, ProcessingResult, ImageTooLargeError, MAX_IMAGE_BYTES, ENGINES, DEFAULT_ENGINE,
+                  RENDITIONS, SERVED_BY_COALESCED, parse_renditions, get_gemini_rate_limiter,
+                  get_gemini_circuit_breaker)
+from cache import get_analysis_cache
+from jobs import JobQueue, get_job_store
+from singleflight import get_single_flight
+from httpcache import get_download_cache
+from outputs import get_cleanup_lease, get_output_store
+from metrics import metrics
+from admission import MemoryBudgetExceeded, get_memory_budget
+from encoding import EncodeOptions, available_formats, get_default_encoding, media_type_for
+from analyzers import (BACKENDS, DEFAULT_ANALYZER, ANALYZER_BATCH_SIZE, ANALYZER_BATCH_WINDOW, model_for,
+                       parse_analyzer_spec, parse_route_analyzers, preload_genai, requires_api_key)
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Arrancar la cola de trabajos y las tareas periódicas del worker, y pararlas al detener la API"""
+    logger.info("🚀 Iniciando Instagram Image Cropper API...")
+    job_queue.start()
+    # Cada worker programa la limpieza, pero en cada intervalo solo limpia el que obtiene el turno
+    output_store.start_cleanup(CLEANUP_INTERVAL, lease=get_cleanup_lease())
+    metrics.start_flush(METRICS_FLUSH_INTERVAL)
+    # El SDK de Gemini (~1 s) se importa en segundo plano: el worker ya responde
+    # a /health y la primera petición con Gemini no paga la importación
+    preload = os.getenv("PRELOAD_GEMINI_SDK", "true").lower() not in ("0", "false", "no")
+    if preload and any(requires_api_key(spec) for spec in {DEFAULT_ANALYZER, *ROUTE_ANALYZERS.values()}):
+        preload_genai()
+    yield
+    job_queue.stop()
+    output_store.stop_cleanup()
+    metrics.stop_flush()
+    processing_executor.shutdown(wait=False)
+
 # Crear aplicación FastAPI
 app = FastAPI(
     title="Instagram Image Cropper API",
     description="API para cortar imágenes automáticamente para Instagram usando Gemini AI",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan
 )
 
 # Configurar CORS
@@ -38,10 +81,50 @@ app.add_middleware(
 )
 
 # Modelos Pydantic
-class ImageAnalysisRequest(BaseModel):
+Engine = Literal["gemini", "local", "hybrid"]
+Rendition = Literal["square", "portrait", "story", "thumbnail", "thumbnail_small"]
+ImageFormat = Literal["jpeg", "webp", "avif"]
+Subsampling = Literal["4:4:4", "4:2:2", "4:2:0"]
+
+class EncodingFields(BaseModel):
+    """Opciones de codificación de las salidas; las omitidas usan las del servidor"""
+    image_format: Optional[ImageFormat] = None
+    quality: Optional[int] = None
+    progressive: Optional[bool] = None
+    optimize: Optional[bool] = None
+    subsampling: Optional[Subsampling] = None
+    target_ssim: Optional[float] = None
+
+class ImageAnalysisRequest(EncodingFields):
     url: HttpUrl
-    api_key: str
+    api_key: Optional[str] = None
     output_filename: Optional[str] = None
+    engine: Optional[Engine] = None
+    renditions: Optional[List[Rendition]] = None
+
+class BatchAnalysisRequest(EncodingFields):
+    urls: List[HttpUrl]
+    api_key: Optional[str] = None
+    engine: Optional[Engine] = None
+    renditions: Optional[List[Rendition]] = None
+
+class JobRequest(EncodingFields):
+    url: HttpUrl
+    api_key: Optional[str] = None
+    output_filename: Optional[str] = None
+    engine: Optional[Engine] = None
+    renditions: Optional[List[Rendition]] = None
+    callback_url: Optional[HttpUrl] = None
+
+class JobResponse(BaseModel):
+    job_id: str
+    status: str
+    status_url: str
+    created_at: Optional[float] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
 
 class ImageAnalysisResponse(BaseModel):
     success: bool
@@ -52,31 +135,404 @@ class ImageAnalysisResponse(BaseModel):
     download_url: Optional[str] = None
     view_url: Optional[str] = None
     processing_time: Optional[float] = None
+    cache: Optional[Dict[str, Any]] = None
+    served_by: Optional[str] = None
+    renditions: Optional[Dict[str, Dict[str, Any]]] = None
+    timings: Optional[Dict[str, float]] = None
 
 class HealthResponse(BaseModel):
     status: str
     version: str
     gemini_model: str
+    analyzer: Optional[Dict[str, Any]] = None
+    cache: Optional[Dict[str, Any]] = None
+    jobs: Optional[Dict[str, Any]] = None
+    gemini: Optional[Dict[str, Any]] = None
+    single_flight: Optional[Dict[str, Any]] = None
+    downloads: Optional[Dict[str, Any]] = None
+    outputs: Optional[Dict[str, Any]] = None
+    memory: Optional[Dict[str, Any]] = None
+
+# Caché de análisis compartida por todas las peticiones (y workers, vía SQLite)
+analysis_cache = get_analysis_cache()
+
+# Caché HTTP en disco de las imágenes descargadas (compartida entre workers)
+download_cache = get_download_cache()
+
+# Almacén de salidas direccionado por contenido (OUTPUT_DIR), con limpieza periódica
+output_store = get_output_store()
+
+# Presupuesto de memoria de las imágenes en proceso, compartido por todos los procesadores del worker
+memory_budget = get_memory_budget()
+CLEANUP_INTERVAL = float(os.getenv("CLEANUP_INTERVAL", "3600"))
+
+# Prefijo de la location `internal` de nginx que apunta a OUTPUT_DIR. Si se
+# configura, /download y /view responden con X-Accel-Redirect y nginx envía
+# el archivo con sendfile (Python no lee los bytes).
+OUTPUT_ACCEL_REDIRECT = os.getenv("OUTPUT_ACCEL_REDIRECT", "")
+
+# Codificación por defecto de las salidas (OUTPUT_FORMAT, OUTPUT_QUALITY...)
+default_encoding = get_default_encoding()
+
+# Cada worker vuelca sus métricas a SQLite cada METRICS_FLUSH_INTERVAL segundos;
+# /metrics suma las de todos los workers
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+# Peticiones idénticas simultáneas (también entre workers) comparten un solo procesamiento
+single_flight = get_single_flight()
 
-# Variable global para el procesador
-processor = None
+# Limitador de Gemini compartido: un bucket por API key (y entre workers con SQLite)
+gemini_rate_limiter = get_gemini_rate_limiter()
+
+# Backend de análisis por ruta (url, file, batch, jobs); las no indicadas usan ANALYZER.
+# P. ej. ANALYZER_ROUTES="batch=gemini:gemini-2.5-flash-lite,jobs=gemini:gemini-2.5-flash-lite"
+ROUTE_ANALYZERS = parse_route_analyzers(os.getenv("ANALYZER_ROUTES", ""))
+parse_analyzer_spec(DEFAULT_ANALYZER)
+
+def route_analyzer(route: str) -> str:
+    """Especificación del backend de análisis de una ruta"""
+    return ROUTE_ANALYZERS.get(route, DEFAULT_ANALYZER)
+
+class ProcessorPool:
+    """Pool LRU de procesadores indexado por API key y backend de análisis
+
+    Reutiliza el ImageProcessor (y su cliente de Gemini) de cada API key en vez
+    de crearlo en cada petición, con un tamaño máximo acotado. Cada procesador
+    tiene su propio circuit breaker: la cuota agotada de una key (o de un
+    modelo) no desvía al motor local el tráfico de las demás.
+    """
+
+    def __init__(self, max_size: int = 32):
+        self.max_size = max_size
+        self._processors: "OrderedDict[Tuple[str, str], ImageProcessor]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, api_key: str, analyzer: str = DEFAULT_ANALYZER) -> ImageProcessor:
+        """Obtener el procesador de una API key y un backend, creándolo si no existe"""
+        key = (api_key, analyzer)
+        with self._lock:
+            processor = self._processors.get(key)
+            if processor is not None:
+                self._processors.move_to_end(key)
+                return processor
+
+            # Crear bajo el lock: un solo procesador por API key y backend
+            processor = ImageProcessor(api_key, cache=analysis_cache, rate_limiter=gemini_rate_limiter,
+                                       circuit_breaker=get_gemini_circuit_breaker(),
+                                       single_flight=single_flight, download_cache=download_cache,
+                                       output_store=output_store, encoding=default_encoding,
+                                       analyzer=analyzer, memory_budget=memory_budget)
+            self._processors[key] = processor
+            if len(self._processors) > self.max_size:
+                self._processors.popitem(last=False)
+            return processor
+
+    def analyzers(self) -> Dict[str, Dict[str, Any]]:
+        """Backends de análisis en uso (uno por especificación) con su configuración"""
+        with self._lock:
+            processors = list(self._processors.values())
+        return {processor.analyzer.spec: processor.analyzer.describe() for processor in processors}
+
+    def breaker_states(self) -> Dict[str, int]:
+        """Número de circuit breakers (uno por API key) en cada estado"""
+        with self._lock:
+            breakers = [p.circuit_breaker for p in self._processors.values() if p.circuit_breaker is not None]
+        states = {"closed": 0, "open": 0, "half_open": 0}
+        for breaker in breakers:
+            states[breaker.state] += 1
+        return states
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._processors)
+
+processor_pool = ProcessorPool(max_size=int(os.getenv("PROCESSOR_POOL_SIZE", "32")))
+
+# Máximo de imágenes por petición a /analyze-batch
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "100"))
+
+# Límite de imágenes procesándose a la vez en este worker. El trabajo bloqueante
+# (descarga, Gemini, decodificación, corte, redimensionado y JPEG) corre en un
+# pool de hilos acotado para no detener el event loop de uvicorn.
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "8"))
+processing_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("PROCESSING_THREADS", str(MAX_CONCURRENT_REQUESTS))),
+    thread_name_prefix="procesamiento"
+)
+processing_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+async def run_blocking(func, *args, **kwargs):
+    """Ejecutar una función bloqueante en el pool de procesamiento sin bloquear el event loop"""
+    async with processing_slots:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(processing_executor, functools.partial(func, *args, **kwargs))
 
 # Configuración de URLs públicas
 BASE_URL = "http://thumbnail.shortenqr.com:8088"
 PUBLIC_OUTPUT_DIR = "/var/www/instagram-cropper/public"
 
-def get_public_urls(filename: str) -> tuple:
+def resolve_engine(api_key: Optional[str], engine: Optional[str], route: str) -> str:
+    """Validar el motor pedido; todos salvo `local` necesitan API key si el backend de la ruta es Gemini"""
+    engine = engine or DEFAULT_ENGINE
+    if engine not in ENGINES:
+        raise HTTPException(status_code=400, detail=f"Motor desconocido: {engine}")
+    if engine != "local" and not api_key and requires_api_key(route_analyzer(route)):
+        raise HTTPException(status_code=400, detail=f"Se requiere api_key para el motor '{engine}'")
+    return engine
+
+# Tipos de respuesta de /analyze-file y /crop: JSON con URLs, la imagen en el
+# cuerpo o multipart/mixed con el JSON y las imágenes
+RESPONSE_KINDS = ("json", "image", "multipart")
+
+def resolve_encoding(image_format: Optional[str] = None, quality: Optional[int] = None,
+                     progressive: Optional[bool] = None, optimize: Optional[bool] = None,
+                     subsampling: Optional[str] = None, target_ssim: Optional[float] = None) -> EncodeOptions:
+    """Codificación pedida sobre la del servidor; 400 si no es válida"""
+    overrides = {
+        "format": image_format,
+        "quality": quality,
+        "progressive": progressive,
+        "optimize": optimize,
+        "subsampling": subsampling,
+        "target_ssim": target_ssim,
+    }
+    try:
+        return dataclasses.replace(
+            default_encoding, **{key: value for key, value in overrides.items() if value is not None}
+        ).validate()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def request_encoding(request: EncodingFields) -> EncodeOptions:
+    return resolve_encoding(request.image_format, request.quality, request.progressive,
+                            request.optimize, request.subsampling, request.target_ssim)
+
+def check_inline_options(response_kind: str, renditions) -> None:
+    """Validar el tipo de respuesta pedido"""
+    if response_kind not in RESPONSE_KINDS:
+        raise HTTPException(status_code=400, detail=f"Tipo de respuesta desconocido: {response_kind}")
+    if response_kind == "image" and len(renditions) > 1:
+        raise HTTPException(status_code=400, detail="La respuesta 'image' admite un solo formato; usa 'multipart'")
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """Cabecera Server-Timing con el desglose por etapa (ms)"""
+    return ", ".join(f"{stage};dur={ms}" for stage, ms in timings.items())
+
+def build_inline_response(result: ProcessingResult, images: Dict[str, bytes], response_kind: str,
+                          encoding: EncodeOptions, processing_time: float) -> Response:
+    """Devolver las imágenes en el cuerpo de la respuesta, sin pasar por disco"""
+    media_type = encoding.media_type
+    if response_kind == "image":
+        name, content = next(iter(images.items()))
+        return Response(content=content, media_type=media_type, headers={
+            "X-Rendition": name,
+            "X-Served-By": result.served_by,
+            "X-Crop-Coordinates": json.dumps(result.crop_coordinates),
+            "X-Processing-Time": f"{processing_time:.2f}",
+            "Server-Timing": server_timing(result.timings),
+        })
+
+    analysis = ImageAnalysisResponse(
+        success=True,
+        message="Imagen procesada exitosamente",
+        analysis=result.analysis,
+        crop_coordinates=result.crop_coordinates,
+        processing_time=round(processing_time, 2),
+        cache=get_cache_info(result.cache_hit),
+        served_by=result.served_by,
+        renditions=result.renditions,
+        timings=result.timings
+    )
+    boundary = uuid.uuid4().hex
+    parts = [(
+        b"Content-Type: application/json\r\n\r\n"
+        + json.dumps(jsonable_encoder(analysis), ensure_ascii=False).encode("utf-8")
+    )]
+    for name, content in images.items():
+        parts.append(
+            f"Content-Type: {media_type}\r\n"
+            f'Content-Disposition: attachment; name="{name}"; filename="{name}.{encoding.extension}"\r\n\r\n'.encode("utf-8")
+            + content
+        )
+    body = b"".join(f"--{boundary}\r\n".encode("utf-8") + part + b"\r\n" for part in parts)
+    body += f"--{boundary}--\r\n".encode("utf-8")
+    return Response(content=body, media_type=f"multipart/mixed; boundary={boundary}")
+
+async def process_upload(data: bytes, api_key: Optional[str], engine: str, renditions,
+                         output_filename: Optional[str], response_kind: str, encoding: EncodeOptions):
+    """Procesar una imagen recibida en el cuerpo de la petición, decodificándola desde memoria"""
+    start_time = time.time()
+    processor = processor_pool.get(api_key or "", route_analyzer("file"))
+    if response_kind == "json":
+        result = await run_blocking(processor.process_image, data, output_path_for(output_filename),
+                                    engine, renditions, encoding)
+        return build_analysis_response(result, time.time() - start_time)
+    result, images = await run_blocking(processor.process_to_bytes, data, engine, renditions, encoding)
+    return build_inline_response(result, images, response_kind, encoding, time.time() - start_time)
+
+async def read_body(request: Request) -> bytes:
+    """Leer el cuerpo crudo de la petición, cortando en cuanto supera MAX_IMAGE_BYTES"""
+    declared = request.headers.get("content-length")
+    if MAX_IMAGE_BYTES and declared and declared.isdigit() and int(declared) > MAX_IMAGE_BYTES:
+        raise ImageTooLargeError(f"La imagen pesa {int(declared)} bytes (máximo {MAX_IMAGE_BYTES})")
+    buffer = bytearray()
+    async for chunk in request.stream():
+        buffer.extend(chunk)
+        if MAX_IMAGE_BYTES and len(buffer) > MAX_IMAGE_BYTES:
+            raise ImageTooLargeError(f"La imagen supera el máximo de {MAX_IMAGE_BYTES} bytes")
+    return bytes(buffer)
+
+def check_output_filename(output_filename: Optional[str]) -> Optional[str]:
+    """Validar el nombre de salida elegido por el cliente (sin rutas)"""
+    if output_filename:
+        try:
+            output_store.named_path(output_filename)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return output_filename
+
+def output_path_for(output_filename: Optional[str]) -> Optional[str]:
+    """Ruta dentro del almacén para un nombre de salida ya validado"""
+    return output_store.named_path(output_filename) if output_filename else None
+
+def process_url(api_key: Optional[str], url: str, output_filename: Optional[str], engine: str,
+                renditions: Optional[List[str]] = None, encoding: Optional[EncodeOptions] = None,
+                route: str = "url") -> ProcessingResult:
+    """Procesar una URL coalesciendo las peticiones idénticas en curso (bloqueante)
+
+    `route` elige el backend de análisis (ANALYZER_ROUTES). La clave incluye
+    todo lo que cambia el resultado: URL, motor, backend, formatos,
+    codificación, nombre de salida y API key (hasheada).
+    """
+    processor = processor_pool.get(api_key or "", route_analyzer(route))
+    output_path = output_path_for(output_filename)
+    encoding = encoding or default_encoding
+    if single_flight is None:
+        return processor.process_image(url, output_path, engine, renditions, encoding)
+    key = hashlib.sha256(json.dumps(
+        [url, engine, processor.analyzer_spec, renditions or [], encoding.key(), output_filename,
+         processor.limiter_key]
+    ).encode("utf-8")).hexdigest()
+    result, shared = single_flight.do(
+        f"url:{key}",
+        lambda: processor.process_image(url, output_path, engine, renditions, encoding),
+        encode=ProcessingResult.to_dict,
+        decode=lambda data: ProcessingResult(**data)
+    )
+    if shared:
+        result = dataclasses.replace(result, served_by=SERVED_BY_COALESCED)
+        metrics.inc("cropper_images_total", served_by=SERVED_BY_COALESCED)
+    return result
+
+def get_cache_info(cache_hit: Optional[bool] = None) -> Optional[Dict[str, Any]]:
+    """Estadísticas de la caché de análisis para incluir en las respuestas"""
+    if analysis_cache is None:
+        return None
+    info = analysis_cache.stats()
+    if cache_hit is not None:
+        info["hit"] = cache_hit
+    return info
+
+def get_jobs_info() -> Optional[Dict[str, Any]]:
+    """Métricas de la cola de trabajos (profundidad y tiempo de espera)"""
+    try:
+        return job_queue.store.stats()
+    except Exception as e:
+        logger.warning(f"No se pudieron leer las métricas de la cola: {e}")
+        return None
+
+def get_gemini_info() -> Dict[str, Any]:
+    """Estado de Gemini para /health: circuit breakers y configuración del limitador"""
+    breakers = processor_pool.breaker_states()
+    if breakers["open"]:
+        status = "degraded"
+    elif breakers["half_open"]:
+        status = "recovering"
+    else:
+        status = "healthy"
+    return {
+        "status": status,
+        "circuit_breakers": breakers,
+        "rate_limiter": type(gemini_rate_limiter).__name__ if gemini_rate_limiter else None,
+    }
+
+def get_analyzer_info() -> Dict[str, Any]:
+    """Backends de análisis para /health: el de por defecto, los de cada ruta y los que están en uso"""
+    return {
+        "default": DEFAULT_ANALYZER,
+        "routes": ROUTE_ANALYZERS,
+        "batch_size": ANALYZER_BATCH_SIZE,
+        "batch_window": ANALYZER_BATCH_WINDOW,
+        "active": processor_pool.analyzers(),
+    }
+
+def public_filename(path: str) -> str:
+    """Nombre público de una salida: las del almacén se sirven por su nombre, sin la ruta"""
+    return output_store.public_name(path) or os.path.basename(path)
+
+def get_public_urls(path: str) -> tuple:
     """Generar URLs públicas para ver y descargar la imagen"""
+    filename = public_filename(path)
     base_url = BASE_URL
     download_url = f"{base_url}/download/{filename}"
     view_url = f"{base_url}/view/{filename}"
     return download_url, view_url
 
-@app.on_event("startup")
-async def startup_event():
-    """Inicializar el procesador al arrancar la API"""
-    global processor
-    logger.info("🚀 Iniciando Instagram Image Cropper API...")
+def get_renditions_info(result: ProcessingResult) -> Dict[str, Dict[str, Any]]:
+    """Formatos generados, cada uno con sus URLs públicas"""
+    renditions = {}
+    for name, rendition in result.renditions.items():
+        download_url, view_url = get_public_urls(rendition["output_path"])
+        renditions[name] = {**rendition, "download_url": download_url, "view_url": view_url}
+    return renditions
+
+def build_analysis_response(result: ProcessingResult, processing_time: float) -> ImageAnalysisResponse:
+    """Construir la respuesta de la API a partir del resultado del procesamiento"""
+    download_url, view_url = get_public_urls(result.output_path)
+    return ImageAnalysisResponse(
+        success=True,
+        message="Imagen procesada exitosamente",
+        analysis=result.analysis,
+        crop_coordinates=result.crop_coordinates,
+        output_file=public_filename(result.output_path),
+        download_url=download_url,
+        view_url=view_url,
+        processing_time=round(processing_time, 2),
+        cache=get_cache_info(result.cache_hit),
+        served_by=result.served_by,
+        renditions=get_renditions_info(result),
+        timings=result.timings
+    )
+
+def run_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Ejecutar un trabajo de la cola (corre en los hilos de la cola, no en el event loop)"""
+    start_time = time.time()
+    encoding = EncodeOptions(**payload["encoding"]) if payload.get("encoding") else None
+    result = process_url(payload["api_key"], payload["url"], payload.get("output_filename"),
+                         payload.get("engine"), payload.get("renditions"), encoding, route="jobs")
+    return jsonable_encoder(build_analysis_response(result, time.time() - start_time))
+
+# Cola de trabajos en segundo plano (POST /jobs)
+job_queue = JobQueue(get_job_store(), run_job, workers=int(os.getenv("JOB_WORKERS", "2")))
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Histograma de duración por ruta (la plantilla, no la URL concreta) y estado"""
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.observe("cropper_http_request_seconds", time.perf_counter() - start, method=request.method,
+                    route=getattr(route, "path", "desconocida"), status=response.status_code)
+    return response
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Métricas en formato Prometheus, sumadas entre todos los workers"""
+    # La cola es compartida: su profundidad se lee al consultar, no se suma por worker
+    jobs = get_jobs_info()
+    if jobs is not None:
+        metrics.set_gauge("cropper_jobs_queue_depth", jobs["queue_depth"])
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/", response_model=HealthResponse)
 async def root():
@@ -84,7 +540,15 @@ async def root():
     return HealthResponse(
         status="healthy",
         version="1.0.0",
-        gemini_model="gemini-2.5-flash"
+        gemini_model=model_for(DEFAULT_ANALYZER),
+        analyzer=get_analyzer_info(),
+        cache=get_cache_info(),
+        jobs=get_jobs_info(),
+        gemini=get_gemini_info(),
+        single_flight=single_flight.stats() if single_flight else None,
+        downloads=download_cache.stats() if download_cache else None,
+        outputs=output_store.stats(),
+        memory=memory_budget.stats() if memory_budget else None
     )
 
 @app.get("/health", response_model=HealthResponse)
@@ -93,7 +557,15 @@ async def health_check():
     return HealthResponse(
         status="healthy",
         version="1.0.0",
-        gemini_model="gemini-2.5-flash"
+        gemini_model=model_for(DEFAULT_ANALYZER),
+        analyzer=get_analyzer_info(),
+        cache=get_cache_info(),
+        jobs=get_jobs_info(),
+        gemini=get_gemini_info(),
+        single_flight=single_flight.stats() if single_flight else None,
+        downloads=download_cache.stats() if download_cache else None,
+        outputs=output_store.stats(),
+        memory=memory_budget.stats() if memory_budget else None
     )
 
 @app.post("/analyze-url", response_model=ImageAnalysisResponse)
@@ -102,43 +574,38 @@ async def analyze_image_from_url(request: ImageAnalysisRequest):
     Analizar y cortar imagen desde URL
     
     - **url**: URL de la imagen a procesar
-    - **api_key**: API key de Google Gemini
+    - **api_key**: API key de Google Gemini (opcional con el motor `local`)
     - **output_filename**: Nombre opcional para el archivo de salida
+    - **engine**: Motor de recorte: `gemini`, `local` (sin Gemini) o `hybrid`
+    - **renditions**: Formatos a generar (`square`, `portrait`, `story`, `thumbnail`, `thumbnail_small`)
+    - **image_format**, **quality**, **progressive**, **optimize**, **subsampling**, **target_ssim**:
+      codificación de las salidas (por defecto la del servidor)
     """
+    engine = resolve_engine(request.api_key, request.engine, "url")
+    check_output_filename(request.output_filename)
+    encoding = request_encoding(request)
     try:
-        import time
         start_time = time.time()
         
-        # Crear procesador con la API key
-        global processor
-        processor = ImageProcessor(request.api_key)
-        
-        # Procesar imagen
-        output_file = processor.process_image(
-            str(request.url), 
-            request.output_filename
+        # Procesar imagen (compartiendo el trabajo con peticiones idénticas en curso)
+        result = await run_blocking(
+            process_url,
+            request.api_key,
+            str(request.url),
+            request.output_filename,
+            engine,
+            request.renditions,
+            encoding
         )
         
         processing_time = time.time() - start_time
         
-        # Obtener análisis del último procesamiento
-        analysis = getattr(processor, '_last_analysis', {})
-        crop_coords = getattr(processor, '_last_crop_coordinates', {})
-        
-        # Generar URLs públicas
-        download_url, view_url = get_public_urls(output_file)
-        
-        return ImageAnalysisResponse(
-            success=True,
-            message="Imagen procesada exitosamente",
-            analysis=analysis,
-            crop_coordinates=crop_coords,
-            output_file=output_file,
-            download_url=download_url,
-            view_url=view_url,
-            processing_time=round(processing_time, 2)
-        )
+        return build_analysis_response(result, processing_time)
         
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except MemoryBudgetExceeded as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         logger.error(f"Error procesando imagen: {e}")
         raise HTTPException(
@@ -149,59 +616,51 @@ async def analyze_image_from_url(request: ImageAnalysisRequest):
 @app.post("/analyze-file", response_model=ImageAnalysisResponse)
 async def analyze_image_from_file(
     file: UploadFile = File(...),
-    api_key: str = Form(...),
-    output_filename: Optional[str] = Form(None)
+    api_key: Optional[str] = Form(None),
+    output_filename: Optional[str] = Form(None),
+    engine: Optional[str] = Form(None),
+    renditions: Optional[str] = Form(None),
+    response: str = Form("json"),
+    image_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None),
+    progressive: Optional[bool] = Form(None),
+    optimize: Optional[bool] = Form(None),
+    subsampling: Optional[str] = Form(None),
+    target_ssim: Optional[float] = Form(None)
 ):
     """
     Analizar y cortar imagen desde archivo subido
     
     - **file**: Archivo de imagen a procesar
-    - **api_key**: API key de Google Gemini
+    - **api_key**: API key de Google Gemini (opcional con el motor `local`)
     - **output_filename**: Nombre opcional para el archivo de salida
+    - **engine**: Motor de recorte: `gemini`, `local` (sin Gemini) o `hybrid`
+    - **renditions**: Formatos a generar, separados por comas (por defecto `square`)
+    - **response**: `json` (URLs de descarga), `image` (la imagen en el cuerpo) o `multipart` (JSON + imágenes)
+    - **image_format**, **quality**, **progressive**, **optimize**, **subsampling**, **target_ssim**:
+      codificación de las salidas (por defecto la del servidor)
     """
+    engine = resolve_engine(api_key, engine, "file")
+    check_output_filename(output_filename)
     try:
-        import time
-        start_time = time.time()
-        
-        # Guardar archivo temporalmente
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{file.filename.split('.')[-1]}") as temp_file:
-            content = await file.read()
-            temp_file.write(content)
-            temp_file_path = temp_file.name
-        
-        # Crear procesador
-        global processor
-        processor = ImageProcessor(api_key)
-        
-        # Procesar imagen
-        output_file = processor.process_image(
-            temp_file_path,
-            output_filename
-        )
-        
-        processing_time = time.time() - start_time
-        
-        # Limpiar archivo temporal
-        os.unlink(temp_file_path)
-        
-        # Obtener análisis del último procesamiento
-        analysis = getattr(processor, '_last_analysis', {})
-        crop_coords = getattr(processor, '_last_crop_coordinates', {})
-        
-        # Generar URLs públicas
-        download_url, view_url = get_public_urls(output_file)
+        renditions = parse_renditions(renditions)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    check_inline_options(response, renditions)
+    encoding = resolve_encoding(image_format, quality, progressive, optimize, subsampling, target_ssim)
+    try:
+        # El upload ya está en memoria (o en un archivo temporal si es grande):
+        # se decodifica directamente desde el buffer, sin copia intermedia en disco
+        content = await file.read()
+        if MAX_IMAGE_BYTES and len(content) > MAX_IMAGE_BYTES:
+            raise ImageTooLargeError(f"El archivo pesa {len(content)} bytes (máximo {MAX_IMAGE_BYTES})")
         
-        return ImageAnalysisResponse(
-            success=True,
-            message="Imagen procesada exitosamente",
-            analysis=analysis,
-            crop_coordinates=crop_coords,
-            output_file=output_file,
-            download_url=download_url,
-            view_url=view_url,
-            processing_time=round(processing_time, 2)
-        )
+        return await process_upload(content, api_key, engine, renditions, output_filename, response, encoding)
         
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except MemoryBudgetExceeded as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         logger.error(f"Error procesando archivo: {e}")
         raise HTTPException(
@@ -209,42 +668,257 @@ async def analyze_image_from_file(
             detail=f"Error procesando archivo: {str(e)}"
         )
 
-@app.get("/download/{filename}")
-async def download_image(filename: str):
-    """Descargar imagen procesada"""
-    file_path = filename
-    if os.path.exists(file_path):
-        return FileResponse(
-            file_path,
-            media_type="image/jpeg",
-            filename=filename
-        )
-    else:
+@app.post("/crop")
+async def crop_raw_image(
+    request: Request,
+    engine: Optional[str] = None,
+    renditions: Optional[str] = None,
+    response: str = "image",
+    output_filename: Optional[str] = None,
+    image_format: Optional[str] = None,
+    quality: Optional[int] = None,
+    progressive: Optional[bool] = None,
+    optimize: Optional[bool] = None,
+    subsampling: Optional[str] = None,
+    target_ssim: Optional[float] = None
+):
+    """
+    Cortar una imagen enviada como cuerpo crudo (`application/octet-stream` o `image/*`)
+
+    La API key de Gemini va en la cabecera `X-API-Key` (opcional con el motor `local`).
+
+    - **engine**: Motor de recorte: `gemini`, `local` (sin Gemini) o `hybrid`
+    - **renditions**: Formatos a generar, separados por comas (por defecto `square`)
+    - **response**: `image` (por defecto, la imagen en el cuerpo), `multipart` (JSON + imágenes) o `json`
+    - **output_filename**: Nombre de salida para la respuesta `json`
+    - **image_format**, **quality**, **progressive**, **optimize**, **subsampling**, **target_ssim**:
+      codificación de las salidas (por defecto la del servidor)
+    """
+    api_key = request.headers.get("x-api-key")
+    engine = resolve_engine(api_key, engine, "file")
+    check_output_filename(output_filename)
+    try:
+        renditions = parse_renditions(renditions)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    check_inline_options(response, renditions)
+    encoding = resolve_encoding(image_format, quality, progressive, optimize, subsampling, target_ssim)
+    try:
+        content = await read_body(request)
+        if not content:
+            raise HTTPException(status_code=400, detail="El cuerpo de la petición está vacío")
+        return await process_upload(content, api_key, engine, renditions, output_filename, response, encoding)
+    except HTTPException:
+        raise
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except MemoryBudgetExceeded as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        logger.error(f"Error procesando imagen: {e}")
         raise HTTPException(
-            status_code=404,
-            detail="Archivo no encontrado"
+            status_code=500,
+            detail=f"Error procesando imagen: {str(e)}"
         )
 
-@app.get("/view/{filename}")
-async def view_image(filename: str):
-    """Ver imagen procesada en el navegador"""
-    file_path = filename
-    if os.path.exists(file_path):
-        return FileResponse(
-            file_path,
-            media_type="image/jpeg"
+@app.post("/analyze-batch")
+async def analyze_batch(request: BatchAnalysisRequest):
+    """
+    Analizar y cortar un lote de imágenes desde URLs
+
+    Devuelve NDJSON: una línea por imagen en cuanto termina (en orden de
+    finalización, con su `index`), y una última línea `summary` con el
+    rendimiento. Un error en una imagen no detiene el resto.
+
+    - **urls**: Lista de URLs de imágenes a procesar
+    - **api_key**: API key de Google Gemini (opcional con el motor `local`)
+    - **engine**: Motor de recorte: `gemini`, `local` (sin Gemini) o `hybrid`
+    - **renditions**: Formatos a generar para cada imagen (por defecto `square`)
+    - **image_format**, **quality**, **progressive**, **optimize**, **subsampling**, **target_ssim**:
+      codificación de las salidas (por defecto la del servidor)
+    """
+    engine = resolve_engine(request.api_key, request.engine, "batch")
+    encoding = request_encoding(request)
+    if not request.urls:
+        raise HTTPException(status_code=400, detail="La lista de URLs está vacía")
+    if len(request.urls) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Máximo {MAX_BATCH_SIZE} imágenes por lote"
         )
-    else:
+
+    async def process_one(index: int, url: str) -> Dict[str, Any]:
+        start = time.time()
+        try:
+            result = await run_blocking(process_url, request.api_key, url, None, engine,
+                                        request.renditions, encoding, "batch")
+            download_url, view_url = get_public_urls(result.output_path)
+            item = {
+                "success": True,
+                "analysis": result.analysis,
+                "crop_coordinates": result.crop_coordinates,
+                "output_file": public_filename(result.output_path),
+                "download_url": download_url,
+                "view_url": view_url,
+                "cache_hit": result.cache_hit,
+                "served_by": result.served_by,
+                "renditions": get_renditions_info(result),
+                "timings": result.timings,
+            }
+        except Exception as e:
+            logger.error(f"Error procesando imagen del lote {url}: {e}")
+            item = {"success": False, "error": str(e)}
+        item.update(index=index, url=url, processing_time=round(time.time() - start, 2))
+        return item
+
+    async def stream():
+        start = time.time()
+        tasks = [asyncio.ensure_future(process_one(i, str(url))) for i, url in enumerate(request.urls)]
+        succeeded = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                item = await next_done
+                succeeded += item["success"]
+                yield json.dumps(item, ensure_ascii=False) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+        elapsed = time.time() - start
+        summary = {
+            "total": len(tasks),
+            "succeeded": succeeded,
+            "failed": len(tasks) - succeeded,
+            "elapsed": round(elapsed, 2),
+            "images_per_second": round(len(tasks) / elapsed, 2) if elapsed else None,
+        }
+        yield json.dumps({"summary": summary}) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.post("/jobs", response_model=JobResponse, status_code=202)
+async def create_job(request: JobRequest):
+    """
+    Encolar el procesamiento de una imagen y responder de inmediato
+
+    - **url**: URL de la imagen a procesar
+    - **api_key**: API key de Google Gemini (opcional con el motor `local`)
+    - **output_filename**: Nombre opcional para el archivo de salida
+    - **callback_url**: Webhook opcional que recibe el estado final del trabajo (POST JSON)
+    - **engine**: Motor de recorte: `gemini`, `local` (sin Gemini) o `hybrid`
+    - **renditions**: Formatos a generar (por defecto `square`)
+    - **image_format**, **quality**, **progressive**, **optimize**, **subsampling**, **target_ssim**:
+      codificación de las salidas (por defecto la del servidor)
+    """
+    payload = {
+        "url": str(request.url),
+        "api_key": request.api_key,
+        "output_filename": check_output_filename(request.output_filename),
+        "engine": resolve_engine(request.api_key, request.engine, "jobs"),
+        "renditions": request.renditions,
+        "encoding": dataclasses.asdict(request_encoding(request)),
+    }
+    callback_url = str(request.callback_url) if request.callback_url else None
+    job_id = await asyncio.get_running_loop().run_in_executor(
+        processing_executor, job_queue.submit, payload, callback_url
+    )
+    return JobResponse(job_id=job_id, status="queued", status_url=f"{BASE_URL}/jobs/{job_id}")
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    """Consultar el estado (y el resultado, si terminó) de un trabajo"""
+    # La consulta a SQLite puede esperar al lock de la base: fuera del event loop
+    job = await asyncio.get_running_loop().run_in_executor(processing_executor, job_queue.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    job.pop("callback_url", None)
+    return JobResponse(status_url=f"{BASE_URL}/jobs/{job_id}", **job)
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Rango único `bytes=a-b`, `bytes=a-` o `bytes=-n` como (inicio, fin) inclusivos
+
+    Devuelve None si la cabecera no se entiende o pide varios rangos (se sirve
+    el archivo completo) y lanza 416 si el rango no es satisfacible.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start, end = max(0, size - int(last)), size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Rango no satisfacible",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+def serve_output(request: Request, filename: str, as_attachment: bool) -> Response:
+    """Servir una salida del almacén con ETag, 304, rangos y X-Accel-Redirect opcional"""
+    file_path = output_store.resolve(filename)
+    if file_path is None:
         raise HTTPException(
             status_code=404,
             detail="Archivo no encontrado"
         )
 
+    etag = output_store.etag_for(file_path)
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        # Las salidas direccionadas por contenido no cambian nunca; las de nombre elegido se revalidan
+        "Cache-Control": "public, max-age=31536000, immutable" if output_store.is_immutable(file_path)
+        else "public, no-cache",
+    }
+    if as_attachment:
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")) or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+
+    if OUTPUT_ACCEL_REDIRECT:
+        relative = os.path.relpath(file_path, output_store.directory).replace(os.sep, "/")
+        headers["X-Accel-Redirect"] = f"{OUTPUT_ACCEL_REDIRECT.rstrip('/')}/{relative}"
+        return Response(headers=headers, media_type=media_type_for(file_path))
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range == etag):
+        size = os.path.getsize(file_path)
+        byte_range = parse_range(range_header, size)
+        if byte_range is not None:
+            start, end = byte_range
+            with open(file_path, "rb") as f:
+                f.seek(start)
+                content = f.read(end - start + 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            return Response(content=content, status_code=206, headers=headers,
+                            media_type=media_type_for(file_path))
+
+    return FileResponse(file_path, media_type=media_type_for(file_path), headers=headers)
+
+@app.get("/download/{filename}")
+def download_image(filename: str, request: Request):
+    """Descargar imagen procesada"""
+    return serve_output(request, filename, as_attachment=True)
+
+@app.get("/view/{filename}")
+def view_image(filename: str, request: Request):
+    """Ver imagen procesada en el navegador"""
+    return serve_output(request, filename, as_attachment=False)
+
 @app.get("/models")
 async def get_available_models():
     """Obtener información sobre modelos disponibles"""
     return {
-        "current_model": "gemini-2.5-flash",
+        "current_model": model_for(DEFAULT_ANALYZER),
+        "analyzer": DEFAULT_ANALYZER,
+        "route_models": {route: model_for(spec) for route, spec in ROUTE_ANALYZERS.items()},
+        "backends": list(BACKENDS),
         "model_type": "multimodal",
         "capabilities": [
             "image_analysis",
@@ -254,7 +928,7 @@ async def get_available_models():
             "json_output"
         ],
         "supported_formats": ["jpg", "jpeg", "png", "webp"],
-        "max_image_size": "10MB"
+        "max_image_size": f"{MAX_IMAGE_BYTES // (1024 * 1024)}MB"
     }
 
 @app.get("/rules")
@@ -270,7 +944,9 @@ async def get_cropping_rules():
         "output_format": {
             "aspect_ratio": "1:1 (cuadrado)",
             "dimensions": "1080x1080 pixels",
-            "quality": "95% JPEG"
+            "quality": f"{default_encoding.quality}% {default_encoding.format.upper()}",
+            "formats": list(available_formats()),
+            "renditions": {name: f"{width}x{height}" for name, (width, height) in RENDITIONS.items()}
         },
         "coordinate_format": "PIL standard (left, top, right, bottom)"
     }
@@ -0,0 +1,695 @@
+#!/usr/bin/env python3
+"""
+Benchmarks del servicio de corte de imágenes para Instagram
+Cada subcomando mide una parte del pipeline y muestra un resumen en consola
+"""
+
+import os
+import sys
+import time
+import json
+import math
+import socket
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+import subprocess
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+
+import requests
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Percentil por rango más cercano (pct entre 0 y 100)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize_latencies(latencies: List[float]) -> Dict[str, float]:
+    """Resumen de latencias en milisegundos"""
+    return {
+        "count": len(latencies),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 1) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(max(latencies) * 1000, 1) if latencies else 0.0,
+    }
+
+
+def bench_load(args) -> Dict[str, Any]:
+    """Carga concurrente contra /analyze-url, midiendo a la vez la latencia de /health"""
+    payload = {"url": args.url, "api_key": args.api_key}
+    latencies: List[float] = []
+    health_latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def one_request(_):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            response = requests.post(f"{args.base_url}/analyze-url", json=payload, timeout=300)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    def probe_health():
+        # Si el event loop se bloquea, /health lo refleja inmediatamente
+        while not done.is_set():
+            start = time.perf_counter()
+            try:
+                requests.get(f"{args.base_url}/health", timeout=30)
+                health_latencies.append(time.perf_counter() - start)
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+
+    prober = threading.Thread(target=probe_health, daemon=True)
+    prober.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(one_request, range(args.requests)))
+    wall = time.perf_counter() - start
+    done.set()
+    prober.join()
+
+    summary = {
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "errors": errors,
+        "wall_s": round(wall, 2),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        "analyze": summarize_latencies(latencies),
+        "health": summarize_latencies(health_latencies),
+    }
+    return summary
+
+
+def crop_iou(a, b) -> float:
+    """Intersección sobre unión de dos áreas de corte (left, top, right, bottom)"""
+    width = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    height = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union else 1.0
+
+
+def bench_proxy(args) -> Dict[str, Any]:
+    """Comparar el análisis a resolución completa contra la copia reducida"""
+    from main import ImageProcessor
+
+    processor = ImageProcessor(args.api_key)
+    rows = []
+    for source in args.sources:
+        image = processor.load_image(source)
+        image.load()
+        row = {"source": source, "size": list(image.size)}
+        crops = {}
+        for label, max_side in (("full", 0), ("proxy", args.analysis_size)):
+            processor.analysis_max_side = max_side
+            start = time.perf_counter()
+            payload = processor.encode_for_analysis(image)
+            encode_time = time.perf_counter() - start
+            start = time.perf_counter()
+            analysis = processor.analyzer.analyze(payload)
+            total_time = time.perf_counter() - start
+            crops[label] = processor.calculate_crop_area(image, analysis)
+            row[label] = {
+                "upload_bytes": len(payload),
+                "encode_ms": round(encode_time * 1000, 1),
+                "analysis_ms": round(total_time * 1000, 1),
+                "crop": list(crops[label]),
+            }
+        row["crop_iou"] = round(crop_iou(crops["full"], crops["proxy"]), 3)
+        rows.append(row)
+
+    def mean(label, key):
+        return round(statistics.mean(row[label][key] for row in rows), 1)
+
+    return {
+        "analysis_size": args.analysis_size,
+        "images": rows,
+        "mean_upload_bytes": {"full": mean("full", "upload_bytes"), "proxy": mean("proxy", "upload_bytes")},
+        "mean_analysis_ms": {"full": mean("full", "analysis_ms"), "proxy": mean("proxy", "analysis_ms")},
+        "crop_agreement": round(sum(row["crop_iou"] >= 0.9 for row in rows) / len(rows), 3),
+    }
+
+
+def _measure_decode(source: str, min_crop_side: int) -> Dict[str, Any]:
+    """Decodificar una imagen en un proceso nuevo y medir tiempo y pico de memoria"""
+    import resource
+    from main import decode_image
+
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    image = decode_image(source, min_crop_side)
+    image.load()
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "decoded_size": list(image.size),
+        "decode_ms": round(elapsed * 1000, 1),
+        "peak_rss_delta_mb": round((peak_kb - baseline_kb) / 1024, 1),
+    }
+
+
+def bench_decode(args) -> Dict[str, Any]:
+    """Decodificación completa vs reducida (draft) por imagen, cada una en un proceso aislado"""
+    import multiprocessing
+
+    # maxtasksperchild=1: cada medición arranca con el pico de RSS del proceso a cero
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    with context.Pool(processes=1, maxtasksperchild=1) as pool:
+        for source in args.sources:
+            row = {"source": source}
+            for label, side in (("full", 0), ("draft", args.crop_side)):
+                row[label] = pool.apply(_measure_decode, (source, side))
+            rows.append(row)
+    return {"crop_side": args.crop_side, "images": rows}
+
+
+# Codificaciones comparadas por `encode`: etiqueta -> opciones de EncodeOptions
+ENCODE_PRESETS = {
+    "jpeg_q95": {},
+    "jpeg_q85_progressive": {"quality": 85, "progressive": True},
+    "jpeg_q85_420": {"quality": 85, "subsampling": "4:2:0", "optimize": True},
+    "jpeg_ssim_0.99": {"target_ssim": 0.99},
+    "webp_q80": {"format": "webp", "quality": 80},
+    "webp_ssim_0.99": {"format": "webp", "target_ssim": 0.99},
+    "avif_q60": {"format": "avif", "quality": 60},
+}
+
+
+def bench_encode(args) -> Dict[str, Any]:
+    """Tiempo de codificación, bytes y SSIM de cada preset sobre el cuadrado central de cada imagen"""
+    from PIL import Image
+    from main import ImageProcessor, OUTPUT_SIZE
+    from encoding import EncodeOptions, encode_image, available_formats, ssim, _luma
+
+    processor = ImageProcessor("", engine="local")
+    outputs = []
+    for source in args.sources:
+        image = processor.load_image(source)
+        side = min(image.size)
+        left, top = (image.width - side) // 2, (image.height - side) // 2
+        output = image.resize(OUTPUT_SIZE, Image.Resampling.LANCZOS, box=(left, top, left + side, top + side))
+        outputs.append(output.convert("RGB"))
+
+    formats = available_formats()
+    presets = {}
+    for label, overrides in ENCODE_PRESETS.items():
+        options = EncodeOptions(**overrides)
+        if options.format not in formats:
+            presets[label] = {"skipped": f"Pillow sin soporte para {options.format}"}
+            continue
+        times, sizes, scores, qualities = [], [], [], []
+        for output in outputs:
+            reference = _luma(output)
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                data, quality = encode_image(output, options)
+                times.append(time.perf_counter() - start)
+            sizes.append(len(data))
+            qualities.append(quality)
+            scores.append(ssim(reference, _luma(Image.open(BytesIO(data)))))
+        presets[label] = {
+            "encode": summarize_latencies(times),
+            "mean_bytes": round(statistics.mean(sizes)),
+            "total_bytes": sum(sizes),
+            "mean_ssim": round(statistics.mean(scores), 4),
+            "qualities": qualities,
+        }
+
+    baseline = presets["jpeg_q95"]["total_bytes"]
+    for preset in presets.values():
+        if "total_bytes" in preset:
+            preset["bytes_vs_jpeg_q95"] = round(preset["total_bytes"] / baseline, 3)
+    return {"images": len(outputs), "repeat": args.repeat, "presets": presets}
+
+
+# Corpus generado: tamaños de cámara/redes habituales y composiciones
+CORPUS_SIZES = ((1080, 1080), (2048, 1365), (4032, 3024), (6000, 4000))
+CORPUS_LAYOUTS = ("single", "diptych_left", "diptych_right", "diptych_both")
+
+
+def _synthetic_image(width: int, height: int, layout: str, rng) -> "Image.Image":
+    """Imagen sintética: fondo con degradado y textura, costura central en los dípticos
+    y figuras de persona (elipses) en los lados que corresponda"""
+    import numpy as np
+    from PIL import Image, ImageDraw
+
+    small_width = 480
+    small_height = max(1, round(small_width * height / width))
+    x = np.linspace(0, 1, small_width)[None, :, None]
+    y = np.linspace(0, 1, small_height)[:, None, None]
+    base = rng.uniform(40, 200, 3) + 50 * np.sin(6 * x + 3 * y + rng.uniform(0, 6, 3))
+    if layout != "single":
+        # Dos fotos distintas lado a lado
+        right = rng.uniform(40, 200, 3) + 50 * np.cos(5 * y - 4 * x + rng.uniform(0, 6, 3))
+        base = np.where(x > 0.5, right, base)
+    small = Image.fromarray(np.clip(base, 0, 255).astype(np.uint8))
+
+    draw = ImageDraw.Draw(small)
+    sides = {"single": (0.5,), "diptych_left": (0.25,), "diptych_right": (0.75,),
+             "diptych_both": (0.25, 0.75)}[layout]
+    for center in sides:
+        cx, scale = center * small_width, small_height / 4
+        draw.ellipse((cx - scale * 0.35, scale * 0.9, cx + scale * 0.35, scale * 1.6), fill=(224, 172, 138))
+        draw.ellipse((cx - scale * 0.7, scale * 1.6, cx + scale * 0.7, scale * 3.6), fill=(40, 60, 120))
+
+    image = small.resize((width, height), Image.Resampling.BICUBIC)
+    # Textura a resolución completa para que el JPEG pese como una foto real
+    noise = rng.integers(0, 24, (height, width, 3), dtype=np.uint8)
+    pixels = np.asarray(image, dtype=np.uint8)
+    return Image.fromarray(np.clip(pixels.astype(np.int16) + noise - 12, 0, 255).astype(np.uint8))
+
+
+def generate_corpus(directory: str, sizes=CORPUS_SIZES, layouts=CORPUS_LAYOUTS, seed: int = 0) -> List[str]:
+    """Generar (o reutilizar, si ya existe) el corpus de imágenes; devuelve sus rutas"""
+    import numpy as np
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for width, height in sizes:
+        for index, layout in enumerate(layouts):
+            path = os.path.join(directory, f"{layout}_{width}x{height}_s{seed}.jpg")
+            if not os.path.exists(path):
+                # Semilla por imagen: el mismo corpus aunque solo falte parte
+                rng = np.random.default_rng([seed, width, height, index])
+                _synthetic_image(width, height, layout, rng).save(path, "JPEG", quality=90)
+            paths.append(path)
+    return paths
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _run_meta() -> Dict[str, Any]:
+    """Commit y entorno de una ejecución, para poder comparar resultados"""
+    return {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def _multipart_timings(response) -> Dict[str, float]:
+    """Desglose por etapa de la parte JSON de una respuesta multipart de /crop"""
+    import email
+
+    message = email.message_from_bytes(
+        f"Content-Type: {response.headers['Content-Type']}\r\n\r\n".encode("utf-8") + response.content
+    )
+    analysis = json.loads(message.get_payload()[0].get_payload(decode=True))
+    return analysis.get("timings") or {}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _offline_environment(work_dir: str) -> None:
+    """Aislar el benchmark: sin cachés compartidas ni límites, todo bajo `work_dir`"""
+    os.environ.update({
+        "ANALYSIS_CACHE_ENABLED": "false",
+        "DOWNLOAD_CACHE_ENABLED": "false",
+        "SINGLE_FLIGHT_BACKEND": "memory",
+        "JOB_QUEUE_BACKEND": "memory",
+        "METRICS_BACKEND": "memory",
+        "GEMINI_RATE_LIMIT_BACKEND": "memory",
+        "GEMINI_REQUESTS_PER_MINUTE": "0",
+        "GEMINI_BREAKER_THRESHOLD": "0",
+        "OUTPUT_DIR": os.path.join(work_dir, "outputs"),
+    })
+
+
+def _peak_rss_kb() -> int:
+    """Pico de memoria residente del proceso (KB)
+
+    VmHWM es del propio proceso; ru_maxrss en Linux conserva el pico del padre
+    tras fork/exec, así que solo se usa si no hay /proc.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_offline(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Medir el pipeline en un proceso nuevo (el pico de RSS no incluye la generación del corpus)"""
+    _offline_environment(config["work_dir"])
+    from main import ImageProcessor
+    from analyzers import GeminiAnalyzer, BatchingAnalyzer, FakeGeminiModel
+    logging.getLogger().setLevel(logging.WARNING)
+
+    model = FakeGeminiModel(responses=config["responses"], latency=config["latency"],
+                            jitter=config["jitter"], error_rate=config["error_rate"])
+    fake_analyzer = GeminiAnalyzer("fake", model_name="fake", model=model)
+    if config["analyzer_batch"] > 1:
+        fake_analyzer = BatchingAnalyzer(fake_analyzer, max_batch=config["analyzer_batch"])
+    baseline_kb = _peak_rss_kb()
+    sources = config["sources"] * config["repeat"]
+    server = None
+
+    if config["target"] == "processor":
+        processor = ImageProcessor("fake", engine=config["engine"], analyzer=fake_analyzer)
+        output_dir = os.path.join(config["work_dir"], "processor")
+        os.makedirs(output_dir, exist_ok=True)
+
+        def run_one(index_source: Tuple[int, str]) -> Dict[str, Any]:
+            index, source = index_source
+            start = time.perf_counter()
+            result = processor.process_image(source, os.path.join(output_dir, f"{index:04d}.jpg"),
+                                             renditions=config["renditions"])
+            return {"latency": time.perf_counter() - start, "timings": result.timings}
+    else:
+        base_url = config["base_url"]
+        if not base_url:
+            import uvicorn
+            import api
+
+            # El pool de la API crea los procesadores con el modelo simulado, sea cual sea el backend
+            def fake_processor(*args, analyzer=None, **kwargs):
+                return ImageProcessor(*args, analyzer=fake_analyzer, **kwargs)
+
+            api.ImageProcessor = fake_processor
+            port = _free_port()
+            server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=port, log_level="warning"))
+            threading.Thread(target=server.run, daemon=True).start()
+            while not server.started:
+                time.sleep(0.05)
+            base_url = f"http://127.0.0.1:{port}"
+        session = requests.Session()
+        params = {"engine": config["engine"], "renditions": ",".join(config["renditions"]), "response": "multipart"}
+
+        def run_one(index_source: Tuple[int, str]) -> Dict[str, Any]:
+            _, source = index_source
+            with open(source, "rb") as f:
+                body = f.read()
+            start = time.perf_counter()
+            response = session.post(f"{base_url}/crop", params=params, data=body,
+                                    headers={"X-API-Key": "fake", "Content-Type": "image/jpeg"}, timeout=300)
+            response.raise_for_status()
+            return {"latency": time.perf_counter() - start, "timings": _multipart_timings(response)}
+
+    latencies: List[float] = []
+    stages: Dict[str, List[float]] = {}
+    errors = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=config["concurrency"]) as executor:
+        futures = [executor.submit(run_one, item) for item in enumerate(sources)]
+        for future in futures:
+            try:
+                item = future.result()
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(item["latency"])
+            for stage, ms in item["timings"].items():
+                stages.setdefault(stage, []).append(ms)
+    wall = time.perf_counter() - start
+    peak_kb = _peak_rss_kb()
+    if server is not None:
+        server.should_exit = True
+
+    return {
+        "images": len(sources),
+        "errors": errors,
+        "wall_s": round(wall, 2),
+        "throughput_ips": round(len(latencies) / wall, 2) if wall else 0.0,
+        "latency": summarize_latencies(latencies),
+        "stages_mean_ms": {stage: round(statistics.mean(values), 1) for stage, values in sorted(stages.items())},
+        "peak_rss_mb": round(peak_kb / 1024, 1),
+        "peak_rss_delta_mb": round((peak_kb - baseline_kb) / 1024, 1),
+        "model_calls": model.calls,
+    }
+
+
+def bench_offline(args) -> Dict[str, Any]:
+    """Pipeline completo con Gemini simulado, sobre un corpus generado de tamaños y dípticos"""
+    import multiprocessing
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="cropper-bench-")
+    corpus_dir = args.corpus_dir or os.path.join(work_dir, "corpus")
+    sizes = [tuple(int(side) for side in size.split("x")) for size in args.sizes.split(",")]
+    sources = generate_corpus(corpus_dir, sizes, args.layouts.split(","), seed=args.seed)
+    responses = None
+    if args.responses:
+        with open(args.responses, encoding="utf-8") as f:
+            responses = json.load(f)
+
+    config = {
+        "target": args.target,
+        "base_url": args.base_url,
+        "work_dir": work_dir,
+        "sources": sources,
+        "repeat": args.repeat,
+        "concurrency": args.concurrency,
+        "engine": args.engine,
+        "renditions": args.renditions.split(","),
+        "responses": responses,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "error_rate": args.error_rate,
+        "analyzer_batch": args.analyzer_batch,
+    }
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes=1) as pool:
+        results = pool.apply(_run_offline, (config,))
+
+    summary = {
+        "meta": _run_meta(),
+        "config": {key: value for key, value in config.items()
+                   if key not in ("sources", "work_dir", "responses")},
+        "corpus": {"images": len(sources), "sizes": [f"{w}x{h}" for w, h in sizes],
+                   "layouts": args.layouts.split(",")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+        print(f"💾 Resultados guardados en: {args.output}")
+    return summary
+
+
+# Arranques en frío que mide `startup` (argumentos de python, desde la raíz del repo)
+STARTUP_COMMANDS = {
+    "cli_help": ["main.py", "--help"],
+    "import_main": ["-c", "import main"],
+    "import_api": ["-c", "import api"],
+}
+
+# Dependencias pesadas que se importan en el primer uso y no al arrancar
+LAZY_MODULES = ("google.generativeai", "google.api_core", "requests", "numpy")
+
+
+def _parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    """(módulo, profundidad, tiempo acumulado en µs) de la salida de `python -X importtime`"""
+    modules = []
+    for line in stderr.splitlines():
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), depth, int(parts[1])))
+    return modules
+
+
+def bench_startup(args) -> Dict[str, Any]:
+    """Arranque en frío de la CLI y de los workers de la API, en procesos nuevos
+
+    Mide la mediana del tiempo total de cada comando y, con `-X importtime`,
+    las importaciones más lentas. Es una regresión que se importe al arrancar
+    alguno de LAZY_MODULES o que se supere `--max-ms`.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    _offline_environment(tempfile.mkdtemp(prefix="cropper-startup-"))
+    results = {}
+    regressions = []
+    for name, command in STARTUP_COMMANDS.items():
+        wall = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, *command], cwd=root, capture_output=True, check=True)
+            wall.append(time.perf_counter() - start)
+        traced = subprocess.run([sys.executable, "-X", "importtime", *command], cwd=root,
+                                capture_output=True, text=True, check=True)
+        modules = _parse_importtime(traced.stderr)
+        loaded = {module for module, _, _ in modules}
+        slowest = sorted((item for item in modules if item[1] <= 1), key=lambda item: item[2], reverse=True)
+        eager = [module for module in LAZY_MODULES if module in loaded]
+        results[name] = {
+            "wall_ms": round(statistics.median(wall) * 1000, 1),
+            "min_ms": round(min(wall) * 1000, 1),
+            "modules": len(loaded),
+            "slowest_imports_ms": {module: round(us / 1000, 1) for module, _, us in slowest[:8]},
+            "eager_lazy_modules": eager,
+        }
+        regressions += [f"{name}: importa {module} al arrancar" for module in eager]
+        if args.max_ms and results[name]["wall_ms"] > args.max_ms:
+            regressions.append(f"{name}: {results[name]['wall_ms']} ms > {args.max_ms} ms")
+
+    summary = {
+        "meta": _run_meta(),
+        "config": {"repeat": args.repeat, "max_ms": args.max_ms},
+        "results": {"commands": results},
+        "regressions": regressions,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+        print(f"💾 Resultados guardados en: {args.output}")
+    return summary
+
+
+def bench_compare(args) -> Dict[str, Any]:
+    """Comparar dos resultados de `offline` o de `startup` (p. ej. de dos commits): cambio relativo de cada métrica"""
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding="utf-8") as f:
+        candidate = json.load(f)
+
+    def metrics_of(summary):
+        results = summary["results"]
+        if "commands" in results:
+            return {f"{name}_wall_ms": command["wall_ms"] for name, command in results["commands"].items()}
+        values = {
+            "throughput_ips": results["throughput_ips"],
+            "peak_rss_delta_mb": results["peak_rss_delta_mb"],
+        }
+        for key in ("p50_ms", "p90_ms", "p99_ms"):
+            values[f"latency_{key}"] = results["latency"][key]
+        for stage, ms in results["stages_mean_ms"].items():
+            values[f"stage_{stage}_ms"] = ms
+        return values
+
+    old, new = metrics_of(baseline), metrics_of(candidate)
+    changes = {}
+    for key in sorted(set(old) & set(new)):
+        change = (new[key] - old[key]) / old[key] if old[key] else None
+        changes[key] = {"baseline": old[key], "candidate": new[key],
+                        "change": round(change, 3) if change is not None else None}
+    # Más throughput es mejor; en el resto (tiempos y memoria), menos es mejor
+    regressions = [
+        key for key, value in changes.items() if value["change"] is not None
+        and (value["change"] < -args.threshold if key == "throughput_ips" else value["change"] > args.threshold)
+    ]
+    return {
+        "baseline": baseline["meta"].get("commit"),
+        "candidate": candidate["meta"].get("commit"),
+        "changes": changes,
+        "regressions": regressions,
+    }
+
+
+def main():
+    """Función principal"""
+    parser = argparse.ArgumentParser(description="Benchmarks del servicio de corte de imágenes")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    load = subparsers.add_parser("load", help="Latencia p50/p99 de la API bajo concurrencia")
+    load.add_argument("url", help="URL de la imagen a procesar en cada petición")
+    load.add_argument("--base-url", default="http://localhost:8000", help="URL base de la API")
+    load.add_argument("-k", "--api-key", default=os.getenv("GEMINI_API_KEY"), help="API key de Google Gemini")
+    load.add_argument("-c", "--concurrency", type=int, default=8, help="Peticiones simultáneas")
+    load.add_argument("-n", "--requests", type=int, default=32, help="Total de peticiones")
+    load.set_defaults(func=bench_load)
+
+    proxy = subparsers.add_parser("proxy", help="Análisis con copia reducida vs resolución completa")
+    proxy.add_argument("sources", nargs="+", help="URLs o rutas de imágenes")
+    proxy.add_argument("-k", "--api-key", default=os.getenv("GEMINI_API_KEY"), help="API key de Google Gemini")
+    proxy.add_argument("--analysis-size", type=int, default=768, help="Lado mayor de la copia reducida")
+    proxy.set_defaults(func=bench_proxy)
+
+    decode = subparsers.add_parser("decode", help="Tiempo y memoria de decodificación completa vs reducida")
+    decode.add_argument("sources", nargs="+", help="Rutas de imágenes locales")
+    decode.add_argument("--crop-side", type=int, default=1080, help="Lado mínimo del corte final")
+    decode.set_defaults(func=bench_decode)
+
+    encode = subparsers.add_parser("encode", help="Tiempo de codificación y bytes por formato de salida")
+    encode.add_argument("sources", nargs="+", help="URLs o rutas de las imágenes del corpus")
+    encode.add_argument("--repeat", type=int, default=3, help="Codificaciones por imagen y preset")
+    encode.set_defaults(func=bench_encode)
+
+    offline = subparsers.add_parser("offline", help="Pipeline completo con Gemini simulado (sin red ni API key)")
+    offline.add_argument("--target", choices=("processor", "app"), default="processor",
+                         help="ImageProcessor directamente o la API (uvicorn en el proceso o --base-url)")
+    offline.add_argument("--base-url", help="Medir una API ya arrancada en vez de levantar una en el proceso")
+    offline.add_argument("--engine", choices=("gemini", "local", "hybrid"), default="gemini")
+    offline.add_argument("--renditions", default="square", help="Formatos a generar, separados por comas")
+    offline.add_argument("--sizes", default=",".join(f"{w}x{h}" for w, h in CORPUS_SIZES),
+                         help="Tamaños del corpus generado (ANCHOxALTO separados por comas)")
+    offline.add_argument("--layouts", default=",".join(CORPUS_LAYOUTS), help="Composiciones del corpus")
+    offline.add_argument("--seed", type=int, default=0, help="Semilla del corpus generado")
+    offline.add_argument("--corpus-dir", help="Directorio del corpus (se reutiliza si ya existe)")
+    offline.add_argument("--work-dir", help="Directorio de trabajo (por defecto uno temporal)")
+    offline.add_argument("-n", "--repeat", type=int, default=3, help="Pasadas sobre el corpus")
+    offline.add_argument("-c", "--concurrency", type=int, default=4, help="Imágenes simultáneas")
+    offline.add_argument("--latency", type=float, default=0.8, help="Latencia media (s) del modelo simulado")
+    offline.add_argument("--jitter", type=float, default=0.2, help="Desviación (s) de la latencia simulada")
+    offline.add_argument("--error-rate", type=float, default=0.0, help="Fracción de llamadas que fallan")
+    offline.add_argument("--analyzer-batch", type=int, default=1,
+                         help="Agrupar hasta N análisis simultáneos en una petición al modelo (1 no agrupa)")
+    offline.add_argument("--responses", help="JSON con la lista de análisis enlatados que devuelve el modelo")
+    offline.add_argument("-o", "--output", help="Guardar el resultado en este archivo JSON")
+    offline.set_defaults(func=bench_offline)
+
+    startup = subparsers.add_parser("startup", help="Arranque en frío de la CLI y de la API (python -X importtime)")
+    startup.add_argument("-n", "--repeat", type=int, default=5, help="Arranques por comando (se toma la mediana)")
+    startup.add_argument("--max-ms", type=float, help="Tiempo máximo de arranque por comando (regresión si se supera)")
+    startup.add_argument("-o", "--output", help="Guardar el resultado en este archivo JSON")
+    startup.set_defaults(func=bench_startup)
+
+    compare = subparsers.add_parser("compare", help="Comparar dos resultados JSON de `offline` o `startup`")
+    compare.add_argument("baseline", help="Resultado de referencia (p. ej. de main)")
+    compare.add_argument("candidate", help="Resultado a evaluar")
+    compare.add_argument("--threshold", type=float, default=0.1,
+                         help="Cambio relativo a partir del que se marca una regresión")
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    if args.command in ("load", "proxy") and not args.api_key:
+        print("Error: Se requiere una API key de Gemini. Usa -k o configura GEMINI_API_KEY")
+        sys.exit(1)
+
+    summary = args.func(args)
+    print(f"\n📊 Resultados ({args.command}):")
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    if args.command in ("compare", "startup") and summary["regressions"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Caché persistente de análisis de imágenes
+Guarda el análisis de Gemini y el área de corte indexados por el hash exacto del
+contenido (junto al hash perceptual de los píxeles), para que la misma foto no
+vuelva a pasar por Gemini
+"""
+
+import os
+import json
+import hashlib
+import time
+import sqlite3
+import tempfile
+import threading
+import logging
+from typing import Optional, Dict, Any, Tuple
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Cambiar esta versión invalida todas las entradas anteriores (p. ej. si cambia el prompt)
+CACHE_VERSION = "v3"
+
+DEFAULT_CACHE_PATH = os.path.join(tempfile.gettempdir(), "instagram-cropper", "analysis_cache.sqlite3")
+DEFAULT_CACHE_TTL = 7 * 24 * 3600  # 7 días
+DEFAULT_CACHE_MAX_ENTRIES = 10000
+
+
+def perceptual_hash(image: Image.Image) -> str:
+    """Calcular un hash perceptual de la imagen (dHash horizontal + vertical, 128 bits)
+
+    Se reduce a 9x9 en escala de grises y se compara cada píxel con su vecino
+    derecho e inferior, así que cambios de compresión o de tamaño no alteran el
+    hash. Se añade la proporción de la imagen para separar recortes distintos.
+    """
+    small = image.convert("L").resize((9, 9), Image.Resampling.BILINEAR, reducing_gap=3.0)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            current = pixels[row * 9 + col]
+            value = (value << 1) | (1 if current > pixels[row * 9 + col + 1] else 0)
+            value = (value << 1) | (1 if current > pixels[(row + 1) * 9 + col] else 0)
+    width, height = image.size
+    return f"{value:032x}-{width / height:.2f}"
+
+
+class AnalysisCache:
+    """Caché de análisis en SQLite con expiración por TTL y límite de entradas
+
+    Cada operación abre su propia conexión, de modo que la misma base de datos
+    puede compartirse entre hilos y entre los workers de uvicorn.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, ttl: int = DEFAULT_CACHE_TTL,
+                 max_entries: int = DEFAULT_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS analysis_cache (
+                    key TEXT PRIMARY KEY,
+                    analysis TEXT NOT NULL,
+                    crop_box TEXT NOT NULL,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_cache_accessed ON analysis_cache (accessed_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def key_for(image: Image.Image, analyzer: str = "") -> str:
+        """Clave de caché para una imagen ya decodificada y el backend que la analiza
+
+        `analyzer` identifica lo que determina el análisis (backend, modelo y
+        formato de respuesta), para no servir a un backend los análisis de otro.
+        El hash perceptual agrupa las versiones de una misma foto, pero fotos
+        distintas pueden coincidir en él, así que la clave incluye además el
+        hash exacto del contenido (el de los bytes de origen si se conoce, o
+        el de los píxeles decodificados).
+        """
+        content_hash = image.info.get("content_hash") or hashlib.sha256(image.tobytes()).hexdigest()
+        return f"{CACHE_VERSION}:{analyzer}:{perceptual_hash(image)}:{content_hash}"
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Obtener una entrada vigente, o None si no existe o expiró"""
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT analysis, crop_box, width, height, created_at FROM analysis_cache WHERE key = ?",
+                    (key,)
+                ).fetchone()
+                if row is not None and self.ttl and now - row[4] > self.ttl:
+                    conn.execute("DELETE FROM analysis_cache WHERE key = ?", (key,))
+                    row = None
+                if row is not None:
+                    conn.execute("UPDATE analysis_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            logger.warning(f"Error leyendo caché de análisis: {e}")
+            row = None
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        logger.info(f"Análisis encontrado en caché: {key}")
+        return {
+            "analysis": json.loads(row[0]),
+            "crop_box": tuple(json.loads(row[1])),
+            "size": (row[2], row[3]),
+        }
+
+    def put(self, key: str, analysis: Dict[str, Any], crop_box: Tuple[int, int, int, int],
+            size: Tuple[int, int]) -> None:
+        """Guardar el análisis y el área de corte, aplicando la política de expulsión"""
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO analysis_cache "
+                    "(key, analysis, crop_box, width, height, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, json.dumps(analysis, ensure_ascii=False), json.dumps(list(crop_box)),
+                     size[0], size[1], now, now)
+                )
+                self._evict(conn, now)
+        except sqlite3.Error as e:
+            logger.warning(f"Error escribiendo caché de análisis: {e}")
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        """Eliminar entradas expiradas y las menos usadas si se supera el límite"""
+        if self.ttl:
+            conn.execute("DELETE FROM analysis_cache WHERE created_at < ?", (now - self.ttl,))
+        if self.max_entries:
+            conn.execute(
+                "DELETE FROM analysis_cache WHERE key IN ("
+                "SELECT key FROM analysis_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        """Estadísticas de uso de la caché en este proceso"""
+        try:
+            with self._connect() as conn:
+                entries = conn.execute("SELECT COUNT(*) FROM analysis_cache").fetchone()[0]
+        except sqlite3.Error:
+            entries = None
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+                "entries": entries,
+            }
+
+
+def get_analysis_cache() -> Optional[AnalysisCache]:
+    """Crear la caché a partir de variables de entorno, o None si está deshabilitada"""
+    if os.getenv("ANALYSIS_CACHE_ENABLED", "true").lower() in ("0", "false", "no"):
+        return None
+    try:
+        return AnalysisCache(
+            path=os.getenv("ANALYSIS_CACHE_PATH", DEFAULT_CACHE_PATH),
+            ttl=int(os.getenv("ANALYSIS_CACHE_TTL", DEFAULT_CACHE_TTL)),
+            max_entries=int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", DEFAULT_CACHE_MAX_ENTRIES)),
+        )
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"No se pudo inicializar la caché de análisis: {e}")
+        return None
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Cálculo de la caja de recorte a partir de restricciones
+El análisis (de Gemini o local) se traduce en una región permitida (la imagen
+o el lado elegido de un díptico, cortado por la costura real), cajas que deben
+quedar completas (sujeto principal, textos o logos) y un margen de aire
+alrededor de ellas. La caja más grande con la proporción pedida se obtiene en
+forma cerrada, así que un solo análisis sirve para todos los formatos de
+salida sin nuevas llamadas al modelo.
+"""
+
+import os
+import logging
+from dataclasses import dataclass
+from typing import Optional, Any, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Caja (x0, y0, x1, y1); normalizada (0-1) en las restricciones, en píxeles al resolver
+Box = Tuple[float, float, float, float]
+
+FULL_IMAGE: Box = (0.0, 0.0, 1.0, 1.0)
+
+# Aire alrededor de las cajas a conservar, como fracción de su tamaño por cada lado
+DEFAULT_KEEP_MARGIN = float(os.getenv("CROP_KEEP_MARGIN", "0.1"))
+
+
+def normalize_box(box: Any) -> Optional[List[float]]:
+    """Caja [x0, y0, x1, y1] normalizada (0-1), o None si no es válida
+
+    Acepta también la escala 0-1000 que Gemini usa por defecto para las cajas.
+    """
+    if not isinstance(box, (list, tuple)) or len(box) != 4:
+        return None
+    try:
+        values = [float(value) for value in box]
+    except (TypeError, ValueError):
+        return None
+    if max(values) > 1:
+        if max(values) > 1000:
+            return None
+        values = [value / 1000 for value in values]
+    x0, x1 = sorted((min(max(values[0], 0.0), 1.0), min(max(values[2], 0.0), 1.0)))
+    y0, y1 = sorted((min(max(values[1], 0.0), 1.0), min(max(values[3], 0.0), 1.0)))
+    if x1 - x0 <= 0 or y1 - y0 <= 0:
+        return None
+    return [round(x0, 4), round(y0, 4), round(x1, 4), round(y1, 4)]
+
+
+@dataclass(frozen=True)
+class CropConstraints:
+    """Restricciones del recorte, normalizadas (0-1) a la imagen
+
+    `must_keep` va por prioridad: si no caben todas en la ventana, se
+    conservan las primeras que quepan juntas (y, si ni la primera cabe, el
+    recorte se centra en ella).
+    """
+
+    region: Box = FULL_IMAGE
+    must_keep: Tuple[Box, ...] = ()
+    margin: float = DEFAULT_KEEP_MARGIN
+
+
+def _to_pixels(box: Box, width: int, height: int) -> Box:
+    return (box[0] * width, box[1] * height, box[2] * width, box[3] * height)
+
+
+def _intersect(a: Box, b: Box) -> Optional[Box]:
+    box = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    return box if box[2] > box[0] and box[3] > box[1] else None
+
+
+def _union(a: Box, b: Box) -> Box:
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _pad(box: Box, margin: float) -> Box:
+    pad_x, pad_y = (box[2] - box[0]) * margin, (box[3] - box[1]) * margin
+    return (box[0] - pad_x, box[1] - pad_y, box[2] + pad_x, box[3] + pad_y)
+
+
+def _fits(box: Box, crop_width: float, crop_height: float) -> bool:
+    return box[2] - box[0] <= crop_width and box[3] - box[1] <= crop_height
+
+
+def _place(low: float, high: float, size: int, center: float,
+           keep: Optional[Tuple[float, float]]) -> int:
+    """Inicio de un segmento de `size` dentro de [low, high], que contenga `keep`, lo más centrado en `center`"""
+    start_min, start_max = low, high - size
+    if keep is not None:
+        start_min, start_max = max(start_min, keep[1] - size), min(start_max, keep[0])
+    start = min(max(center - size / 2, start_min), start_max)
+    return int(min(max(round(start), int(round(low))), int(high) - size))
+
+
+def solve_crop(constraints: CropConstraints, width: int, height: int,
+               aspect: float = 1.0) -> Tuple[int, int, int, int]:
+    """Mayor caja de proporción `aspect` (ancho/alto) dentro de la región que contiene las cajas a conservar
+
+    El tamaño solo depende de la región (la ventana más grande que cabe), así
+    que las cajas a conservar solo restringen la posición: en cada eje el
+    inicio válido es un intervalo y se elige el punto más cercano a centrar
+    las cajas (o la región, si no hay). Devuelve (left, top, right, bottom).
+    """
+    region = _intersect(_to_pixels(constraints.region, width, height), (0, 0, width, height))
+    if region is None:
+        region = (0, 0, width, height)
+    region_width, region_height = region[2] - region[0], region[3] - region[1]
+    crop_width = max(1, int(min(region_width, region_height * aspect)))
+    crop_height = max(1, min(int(region_height), int(round(crop_width / aspect))))
+
+    keep: Optional[Box] = None
+    focus: Optional[Box] = None
+    for box in constraints.must_keep:
+        box = _intersect(_to_pixels(box, width, height), region)
+        if box is None:
+            continue  # Fuera de la región (p. ej. en el otro lado del díptico)
+        for candidate in (_pad(box, constraints.margin), box):
+            candidate = _intersect(candidate, region)
+            merged = candidate if keep is None else _union(keep, candidate)
+            if _fits(merged, crop_width, crop_height):
+                keep = merged
+                break
+        else:
+            if keep is None and focus is None:
+                focus = box
+                logger.info("La caja a conservar no cabe en el recorte: se centra en ella")
+
+    target = keep or focus or region
+    center_x, center_y = (target[0] + target[2]) / 2, (target[1] + target[3]) / 2
+    left = _place(region[0], region[2], crop_width, center_x, (keep[0], keep[2]) if keep else None)
+    top = _place(region[1], region[3], crop_height, center_y, (keep[1], keep[3]) if keep else None)
+    return (left, top, left + crop_width, top + crop_height)
@@ -91,6 +91,15 @@ server {
         proxy_read_timeout 300s;
         proxy_connect_timeout 75s;
     }
+
+    # Salidas enviadas por nginx cuando la API responde con X-Accel-Redirect
+    # (OUTPUT_ACCEL_REDIRECT=/protected-outputs/)
+    location /protected-outputs/ {
+        internal;
+        alias /var/www/instagram-cropper/outputs/;
+        sendfile on;
+        tcp_nopush on;
+    }
 }
 EOF
 
@@ -128,7 +128,7 @@ class InstagramCropGUI:
             output_file = self.processor.process_image(
                 self.image_url.get(), 
                 self.output_path.get() if self.output_path.get() else None
-            )
+            ).output_path
             
             self.log_message(f"✅ ¡Procesamiento completado!")
             self.log_message(f"📁 Archivo guardado: {output_file}")
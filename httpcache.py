@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Caché HTTP en disco para las imágenes descargadas
+Respeta Cache-Control/Expires y revalida con ETag/Last-Modified, así que las
+descargas repetidas desde los mismos CDNs terminan en un acierto local o en un
+304 sin cuerpo. El tamaño total está acotado con expulsión LRU.
+"""
+
+import os
+import time
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import logging
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Any, Callable, Tuple, Mapping
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DOWNLOAD_CACHE_DIR = os.path.join(tempfile.gettempdir(), "instagram-cropper", "downloads")
+DEFAULT_DOWNLOAD_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# download(cabeceras condicionales) -> (status, cabeceras de la respuesta, cuerpo o None si 304)
+Downloader = Callable[[Dict[str, str]], Tuple[int, Mapping[str, str], Optional[bytes]]]
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """Directivas de Cache-Control en minúsculas: {"max-age": "60", "no-cache": None, ...}"""
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def freshness_deadline(headers: Mapping[str, str], now: float) -> Optional[float]:
+    """Instante hasta el que la respuesta es fresca, o None si no se puede guardar (no-store)
+
+    Sin max-age ni Expires (o con no-cache) la respuesta se guarda pero se
+    revalida en cada uso.
+    """
+    directives = parse_cache_control(headers.get("Cache-Control"))
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return now
+    max_age = directives.get("max-age")
+    if max_age is not None and max_age.isdigit():
+        age = headers.get("Age", "")
+        return now + int(max_age) - (int(age) if age.isdigit() else 0)
+    expires = headers.get("Expires")
+    if expires:
+        try:
+            return parsedate_to_datetime(expires).timestamp()
+        except (TypeError, ValueError):
+            return now
+    return now
+
+
+class DownloadCache:
+    """Caché de respuestas HTTP en disco con índice SQLite
+
+    Los cuerpos se guardan en `directory` (un archivo por URL, escrito de forma
+    atómica) y el índice en `directory/index.sqlite3`, compartido por los
+    workers de uvicorn. `max_bytes` limita el tamaño total: al superarlo se
+    expulsan las entradas usadas hace más tiempo.
+    """
+
+    def __init__(self, directory: str = DEFAULT_DOWNLOAD_CACHE_DIR,
+                 max_bytes: int = DEFAULT_DOWNLOAD_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.bytes_downloaded = 0
+        self.bytes_from_cache = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    fresh_until REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(os.path.join(self.directory, "index.sqlite3"), timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _body_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def fetch(self, url: str, download: Downloader) -> bytes:
+        """Obtener el cuerpo de `url` desde la caché, revalidando o descargando si hace falta"""
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        now = time.time()
+        entry = self._lookup(key)
+        body = self._read_body(key) if entry is not None else None
+        if body is not None and entry["fresh_until"] > now:
+            self._touch(key, now)
+            self._record(hits=1, from_cache=len(body))
+            logger.info(f"Descarga servida desde la caché: {url}")
+            return body
+
+        validators = {}
+        if body is not None:
+            if entry["etag"]:
+                validators["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                validators["If-Modified-Since"] = entry["last_modified"]
+
+        status, headers, downloaded = download(validators)
+        if status == 304:
+            if validators:
+                self._revalidate(key, headers, time.time())
+                self._record(revalidated=1, from_cache=len(body))
+                logger.info(f"Descarga revalidada (304): {url}")
+                return body
+            # Un 304 sin cabeceras condicionales no confirma la copia guardada:
+            # se descarta y se descarga de nuevo sin validadores
+            logger.warning(f"304 inesperado sin cabeceras condicionales, se descarga de nuevo: {url}")
+            self._drop(key)
+            status, headers, downloaded = download({})
+            if status == 304 or downloaded is None:
+                raise ValueError(f"El servidor respondió 304 sin cabeceras condicionales: {url}")
+
+        self._record(misses=1, downloaded=len(downloaded))
+        self._store(key, url, headers, downloaded, time.time())
+        return downloaded
+
+    def _lookup(self, key: str) -> Optional[sqlite3.Row]:
+        try:
+            with self._connect() as conn:
+                return conn.execute("SELECT * FROM responses WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Error leyendo la caché de descargas: {e}")
+            return None
+
+    def _read_body(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._body_path(key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _touch(self, key: str, now: float) -> None:
+        try:
+            with self._connect() as conn:
+                conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            logger.warning(f"Error actualizando la caché de descargas: {e}")
+
+    def _drop(self, key: str) -> None:
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logger.warning(f"Error actualizando la caché de descargas: {e}")
+        try:
+            os.remove(self._body_path(key))
+        except OSError:
+            pass
+
+    def _revalidate(self, key: str, headers: Mapping[str, str], now: float) -> None:
+        """Un 304 renueva la frescura (y los validadores, si el servidor envía nuevos)"""
+        fresh_until = freshness_deadline(headers, now)
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "UPDATE responses SET fresh_until = ?, accessed_at = ?, "
+                    "etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified) WHERE key = ?",
+                    (fresh_until if fresh_until is not None else now, now,
+                     headers.get("ETag"), headers.get("Last-Modified"), key)
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Error actualizando la caché de descargas: {e}")
+
+    def _store(self, key: str, url: str, headers: Mapping[str, str], body: bytes, now: float) -> None:
+        fresh_until = freshness_deadline(headers, now)
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        # Sin frescura ni validadores no hay forma de reutilizar la respuesta
+        if fresh_until is None or (fresh_until <= now and not etag and not last_modified):
+            return
+        if self.max_bytes and len(body) > self.max_bytes:
+            return
+
+        path = self._body_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(body)
+            os.replace(temp_path, path)
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses "
+                    "(key, url, etag, last_modified, fresh_until, size, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, url, etag, last_modified, fresh_until, len(body), now)
+                )
+                self._evict(conn)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Error escribiendo la caché de descargas: {e}")
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        """Expulsar las entradas menos usadas hasta quedar por debajo de `max_bytes`"""
+        if not self.max_bytes:
+            return
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for row in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+            conn.execute("DELETE FROM responses WHERE key = ?", (row["key"],))
+            try:
+                os.remove(self._body_path(row["key"]))
+            except OSError:
+                pass
+            total -= row["size"]
+            if total <= self.max_bytes:
+                break
+
+    def _record(self, hits: int = 0, revalidated: int = 0, misses: int = 0,
+                downloaded: int = 0, from_cache: int = 0) -> None:
+        result = "hit" if hits else "revalidated" if revalidated else "miss"
+        metrics.inc("cropper_cache_requests_total", cache="download", result=result)
+        with self._lock:
+            self.hits += hits
+            self.revalidated += revalidated
+            self.misses += misses
+            self.bytes_downloaded += downloaded
+            self.bytes_from_cache += from_cache
+
+    def stats(self) -> Dict[str, Any]:
+        """Métricas de descargas en este proceso y tamaño actual de la caché"""
+        try:
+            with self._connect() as conn:
+                entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        except sqlite3.Error:
+            entries, size = None, None
+        with self._lock:
+            total = self.hits + self.revalidated + self.misses
+            return {
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "hit_ratio": round((self.hits + self.revalidated) / total, 3) if total else 0.0,
+                "bytes_downloaded": self.bytes_downloaded,
+                "bytes_from_cache": self.bytes_from_cache,
+                "entries": entries,
+                "size_bytes": size,
+            }
+
+
+def get_download_cache() -> Optional[DownloadCache]:
+    """Crear la caché de descargas a partir de variables de entorno, o None si está deshabilitada"""
+    if os.getenv("DOWNLOAD_CACHE_ENABLED", "true").lower() in ("0", "false", "no"):
+        return None
+    try:
+        return DownloadCache(
+            directory=os.getenv("DOWNLOAD_CACHE_DIR", DEFAULT_DOWNLOAD_CACHE_DIR),
+            max_bytes=int(os.getenv("DOWNLOAD_CACHE_MAX_BYTES", DEFAULT_DOWNLOAD_CACHE_MAX_BYTES)),
+        )
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"No se pudo inicializar la caché de descargas: {e}")
+        return None
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Cola de trabajos para procesar imágenes en segundo plano
+POST /jobs encola y responde al instante; un pool de hilos local ejecuta los
+trabajos y el cliente consulta el estado o recibe un webhook al terminar
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import tempfile
+import threading
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Optional, Dict, Any, Callable, List
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOBS_PATH = os.path.join(tempfile.gettempdir(), "instagram-cropper", "jobs.sqlite3")
+DEFAULT_JOB_RETENTION = 24 * 3600  # Los trabajos terminados se conservan 1 día
+
+# Estados de un trabajo
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+
+class JobStore(ABC):
+    """Interfaz del almacén de trabajos (backend de la cola)"""
+
+    @abstractmethod
+    def create(self, payload: Dict[str, Any], callback_url: Optional[str] = None) -> str:
+        """Encolar un trabajo; devuelve su id"""
+
+    @abstractmethod
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """Tomar el siguiente trabajo pendiente y marcarlo como en ejecución"""
+
+    @abstractmethod
+    def finish(self, job_id: str, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None) -> None:
+        """Marcar un trabajo como terminado (con su resultado) o fallido (con el error)"""
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Estado de un trabajo, o None si no existe (o ya se eliminó)"""
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        """Profundidad de la cola y tiempos de espera"""
+
+
+def _public_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Vista del trabajo sin el payload (que incluye la API key)"""
+    return {key: value for key, value in job.items() if key != "payload"}
+
+
+class MemoryJobStore(JobStore):
+    """Cola en memoria del proceso. Solo sirve con un único worker de uvicorn."""
+
+    def __init__(self, retention: float = DEFAULT_JOB_RETENTION):
+        self.retention = retention
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._wait_times: deque = deque(maxlen=1000)
+
+    def create(self, payload, callback_url=None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            expired = [key for key, job in self._jobs.items()
+                       if job["finished_at"] and now - job["finished_at"] > self.retention]
+            for key in expired:
+                del self._jobs[key]
+            self._jobs[job_id] = {
+                "job_id": job_id, "status": QUEUED, "payload": payload, "callback_url": callback_url,
+                "result": None, "error": None, "created_at": now,
+                "started_at": None, "finished_at": None,
+            }
+            self._pending.append(job_id)
+        return job_id
+
+    def claim(self):
+        with self._lock:
+            if not self._pending:
+                return None
+            job = self._jobs[self._pending.popleft()]
+            job["status"] = RUNNING
+            job["started_at"] = time.time()
+            self._wait_times.append(job["started_at"] - job["created_at"])
+            return dict(job)
+
+    def finish(self, job_id, result=None, error=None):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(status=FAILED if error else COMPLETED, result=result, error=error,
+                       finished_at=time.time(), payload=None)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return _public_job(job) if job else None
+
+    def stats(self):
+        with self._lock:
+            counts = {QUEUED: 0, RUNNING: 0, COMPLETED: 0, FAILED: 0}
+            for job in self._jobs.values():
+                counts[job["status"]] += 1
+            waits = list(self._wait_times)
+        return _stats(counts, waits)
+
+
+class SQLiteJobStore(JobStore):
+    """Cola persistente en SQLite, compartida por todos los workers de uvicorn
+
+    Un trabajo que lleva más de `lease_timeout` segundos en ejecución (p. ej. el
+    worker murió) vuelve a poder reclamarse.
+    """
+
+    def __init__(self, path: str = DEFAULT_JOBS_PATH, lease_timeout: float = 600,
+                 retention: float = DEFAULT_JOB_RETENTION):
+        self.path = path
+        self.lease_timeout = lease_timeout
+        self.retention = retention
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    payload TEXT,
+                    callback_url TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def create(self, payload, callback_url=None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE finished_at < ?", (now - self.retention,))
+            conn.execute(
+                "INSERT INTO jobs (job_id, status, payload, callback_url, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, QUEUED, json.dumps(payload), callback_url, now)
+            )
+        return job_id
+
+    def claim(self):
+        now = time.time()
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE toma el lock de escritura: dos workers nunca reclaman el mismo trabajo
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? OR (status = ? AND started_at < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (QUEUED, RUNNING, now - self.lease_timeout)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute("UPDATE jobs SET status = ?, started_at = ? WHERE job_id = ?",
+                         (RUNNING, now, row["job_id"]))
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        job = self._row_to_job(row)
+        job.update(status=RUNNING, started_at=now)
+        return job
+
+    def finish(self, job_id, result=None, error=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, payload = NULL WHERE job_id = ?",
+                (FAILED if error else COMPLETED, json.dumps(result) if result is not None else None,
+                 error, time.time(), job_id)
+            )
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return _public_job(self._row_to_job(row)) if row else None
+
+    def stats(self):
+        with self._connect() as conn:
+            counts = {QUEUED: 0, RUNNING: 0, COMPLETED: 0, FAILED: 0}
+            for status, count in conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+                counts[status] = count
+            waits = [row[0] for row in conn.execute(
+                "SELECT started_at - created_at FROM jobs WHERE started_at IS NOT NULL "
+                "ORDER BY started_at DESC LIMIT 1000"
+            )]
+        return _stats(counts, waits)
+
+    @staticmethod
+    def _row_to_job(row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"]) if job["payload"] else None
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+
+def _stats(counts: Dict[str, int], waits: List[float]) -> Dict[str, Any]:
+    """Métricas de la cola: profundidad por estado y tiempo de espera en cola"""
+    return {
+        "queue_depth": counts[QUEUED],
+        "running": counts[RUNNING],
+        "completed": counts[COMPLETED],
+        "failed": counts[FAILED],
+        "avg_wait_seconds": round(sum(waits) / len(waits), 3) if waits else 0.0,
+        "max_wait_seconds": round(max(waits), 3) if waits else 0.0,
+    }
+
+
+class JobQueue:
+    """Pool de hilos que consume trabajos del almacén y ejecuta `handler(payload)`"""
+
+    def __init__(self, store: JobStore, handler: Callable[[Dict[str, Any]], Dict[str, Any]],
+                 workers: int = 2, poll_interval: float = 0.5):
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def submit(self, payload: Dict[str, Any], callback_url: Optional[str] = None) -> str:
+        """Encolar un trabajo y devolver su id"""
+        job_id = self.store.create(payload, callback_url)
+        self._wakeup.set()
+        logger.info(f"Trabajo encolado: {job_id}")
+        return job_id
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"trabajos-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+    def _worker(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                job = self.store.claim()
+            except Exception as e:
+                logger.error(f"Error leyendo la cola de trabajos: {e}")
+                job = None
+            if job is None:
+                # Otros workers de uvicorn pueden encolar sin avisarnos: sondear periódicamente
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._run(job)
+
+    def _run(self, job: Dict[str, Any]) -> None:
+        job_id = job["job_id"]
+        waited = job["started_at"] - job["created_at"]
+        metrics.observe("cropper_job_wait_seconds", max(0.0, waited))
+        logger.info(f"Ejecutando trabajo {job_id} (esperó {waited:.2f}s)")
+        start = time.perf_counter()
+        status = COMPLETED
+        try:
+            result = self.handler(job["payload"])
+            self.store.finish(job_id, result=result)
+        except Exception as e:
+            logger.error(f"Error en trabajo {job_id}: {e}")
+            self.store.finish(job_id, error=str(e))
+            status = FAILED
+        metrics.observe("cropper_job_run_seconds", time.perf_counter() - start, status=status)
+        if job.get("callback_url"):
+            notify_webhook(job["callback_url"], self.store.get(job_id))
+
+
+def notify_webhook(url: str, job: Dict[str, Any], attempts: int = 3) -> bool:
+    """Enviar el estado final del trabajo al webhook del cliente, con reintentos"""
+    import requests  # Solo los trabajos con webhook lo necesitan
+
+    for attempt in range(attempts):
+        try:
+            response = requests.post(url, json=job, timeout=10)
+            if response.status_code < 500:
+                return response.ok
+        except requests.RequestException as e:
+            logger.warning(f"Webhook {url} falló (intento {attempt + 1}): {e}")
+        if attempt < attempts - 1:
+            time.sleep(2 ** attempt)
+    return False
+
+
+def get_job_store() -> JobStore:
+    """Crear el backend de la cola según JOB_QUEUE_BACKEND (sqlite o memory)"""
+    backend = os.getenv("JOB_QUEUE_BACKEND", "sqlite").lower()
+    retention = float(os.getenv("JOB_RETENTION", DEFAULT_JOB_RETENTION))
+    if backend == "memory":
+        return MemoryJobStore(retention=retention)
+    return SQLiteJobStore(
+        path=os.getenv("JOB_QUEUE_PATH", DEFAULT_JOBS_PATH),
+        lease_timeout=float(os.getenv("JOB_LEASE_TIMEOUT", "600")),
+        retention=retention,
+    )
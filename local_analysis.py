@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Análisis local (sin Gemini) de imágenes
+Detecta la costura vertical de un díptico a partir del perfil de gradientes por
+columna, estima qué lado tiene personas con un detector de piel en YCbCr y
+busca el mejor recorte cuadrado sobre un mapa de saliencia
+"""
+
+import logging
+from typing import Optional, Dict, Any, Tuple
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Ancho de trabajo del detector: suficiente para ver la costura, muy barato de procesar
+DETECTOR_WIDTH = 256
+
+# La costura se busca en la franja central de la imagen
+SEAM_SEARCH_BAND = (0.3, 0.7)
+
+# Fracción de filas con salto fuerte en una columna para considerarla costura
+SEAM_CONFIDENT = 0.6
+NO_SEAM_CONFIDENT = 0.25
+
+# Fracción de píxeles con tono de piel para decidir si un lado tiene personas
+SKIN_PRESENT = 0.03
+SKIN_ABSENT = 0.005
+
+
+def _prepare(image: Image.Image) -> Image.Image:
+    """Reducir la imagen al ancho de trabajo del detector, en RGB"""
+    if image.mode not in ("RGB", "L", "RGBA", "LA"):
+        image = image.convert("RGB")
+    if image.size[0] > DETECTOR_WIDTH:
+        height = max(1, round(image.size[1] * DETECTOR_WIDTH / image.size[0]))
+        image = image.resize((DETECTOR_WIDTH, height), Image.Resampling.BILINEAR, reducing_gap=2.0)
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
+def find_seam(gray: np.ndarray) -> Dict[str, float]:
+    """Buscar la columna de la costura en una imagen en escala de grises (H x W, 0-255)
+
+    Una costura entre dos fotos es una columna donde casi todas las filas
+    tienen un salto de intensidad, mientras que un borde natural solo lo tiene
+    en parte de la altura. También se detectan separadores: una banda de
+    columnas casi uniformes en vertical (línea blanca o negra entre fotos).
+    """
+    height, width = gray.shape
+    start, stop = int(width * SEAM_SEARCH_BAND[0]), int(width * SEAM_SEARCH_BAND[1])
+
+    # Saltos horizontales entre columnas vecinas
+    jumps = np.abs(np.diff(gray, axis=1))
+    threshold = max(12.0, 3.0 * float(np.median(jumps)))
+    consistency = (jumps > threshold).mean(axis=0)
+
+    band = consistency[start:stop]
+    best = int(np.argmax(band))
+    seam_score = float(band[best])
+    seam_x = (start + best + 1) / width
+
+    # Separador uniforme: columnas con muy poca variación vertical, rodeadas de contenido
+    column_std = gray.std(axis=0)
+    flat = column_std[start:stop] < 4.0
+    if flat.any() and float(np.median(column_std)) > 20.0:
+        flat_columns = np.flatnonzero(flat) + start
+        separator_x = float(flat_columns.mean() + 0.5) / width
+        if flat_columns.max() - flat_columns.min() < 0.08 * width:
+            seam_score = max(seam_score, 1.0)
+            seam_x = separator_x
+
+    return {"score": seam_score, "position": seam_x}
+
+
+def skin_fraction(ycbcr: np.ndarray) -> float:
+    """Fracción de píxeles con tono de piel (reglas clásicas en el plano Cb/Cr)"""
+    if ycbcr.size == 0:
+        return 0.0
+    y, cb, cr = ycbcr[..., 0], ycbcr[..., 1], ycbcr[..., 2]
+    mask = (y > 40) & (cb >= 77) & (cb <= 127) & (cr >= 133) & (cr <= 173)
+    return float(mask.mean())
+
+
+def _people(fraction: float) -> Optional[bool]:
+    """True/False si la fracción de piel es concluyente, None si es dudosa"""
+    if fraction >= SKIN_PRESENT:
+        return True
+    if fraction <= SKIN_ABSENT:
+        return False
+    return None
+
+
+def detect_split(image: Image.Image) -> Dict[str, Any]:
+    """Detectar si la imagen es un díptico y dónde está la costura
+
+    Devuelve `dividida` (True/False, o None si no es concluyente), la posición
+    de la costura como fracción del ancho y la fracción de piel de cada lado.
+    """
+    small = _prepare(image)
+    ycbcr = np.asarray(small.convert("YCbCr"), dtype=np.float32)
+    gray = ycbcr[..., 0]
+
+    seam = find_seam(gray)
+    if seam["score"] >= SEAM_CONFIDENT:
+        split = True
+    elif seam["score"] <= NO_SEAM_CONFIDENT:
+        split = False
+    else:
+        split = None
+
+    seam_column = int(round(seam["position"] * gray.shape[1]))
+    return {
+        "dividida": split,
+        "posicion": round(seam["position"], 3),
+        "puntuacion_costura": round(seam["score"], 3),
+        "piel_izquierda": round(skin_fraction(ycbcr[:, :seam_column]), 4),
+        "piel_derecha": round(skin_fraction(ycbcr[:, seam_column:]), 4),
+    }
+
+
+def local_split_analysis(image: Image.Image) -> Optional[Dict[str, Any]]:
+    """Análisis con el mismo esquema que Gemini, o None si el detector no está seguro"""
+    detection = detect_split(image)
+    logger.info(f"Detector local de díptico: {detection}")
+
+    if detection["dividida"] is None:
+        return None
+
+    if not detection["dividida"]:
+        return {
+            "contenido_principal": "no analizado (detector local)",
+            "imagen_dividida": False,
+            "personas_izquierda": False,
+            "personas_derecha": False,
+            "lado_importante": "centro",
+            "razon_lado_elegido": "imagen no dividida (sin costura vertical)",
+            "detector_local": detection,
+        }
+
+    people_left = _people(detection["piel_izquierda"])
+    people_right = _people(detection["piel_derecha"])
+    if people_left is None or people_right is None or (not people_left and not people_right):
+        # Sin personas claras hay que elegir el lado más interesante: eso lo decide Gemini
+        return None
+
+    side = "derecha" if people_right and not people_left else "izquierda"
+    return {
+        "contenido_principal": "no analizado (detector local)",
+        "imagen_dividida": True,
+        "personas_izquierda": people_left,
+        "personas_derecha": people_right,
+        "lado_importante": side,
+        "razon_lado_elegido": "personas detectadas localmente por tono de piel",
+        "detector_local": detection,
+    }
+
+
+# Ancho del mapa de saliencia (residuo espectral + energía de bordes)
+SALIENCY_WIDTH = 128
+
+# Penalización por área en la búsqueda de ventana: sin ella, la ventana más
+# grande siempre captura más saliencia
+WINDOW_AREA_PENALTY = 0.3
+
+# Lado mínimo de la ventana, como fracción del lado menor de la imagen
+MIN_WINDOW_FRACTION = 0.6
+
+
+def _box_blur(values: np.ndarray, radius: int) -> np.ndarray:
+    """Desenfoque de caja separable con sumas acumuladas (tamaño 2*radius+1)"""
+    if radius < 1:
+        return values
+    size = 2 * radius + 1
+    padded = np.pad(values, radius, mode="edge")
+    cumulative = np.cumsum(padded, axis=0)
+    cumulative = np.vstack([np.zeros((1, cumulative.shape[1])), cumulative])
+    values = (cumulative[size:] - cumulative[:-size]) / size
+    cumulative = np.cumsum(values, axis=1)
+    cumulative = np.hstack([np.zeros((cumulative.shape[0], 1)), cumulative])
+    return (cumulative[:, size:] - cumulative[:, :-size]) / size
+
+
+def _normalize(values: np.ndarray) -> np.ndarray:
+    low, high = float(values.min()), float(values.max())
+    return (values - low) / (high - low) if high > low else np.zeros_like(values)
+
+
+def saliency_map(image: Image.Image) -> np.ndarray:
+    """Mapa de saliencia normalizado (0-1) de ancho SALIENCY_WIDTH
+
+    Combina el residuo espectral (Hou & Zhang, 2007), que resalta lo que se
+    sale del patrón de la imagen, con la energía de bordes, que favorece zonas
+    con detalle (caras, texto) frente a fondos lisos, y un leve prior central.
+    """
+    small = _prepare(image)
+    height = max(1, round(small.size[1] * SALIENCY_WIDTH / small.size[0]))
+    gray = np.asarray(small.convert("L").resize((SALIENCY_WIDTH, height), Image.Resampling.BILINEAR),
+                      dtype=np.float64)
+
+    spectrum = np.fft.fft2(gray)
+    log_amplitude = np.log1p(np.abs(spectrum))
+    residual = log_amplitude - _box_blur(log_amplitude, 1)
+    spectral = np.abs(np.fft.ifft2(np.exp(residual + 1j * np.angle(spectrum)))) ** 2
+    spectral = _normalize(_box_blur(spectral, 3))
+
+    gy, gx = np.gradient(gray)
+    edges = _normalize(_box_blur(np.hypot(gx, gy), 2))
+
+    # Prior central débil: desempata imágenes planas y favorece el sujeto centrado
+    rows = np.linspace(-1, 1, gray.shape[0])[:, None]
+    cols = np.linspace(-1, 1, gray.shape[1])[None, :]
+    center = np.exp(-(rows ** 2 + cols ** 2) / 0.5)
+
+    return _normalize(0.45 * spectral + 0.45 * edges + 0.1 * center)
+
+
+def summed_area_table(values: np.ndarray) -> np.ndarray:
+    """Tabla de sumas acumuladas con una fila y columna de ceros al inicio"""
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1))
+    table[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+    return table
+
+
+def best_window(saliency: np.ndarray, min_side: int, max_side: int,
+                aspect: float = 1.0) -> Tuple[int, int, int, int]:
+    """Mejor ventana de proporción `aspect` (ancho/alto) sobre el mapa de saliencia
+
+    Con la tabla de sumas acumuladas, la suma de cada ventana cuesta O(1): para
+    cada tamaño candidato se evalúan todas las posiciones de una vez con
+    NumPy. La puntuación es la fracción de saliencia capturada menos una
+    penalización proporcional al área. Devuelve (left, top, right, bottom) en
+    píxeles del mapa.
+    """
+    height, width = saliency.shape
+    table = summed_area_table(saliency)
+    total = table[-1, -1] or 1.0
+
+    best_score, best_box = -np.inf, (0, 0, width, height)
+    for side in sorted({int(v) for v in np.linspace(min_side, max_side, 8)}, reverse=True):
+        window_h = min(height, side)
+        window_w = min(width, max(1, int(round(window_h * aspect))))
+        if window_w == width and aspect * window_h > width:
+            window_h = max(1, int(round(window_w / aspect)))
+        sums = (table[window_h:, window_w:] - table[:-window_h, window_w:]
+                - table[window_h:, :-window_w] + table[:-window_h, :-window_w])
+        top, left = np.unravel_index(int(np.argmax(sums)), sums.shape)
+        score = sums[top, left] / total - WINDOW_AREA_PENALTY * (window_w * window_h) / (width * height)
+        if score > best_score:
+            best_score, best_box = score, (int(left), int(top), int(left) + window_w, int(top) + window_h)
+    return best_box
+
+
+def local_crop_analysis(image: Image.Image, min_output_side: int = 1080,
+                        original_size: Optional[Tuple[int, int]] = None) -> Dict[str, Any]:
+    """Análisis completamente local: díptico + recorte por saliencia
+
+    `image` puede ser una copia reducida; `original_size` es el tamaño de la
+    imagen que se va a recortar, para no elegir ventanas más pequeñas que
+    `min_output_side` (habría que ampliarlas al redimensionar).
+
+    Si la imagen es un díptico claro, la búsqueda se limita al lado elegido
+    (personas primero; si no hay, el lado con más saliencia). El resultado
+    incluye `caja_corte`: la caja del recorte normalizada (0-1) a la imagen.
+    """
+    detection = detect_split(image)
+    saliency = saliency_map(image)
+    height, width = saliency.shape
+
+    region = (0, width)
+    side = "centro"
+    if detection["dividida"]:
+        seam = int(round(detection["posicion"] * width))
+        people_left = _people(detection["piel_izquierda"])
+        people_right = _people(detection["piel_derecha"])
+        if people_right and not people_left:
+            side = "derecha"
+        elif people_left:
+            side = "izquierda"
+        else:
+            side = "izquierda" if saliency[:, :seam].mean() >= saliency[:, seam:].mean() else "derecha"
+        region = (0, seam) if side == "izquierda" else (seam, width)
+
+    sub = saliency[:, region[0]:region[1]]
+    max_side = min(sub.shape)
+    # No reducir la ventana por debajo del tamaño de salida (evita ampliar al redimensionar)
+    scale = (original_size or image.size)[0] / width
+    min_fraction = max(MIN_WINDOW_FRACTION, min(1.0, min_output_side / (max_side * scale)))
+    left, top, right, bottom = best_window(sub, max(1, int(max_side * min_fraction)), max_side)
+    left, right = left + region[0], right + region[0]
+
+    return {
+        "contenido_principal": "no analizado (motor local)",
+        "imagen_dividida": bool(detection["dividida"]),
+        "personas_izquierda": bool(_people(detection["piel_izquierda"])),
+        "personas_derecha": bool(_people(detection["piel_derecha"])),
+        "lado_importante": side,
+        "razon_lado_elegido": "recorte por saliencia local",
+        "caja_corte": [round(left / width, 4), round(top / height, 4),
+                       round(right / width, 4), round(bottom / height, 4)],
+        "detector_local": detection,
+    }
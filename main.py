@@ -7,194 +7,648 @@ Analiza imágenes y las corta manteniendo el contenido esencial
 import os
 import sys
 import argparse
-import requests
+import signal
 from PIL import Image, ImageOps
-import google.generativeai as genai
 from io import BytesIO
-import json
-from typing import Tuple, Dict, Any
+import time
+import sqlite3
+import hashlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from dataclasses import dataclass, asdict, field, replace
+from typing import Tuple, Dict, Any, Optional, List, Iterator, Union, Callable
 import logging
+from cache import AnalysisCache, get_analysis_cache
+from ratelimit import (RateLimiter, SharedRateLimiter, CircuitBreaker, DEFAULT_RATE_LIMIT_PATH,
+                       retry_with_backoff, bucket_key)
+from singleflight import SingleFlight
+from httpcache import DownloadCache, get_download_cache
+from outputs import OutputStore
+from encoding import EncodeOptions, FORMATS, SUBSAMPLING_MODES, encode_image, get_default_encoding
+from metrics import metrics, request_timings
+from crop_solver import CropConstraints, FULL_IMAGE, normalize_box, solve_crop
+from watcher import HotFolder, Manifest, MANIFEST_NAME, write_atomic
+from admission import (ImageTooLargeError, MemoryBudget, DEFAULT_MAX_DECODED_BYTES, estimate_decoded_bytes,
+                       get_memory_budget)
+from analyzers import (Analyzer, DEFAULT_ANALYZER, BACKENDS, create_analyzer, parse_analyzer_spec,
+                       requires_api_key, analysis_identity)
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Sesión HTTP compartida: reutiliza conexiones keep-alive entre descargas e hilos.
+# Se crea en la primera descarga, así que ni `--help` ni el trabajo con archivos
+# locales importan `requests`
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Sesión HTTP compartida (requests.Session), creada en el primer uso"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            session = requests.Session()
+            session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32))
+            session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32))
+            _http_session = session
+        return _http_session
+
+@dataclass
+class ProcessingResult:
+    """Resultado de procesar una imagen"""
+    output_path: str
+    analysis: Dict[str, Any]
+    crop_coordinates: Dict[str, int]
+    cache_hit: bool = False
+    served_by: str = "gemini"
+    renditions: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    timings: Dict[str, float] = field(default_factory=dict)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.tif', '.tiff')
+
+def list_batch_sources(spec: str) -> List[str]:
+    """Fuentes de un lote: un directorio de imágenes o un archivo con una URL/ruta por línea"""
+    if os.path.isdir(spec):
+        return sorted(
+            os.path.join(spec, name) for name in os.listdir(spec)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+    with open(spec, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+# Detector local de dípticos: off (siempre Gemini), auto (evita Gemini si está seguro)
+# o compare (ejecuta ambos y registra desacuerdos)
+LOCAL_DETECTOR_MODES = ("off", "auto", "compare")
+DEFAULT_LOCAL_DETECTOR = os.getenv("LOCAL_SPLIT_DETECTOR", "off")
+
+# Motor de recorte: gemini (por defecto), local (saliencia, sin Gemini) o
+# hybrid (Gemini, con el motor local si Gemini falla)
+ENGINES = ("gemini", "local", "hybrid")
+DEFAULT_ENGINE = os.getenv("CROP_ENGINE", "gemini")
+
+# Formatos de salida (ancho, alto). Todos salen de una sola decodificación y un solo análisis
+RENDITIONS = {
+    "square": (1080, 1080),       # Publicación de Instagram 1:1
+    "portrait": (1080, 1350),     # Publicación vertical 4:5
+    "story": (1080, 1920),        # Historia / reel 9:16
+    "thumbnail": (320, 320),
+    "thumbnail_small": (150, 150),
+}
+DEFAULT_RENDITIONS = ("square",)
+
+# Tamaño de salida para Instagram
+OUTPUT_SIZE = RENDITIONS["square"]
+
+def parse_renditions(names) -> Tuple[str, ...]:
+    """Validar una lista de formatos (o una cadena separada por comas), sin duplicados"""
+    if not names:
+        return DEFAULT_RENDITIONS
+    if isinstance(names, str):
+        names = names.split(",")
+    parsed = []
+    for name in (name.strip() for name in names if name.strip()):
+        if name not in RENDITIONS:
+            raise ValueError(f"Formato desconocido: {name} (disponibles: {', '.join(RENDITIONS)})")
+        if name not in parsed:
+            parsed.append(name)
+    return tuple(parsed) or DEFAULT_RENDITIONS
+
+def fit_crop_to_aspect(crop_area: Tuple[int, int, int, int], image_size: Tuple[int, int],
+                       aspect: float) -> Tuple[int, int, int, int]:
+    """Adaptar el corte cuadrado elegido a otra proporción (ancho/alto)
+
+    Se conserva el lado corto del cuadrado y se extiende el otro eje alrededor
+    del mismo centro; si no cabe en la imagen, se reduce hasta el borde. La caja
+    se desplaza lo mínimo para quedar dentro de la imagen.
+    """
+    left, top, right, bottom = crop_area
+    width, height = image_size
+    side = min(right - left, bottom - top)
+    if aspect >= 1:
+        crop_width, crop_height = side * aspect, side
+    else:
+        crop_width, crop_height = side, side / aspect
+    scale = min(1.0, width / crop_width, height / crop_height)
+    crop_width, crop_height = round(crop_width * scale), round(crop_height * scale)
+
+    center_x, center_y = (left + right) / 2, (top + bottom) / 2
+    new_left = min(max(0, round(center_x - crop_width / 2)), width - crop_width)
+    new_top = min(max(0, round(center_y - crop_height / 2)), height - crop_height)
+    return (new_left, new_top, new_left + crop_width, new_top + crop_height)
+
+def rendition_boxes(crop_area: Tuple[int, int, int, int], image_size: Tuple[int, int],
+                    names, analysis: Optional[Dict[str, Any]] = None) -> Dict[str, Tuple[int, int, int, int]]:
+    """Caja de corte de cada formato a partir del corte cuadrado elegido
+
+    Con `analysis` (y sin caja_corte explícita), los formatos no cuadrados se
+    resuelven con las mismas restricciones que el cuadrado: la mayor caja de
+    su proporción dentro del lado elegido y conservando el sujeto, en lugar
+    de estirar el cuadrado.
+    """
+    constraints = None
+    if analysis is not None and not analysis.get("caja_corte"):
+        constraints = crop_constraints(analysis)
+    boxes = {}
+    for name in names:
+        aspect = RENDITIONS[name][0] / RENDITIONS[name][1]
+        if constraints is None or aspect == 1:
+            boxes[name] = fit_crop_to_aspect(crop_area, image_size, aspect)
+        else:
+            boxes[name] = solve_crop(constraints, image_size[0], image_size[1], aspect)
+    return boxes
+
+def needs_more_pixels(crop_area: Tuple[int, int, int, int], image_size: Tuple[int, int], names,
+                      analysis: Optional[Dict[str, Any]] = None) -> bool:
+    """Si la caja de algún formato mide menos que su salida (habría que ampliarla)"""
+    boxes = rendition_boxes(crop_area, image_size, names, analysis)
+    return any(box[2] - box[0] < RENDITIONS[name][0] or box[3] - box[1] < RENDITIONS[name][1]
+               for name, box in boxes.items())
+
+def render_renditions(image: Image.Image, crop_area: Tuple[int, int, int, int], names,
+                      analysis: Optional[Dict[str, Any]] = None) -> Dict[str, Tuple[Image.Image, Tuple[int, int, int, int]]]:
+    """Generar los formatos pedidos desde una sola imagen decodificada
+
+    Los formatos con la misma proporción comparten caja de corte, y cada uno se
+    redimensiona desde el menor formato ya generado que siga siendo más grande
+    (p. ej. la miniatura sale del cuadrado de 1080, no de la imagen completa).
+    Devuelve {nombre: (imagen, caja de corte)}.
+    """
+    boxes = rendition_boxes(crop_area, image.size, names, analysis)
+    rendered: Dict[str, Tuple[Image.Image, Tuple[int, int, int, int]]] = {}
+    for name in sorted(names, key=lambda n: RENDITIONS[n][0] * RENDITIONS[n][1], reverse=True):
+        size = RENDITIONS[name]
+        box = boxes[name]
+        intermediates = [
+            output for output, output_box in rendered.values()
+            if output_box == box and output.size[0] >= size[0] and output.size[1] >= size[1]
+        ]
+        if intermediates:
+            source = min(intermediates, key=lambda output: output.size[0] * output.size[1])
+            output = source.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        else:
+            output = image.resize(size, Image.Resampling.LANCZOS, box=box, reducing_gap=3.0)
+        rendered[name] = (output, box)
+    return {name: rendered[name] for name in names}
+
+def rendition_path(output_path: str, name: str, primary: bool, extension: str = "jpg") -> str:
+    """Ruta de salida de un formato: el primero usa `output_path`, el resto añade un sufijo"""
+    if primary:
+        return output_path
+    root, ext = os.path.splitext(output_path)
+    return f"{root}_{name}{ext or '.' + extension}"
+
+# Tamaño máximo de una imagen descargada o subida (bytes)
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))
+
+# Máximo de una imagen decodificada (bytes de píxeles); los JPEG mayores se reducen al decodificar
+MAX_DECODED_BYTES = int(os.getenv("MAX_DECODED_BYTES", str(DEFAULT_MAX_DECODED_BYTES)))
+
+# Etiqueta EXIF de orientación
+EXIF_ORIENTATION = 0x0112
+
+def download_image_bytes(url: str, max_bytes: int = MAX_IMAGE_BYTES,
+                         cache: Optional[DownloadCache] = None) -> bytes:
+    """Descargar una imagen, pasando por la caché HTTP en disco si se indica"""
+    if cache is None:
+        return fetch_image(url, max_bytes)[2]
+    return cache.fetch(url, lambda validators: fetch_image(url, max_bytes, validators))
+
+def fetch_image(url: str, max_bytes: int = MAX_IMAGE_BYTES,
+                headers: Optional[Dict[str, str]] = None) -> Tuple[int, Dict[str, str], Optional[bytes]]:
+    """Petición GET por partes, cortando en cuanto supera `max_bytes`
+
+    Con cabeceras condicionales (If-None-Match / If-Modified-Since) el servidor
+    puede responder 304: entonces el cuerpo es None. Devuelve (status,
+    cabeceras, cuerpo).
+    """
+    with get_http_session().get(url, timeout=30, stream=True, headers=headers) as response:
+        if response.status_code == 304 and headers:
+            return 304, response.headers, None
+        response.raise_for_status()
+        declared = response.headers.get("Content-Length")
+        if max_bytes and declared and declared.isdigit() and int(declared) > max_bytes:
+            raise ImageTooLargeError(f"La imagen pesa {int(declared)} bytes (máximo {max_bytes})")
+
+        buffer = BytesIO()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            buffer.write(chunk)
+            if max_bytes and buffer.tell() > max_bytes:
+                raise ImageTooLargeError(f"La imagen supera el máximo de {max_bytes} bytes")
+        return response.status_code, response.headers, buffer.getvalue()
+
+def decode_image(fp, min_crop_side: int = OUTPUT_SIZE[0], max_decoded_bytes: int = 0,
+                 reserve: Optional[Callable[[int], None]] = None) -> Image.Image:
+    """Decodificar una imagen a la menor escala JPEG que aún cubre el corte final
+
+    Con `Image.draft` el decodificador JPEG escala por 1/2, 1/4 o 1/8 durante
+    la IDCT, sin materializar los píxeles a tamaño completo. Se pide que el
+    corte más pequeño posible (la mitad de un díptico: min(ancho/2, alto))
+    siga midiendo al menos `min_crop_side` (si el corte resuelto es menor,
+    `ImageProcessor.prepare` vuelve a decodificar). Después se aplica la orientación
+    EXIF. El tamaño original (ya orientado) queda en `image.info["original_size"]`.
+
+    Con `max_decoded_bytes`, un JPEG que no cabría se reduce más (aunque el
+    corte quede por debajo de `min_crop_side`) y el resto de formatos se
+    rechazan con ImageTooLargeError antes de decodificar. `reserve` recibe
+    los bytes estimados justo antes de decodificar (control de admisión).
+    """
+    try:
+        image = Image.open(fp)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e))
+    width, height = image.size
+    rotated = image.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8)
+    requested = None
+    if min_crop_side:
+        requested = (min_crop_side, 2 * min_crop_side) if rotated else (2 * min_crop_side, min_crop_side)
+    if max_decoded_bytes and image.format in ("JPEG", "MPO"):
+        for scale in (1, 2, 4, 8):
+            if estimate_decoded_bytes((width // scale, height // scale), image.mode) <= max_decoded_bytes:
+                break
+        if scale > 1:
+            fitting = (width // scale, height // scale)
+            requested = fitting if requested is None else (min(requested[0], fitting[0]), min(requested[1], fitting[1]))
+    if requested:
+        image.draft(None, requested)
+    if image.size != (width, height):
+        logger.info(f"Decodificación reducida: {width}x{height} -> {image.size[0]}x{image.size[1]}")
+
+    estimated = estimate_decoded_bytes(image.size, image.mode)
+    if max_decoded_bytes and estimated > max_decoded_bytes:
+        raise ImageTooLargeError(f"La imagen de {width}x{height} ocuparía {estimated // 2 ** 20} MB decodificada "
+                                 f"(máximo {max_decoded_bytes // 2 ** 20} MB)")
+    if reserve is not None:
+        reserve(estimated)
+
+    ImageOps.exif_transpose(image, in_place=True)
+    image.info["original_size"] = (height, width) if rotated else (width, height)
+    return image
+
+# Lado mayor (px) de la copia reducida que se envía a Gemini; 0 envía la imagen completa
+DEFAULT_ANALYSIS_MAX_SIDE = int(os.getenv("ANALYSIS_MAX_SIDE", "768"))
+
+def make_analysis_proxy(image: Image.Image, max_side: int) -> Image.Image:
+    """Copia reducida de la imagen para el análisis
+
+    Primero se reduce por un factor entero con `Image.reduce` (promedio por
+    bloques, muy barato) y luego se ajusta al tamaño exacto con un filtro
+    bilineal sobre la imagen ya pequeña. Gemini solo necesita distinguir
+    personas y la división del díptico, no el detalle fino.
+    """
+    if image.mode not in ("RGB", "L", "RGBA", "LA"):
+        image = image.convert("RGB")
+    width, height = image.size
+    if max_side and max(width, height) > max_side:
+        image = _reduce_to(image, max_side)
+    # JPEG no admite alfa: convertir después de reducir, sobre menos píxeles
+    return image if image.mode in ("RGB", "L") else image.convert("RGB")
+
+def _reduce_to(image: Image.Image, max_side: int) -> Image.Image:
+    """Reducir la imagen hasta que su lado mayor sea `max_side`"""
+    factor = max(image.size) // max_side
+    if factor >= 2:
+        image = image.reduce(factor)
+    scale = max_side / max(image.size)
+    if scale < 1:
+        image = image.resize(
+            (max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale))),
+            Image.Resampling.BILINEAR
+        )
+    return image
+
+def normalized_box_to_square(box, width: int, height: int) -> Tuple[int, int, int, int]:
+    """Convertir una caja normalizada (0-1) en un cuadrado en píxeles centrado en ella"""
+    left, top, right, bottom = (box[0] * width, box[1] * height, box[2] * width, box[3] * height)
+    side = int(min(right - left, bottom - top, width, height))
+    side = max(1, side)
+    center_x, center_y = (left + right) / 2, (top + bottom) / 2
+    crop_left = int(min(max(0, round(center_x - side / 2)), width - side))
+    crop_top = int(min(max(0, round(center_y - side / 2)), height - side))
+    return (crop_left, crop_top, crop_left + side, crop_top + side)
+
+def important_side(analysis: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+    """Lado del díptico que se conserva tras las reglas de prioridad; devuelve (lado, regla aplicada)"""
+    lado_importante = analysis.get("lado_importante", "centro")
+    personas_izq = analysis.get("personas_izquierda", False)
+    personas_der = analysis.get("personas_derecha", False)
+    if personas_izq and not personas_der:
+        return "izquierda", "Solo lado izquierdo tiene personas - eligiendo izquierda"
+    if personas_der and not personas_izq:
+        return "derecha", "Solo lado derecho tiene personas - eligiendo derecha"
+    if personas_izq and personas_der:
+        return "izquierda", "Ambos lados tienen personas - eligiendo izquierda por defecto"
+    return lado_importante, None
+
+def seam_position(analysis: Dict[str, Any]) -> float:
+    """Posición (0-1) de la división del díptico: la del modelo, la del detector local o el centro"""
+    for position in (analysis.get("posicion_division"), (analysis.get("detector_local") or {}).get("posicion")):
+        if isinstance(position, (int, float)) and 0 < position < 1:
+            return float(position)
+    return 0.5
+
+def crop_constraints(analysis: Dict[str, Any]) -> CropConstraints:
+    """Restricciones del recorte a partir del análisis
+
+    En un díptico la región es el lado elegido, cortado por la división real
+    (no siempre está en la mitad). Las cajas a conservar son caja_sujeto y
+    zonas_conservar; las que caen fuera de la región se ignoran.
+    """
+    region = FULL_IMAGE
+    if analysis.get("imagen_dividida", False):
+        side, _ = important_side(analysis)
+        seam = seam_position(analysis)
+        if side == "izquierda":
+            region = (0.0, 0.0, seam, 1.0)
+        elif side == "derecha":
+            region = (seam, 0.0, 1.0, 1.0)
+    boxes = [analysis.get("caja_sujeto")] + list(analysis.get("zonas_conservar") or [])
+    must_keep = tuple(tuple(box) for box in map(normalize_box, boxes) if box is not None)
+    return CropConstraints(region=region, must_keep=must_keep)
+
+def log_detector_disagreement(local: Optional[Dict[str, Any]], analysis: Dict[str, Any]) -> None:
+    """Registrar si el detector local habría decidido distinto que Gemini"""
+    if local is None:
+        logger.info("Detector local: no concluyente (se usó Gemini)")
+        return
+    keys = ("imagen_dividida",)
+    if local.get("imagen_dividida") and analysis.get("imagen_dividida"):
+        keys += ("personas_izquierda", "personas_derecha")
+    differences = {key: (local.get(key), analysis.get(key)) for key in keys
+                   if bool(local.get(key)) != bool(analysis.get(key))}
+    if differences:
+        logger.warning(f"Detector local en desacuerdo con Gemini (local, gemini): {differences} "
+                       f"detección={local.get('detector_local')}")
+    else:
+        logger.info("Detector local de acuerdo con Gemini")
+
+# Llamadas a Gemini: intentos y espera base del backoff (s); el timeout está en analyzers
+GEMINI_RETRIES = int(os.getenv("GEMINI_RETRIES", "3"))
+GEMINI_RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "1.0"))
+
+@functools.lru_cache(maxsize=None)
+def retryable_gemini_errors() -> Tuple[type, ...]:
+    """Errores transitorios de Gemini (cuota, sobrecarga, timeout) que merece la pena reintentar
+
+    google.api_core se importa en el primer análisis, no al cargar el módulo.
+    """
+    from google.api_core import exceptions as google_exceptions
+    return (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.TooManyRequests,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.GatewayTimeout,
+        TimeoutError,
+        ConnectionError,
+    )
+
+# Origen del análisis de una imagen (ProcessingResult.served_by)
+SERVED_BY_GEMINI = "gemini"                 # Con otros backends de análisis, su nombre (fake, replay)
+SERVED_BY_CACHE = "cache"
+SERVED_BY_LOCAL = "local"                   # Motor local pedido explícitamente
+SERVED_BY_LOCAL_DETECTOR = "local_detector"  # Detector de dípticos en modo auto
+SERVED_BY_LOCAL_FALLBACK = "local_fallback"  # Gemini falló o su circuit breaker está abierto
+SERVED_BY_DEFAULT = "default"               # Gemini falló: corte centrado
+SERVED_BY_COALESCED = "coalesced"           # Compartido con una petición idéntica en curso
+
+def get_gemini_rate_limiter() -> Optional[RateLimiter]:
+    """Limitador de Gemini configurado por entorno (GEMINI_REQUESTS_PER_MINUTE=0 lo desactiva)
+
+    Con GEMINI_RATE_LIMIT_BACKEND=sqlite (por defecto) la cuota de cada API key
+    se comparte entre todos los procesos; con `memory` cada proceso lleva la suya.
+    """
+    rate = float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "60"))
+    if rate <= 0:
+        return None
+    burst = int(os.getenv("GEMINI_BURST", "10"))
+    if os.getenv("GEMINI_RATE_LIMIT_BACKEND", "sqlite").lower() == "memory":
+        return RateLimiter(rate, burst=burst)
+    try:
+        return SharedRateLimiter(rate, burst=burst, path=os.getenv("GEMINI_RATE_LIMIT_PATH", DEFAULT_RATE_LIMIT_PATH))
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"No se pudo crear el limitador compartido, se usa uno por proceso: {e}")
+        return RateLimiter(rate, burst=burst)
+
+def get_gemini_circuit_breaker() -> Optional[CircuitBreaker]:
+    """Circuit breaker de Gemini configurado por entorno (GEMINI_BREAKER_THRESHOLD=0 lo desactiva)"""
+    threshold = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+    if threshold <= 0:
+        return None
+    return CircuitBreaker(threshold, reset_timeout=float(os.getenv("GEMINI_BREAKER_RESET", "60")))
+
 class ImageProcessor:
-    def __init__(self, api_key: str):
-        """Inicializar el procesador de imágenes con la API key de Gemini"""
+    def __init__(self, api_key: str, cache: Optional[AnalysisCache] = None,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 circuit_breaker: Optional[CircuitBreaker] = None,
+                 single_flight: Optional[SingleFlight] = None,
+                 download_cache: Optional[DownloadCache] = None,
+                 output_store: Optional[OutputStore] = None,
+                 encoding: Optional[EncodeOptions] = None,
+                 analysis_max_side: int = DEFAULT_ANALYSIS_MAX_SIDE,
+                 local_detector: str = DEFAULT_LOCAL_DETECTOR,
+                 engine: str = DEFAULT_ENGINE,
+                 analyzer: Union[str, Analyzer, None] = None,
+                 memory_budget: Optional[MemoryBudget] = None,
+                 max_decoded_bytes: int = MAX_DECODED_BYTES):
+        """Inicializar el procesador de imágenes con la API key de Gemini
+
+        `analyzer` es el backend de análisis ya creado o su especificación
+        (`gemini:gemini-2.5-flash-lite`, `fake`...); por defecto, ANALYZER.
+        `memory_budget` (compartido por los procesadores del proceso) acota la
+        memoria de las imágenes que se procesan a la vez.
+        """
+        if local_detector not in LOCAL_DETECTOR_MODES:
+            raise ValueError(f"Modo de detector local desconocido: {local_detector}")
+        if engine not in ENGINES:
+            raise ValueError(f"Motor de recorte desconocido: {engine}")
+        self.engine = engine
         self.api_key = api_key
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.single_flight = single_flight
+        self.download_cache = download_cache
+        self.output_store = output_store
+        self.encoding = encoding or EncodeOptions()
+        self.limiter_key = bucket_key(api_key)
+        self.analysis_max_side = analysis_max_side
+        self.local_detector = local_detector
+        self.memory_budget = memory_budget
+        self.max_decoded_bytes = max_decoded_bytes
+        if memory_budget is not None:
+            self.max_decoded_bytes = min(max_decoded_bytes or memory_budget.capacity, memory_budget.capacity)
+        # El backend se crea en el primer análisis: el motor local no lo necesita
+        # (ni importa el SDK de Gemini)
+        if isinstance(analyzer, Analyzer):
+            self._analyzer: Optional[Analyzer] = analyzer
+            self.analyzer_spec = analyzer.spec
+        else:
+            self._analyzer = None
+            self.analyzer_spec = (analyzer or DEFAULT_ANALYZER).strip()
+        self._analyzer_lock = threading.Lock()
+    
+    @property
+    def analyzer(self) -> Analyzer:
+        """Backend de análisis, creado en el primer uso"""
+        with self._analyzer_lock:
+            if self._analyzer is None:
+                self._analyzer = create_analyzer(self.analyzer_spec, self.api_key, self.rate_limiter)
+            return self._analyzer
         
-    def load_image(self, source: str) -> Image.Image:
-        """Cargar imagen desde URL o archivo local"""
+    def read_source(self, source: Union[str, bytes]) -> Tuple[Callable[[], Any], str]:
+        """Obtener los bytes de una URL, archivo local o buffer; devuelve (abrir, hash del contenido)
+
+        `abrir()` devuelve un objeto para decodificar la imagen y puede llamarse
+        más de una vez (p. ej. para volver a decodificar a más resolución) sin
+        repetir la descarga.
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            # Decodificar directamente desde el buffer, sin pasar por disco
+            metrics.inc("cropper_bytes_in_total", len(source), source="upload")
+            return lambda: BytesIO(source), hashlib.sha256(source).hexdigest()
+        if source.startswith(('http://', 'https://')):
+            # Descargar desde URL
+            logger.info(f"Descargando imagen desde: {source}")
+            with metrics.stage("download"):
+                data = download_image_bytes(source, cache=self.download_cache)
+            metrics.inc("cropper_bytes_in_total", len(data), source="url")
+            return lambda: BytesIO(data), hashlib.sha256(data).hexdigest()
+        # Cargar archivo local
+        logger.info(f"Cargando imagen local: {source}")
+        digest = hashlib.sha256()
+        size = 0
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+                size += len(chunk)
+        metrics.inc("cropper_bytes_in_total", size, source="file")
+        return lambda: source, digest.hexdigest()
+
+    def load_image(self, source: Union[str, bytes], min_crop_side: int = OUTPUT_SIZE[0],
+                   held: Optional[ExitStack] = None) -> Image.Image:
+        """Cargar imagen desde URL, archivo local o bytes ya en memoria
+
+        Con presupuesto de memoria y `held`, la memoria estimada de la imagen
+        queda reservada hasta que se cierre `held`.
+        """
+        return self._load(source, min_crop_side, held)[0]
+
+    def _load(self, source: Union[str, bytes], min_crop_side: int,
+              held: Optional[ExitStack] = None) -> Tuple[Image.Image, Callable[[], Any]]:
+        """Leer y decodificar la imagen; devuelve (imagen, abrir) para poder volver a decodificarla"""
         try:
-            if source.startswith(('http://', 'https://')):
-                # Descargar desde URL
-                logger.info(f"Descargando imagen desde: {source}")
-                response = requests.get(source, timeout=30)
-                response.raise_for_status()
-                
-                image = Image.open(BytesIO(response.content))
-                logger.info(f"Imagen descargada: {image.size[0]}x{image.size[1]} píxeles")
-            else:
-                # Cargar archivo local
-                logger.info(f"Cargando imagen local: {source}")
-                image = Image.open(source)
-                logger.info(f"Imagen cargada: {image.size[0]}x{image.size[1]} píxeles")
-            
-            return image
+            open_source, content_hash = self.read_source(source)
+            image = self._decode(open_source(), min_crop_side, held)
+            logger.info(f"Imagen cargada: {image.size[0]}x{image.size[1]} píxeles")
+            # Hash de los bytes de origen: identifica las salidas en el almacén
+            image.info["content_hash"] = content_hash
+            return image, open_source
         except Exception as e:
             logger.error(f"Error al cargar imagen: {e}")
             raise
     
+    def _decode(self, fp, min_crop_side: int, held: Optional[ExitStack] = None) -> Image.Image:
+        """Decodificar (ya con los píxeles cargados) midiendo la etapa `decode`"""
+        reserve = None
+        if self.memory_budget is not None and held is not None:
+            reserve = lambda nbytes: held.enter_context(self.memory_budget.reserve(nbytes))
+        with metrics.stage("decode"):
+            image = decode_image(fp, min_crop_side, self.max_decoded_bytes, reserve)
+            image.load()
+        return image
+
     def analyze_image_with_gemini(self, image: Image.Image) -> Dict[str, Any]:
-        """Analizar imagen con Gemini para detectar contenido esencial"""
+        """Analizar imagen con el backend de análisis para detectar contenido esencial"""
+        # La especificación se toma antes: si falla crear el backend, `self.analyzer` volvería a fallar
+        spec = self.analyzer_spec
         try:
-            # Convertir imagen a bytes para Gemini
-            img_byte_arr = BytesIO()
-            image.save(img_byte_arr, format='JPEG', quality=85)
-            img_byte_arr = img_byte_arr.getvalue()
-            
-            prompt = """
-            Analiza esta imagen y proporciona información detallada en formato JSON:
-            
-            1. ¿Cuál es el contenido principal de la imagen?
-            2. ¿Hay elementos importantes en los bordes que no deben cortarse?
-            3. ¿La imagen parece estar dividida en dos partes distintas (como dos fotos fusionadas o un díptico)?
-            4. Si está dividida, analiza cada lado por separado:
-               - Lado izquierdo: ¿qué contiene? ¿hay personas visibles?
-               - Lado derecho: ¿qué contiene? ¿hay personas visibles?
-               - ¿Cuál lado tiene personas?
-               - ¿Cuál lado tiene más contenido visual interesante o importante?
-               - ¿Cuál lado tiene mejor composición para Instagram?
-            5. ¿Cuál es el punto focal principal de la imagen?
-            6. ¿Hay texto visible que debe mantenerse?
-            
-            REGLAS DE PRIORIDAD PARA DÍPTICOS:
-            - Si solo UN lado tiene personas: SIEMPRE elige ese lado
-            - Si AMBOS lados tienen personas: SIEMPRE elige el lado izquierdo
-            - Si NINGÚN lado tiene personas: elige el más visualmente interesante
-            
-            IMPORTANTE: Si la imagen está dividida, NO cortes por la mitad. Elige UN lado completo (izquierda o derecha) que sea más interesante para Instagram.
-            
-            Responde SOLO en formato JSON válido con estas claves:
-            {
-                "contenido_principal": "descripción",
-                "elementos_bordes": "descripción de elementos en bordes",
-                "imagen_dividida": true/false,
-                "lado_izquierdo": "descripción del contenido del lado izquierdo",
-                "lado_derecho": "descripción del contenido del lado derecho",
-                "personas_izquierda": true/false,
-                "personas_derecha": true/false,
-                "lado_importante": "izquierda/derecha/centro",
-                "razon_lado_elegido": "explicación de por qué se eligió ese lado",
-                "punto_focal": "descripción del punto focal",
-                "texto_visible": "texto encontrado o 'ninguno'",
-                "recomendacion_corte": "descripción específica de cómo cortar"
-            }
-            """
-            
-            logger.info("Analizando imagen con Gemini...")
-            response = self.model.generate_content([prompt, {"mime_type": "image/jpeg", "data": img_byte_arr}])
-            
-            # Extraer JSON de la respuesta
-            response_text = response.text.strip()
-            if response_text.startswith('```json'):
-                response_text = response_text[7:-3]
-            elif response_text.startswith('```'):
-                response_text = response_text[3:-3]
-            
-            analysis = json.loads(response_text)
-            logger.info("Análisis completado")
-            return analysis
-            
+            return self._request_analysis(image)
         except Exception as e:
-            logger.error(f"Error al analizar imagen con Gemini: {e}")
-            # Análisis por defecto si falla Gemini
-            return {
-                "contenido_principal": "imagen general",
-                "elementos_bordes": "no detectados",
-                "imagen_dividida": False,
-                "lado_izquierdo": "no aplicable",
-                "lado_derecho": "no aplicable",
-                "personas_izquierda": False,
-                "personas_derecha": False,
-                "lado_importante": "centro",
-                "razon_lado_elegido": "imagen no dividida",
-                "punto_focal": "centro de la imagen",
-                "texto_visible": "ninguno",
-                "recomendacion_corte": "corte centrado"
-            }
+            logger.error(f"Error al analizar imagen con {spec}: {e}")
+            # Análisis por defecto si falla el backend
+            return self.default_analysis()
+
+    def encode_for_analysis(self, image: Image.Image) -> bytes:
+        """JPEG de la copia reducida que se sube a Gemini"""
+        proxy = make_analysis_proxy(image, self.analysis_max_side)
+        img_byte_arr = BytesIO()
+        proxy.save(img_byte_arr, format='JPEG', quality=85)
+        logger.info(f"Imagen para análisis: {proxy.size[0]}x{proxy.size[1]} píxeles, {img_byte_arr.tell()} bytes")
+        return img_byte_arr.getvalue()
+
+    def _request_analysis(self, image: Image.Image) -> Dict[str, Any]:
+        """Pedir el análisis al backend y devolverlo; lanza excepción si falla
+
+        El análisis solo describe lados y contenido (no coordenadas en píxeles),
+        así que es válido para la imagen original aunque se calcule sobre la
+        copia reducida. Los errores transitorios se reintentan con backoff.
+        """
+        payload = self.encode_for_analysis(image)
+        analysis = retry_with_backoff(lambda: self.analyzer.analyze(payload), attempts=GEMINI_RETRIES,
+                                      base_delay=GEMINI_RETRY_BASE_DELAY, retry_on=retryable_gemini_errors())
+        logger.info("Análisis completado")
+        return analysis
+
+    @staticmethod
+    def default_analysis() -> Dict[str, Any]:
+        """Análisis por defecto (corte centrado) cuando no hay respuesta de Gemini"""
+        return {
+            "contenido_principal": "imagen general",
+            "elementos_bordes": "no detectados",
+            "imagen_dividida": False,
+            "lado_izquierdo": "no aplicable",
+            "lado_derecho": "no aplicable",
+            "personas_izquierda": False,
+            "personas_derecha": False,
+            "lado_importante": "centro",
+            "razon_lado_elegido": "imagen no dividida",
+            "punto_focal": "centro de la imagen",
+            "texto_visible": "ninguno",
+            "recomendacion_corte": "corte centrado"
+        }
     
     def calculate_crop_area(self, image: Image.Image, analysis: Dict[str, Any]) -> Tuple[int, int, int, int]:
         """Calcular área de corte basada en el análisis"""
         width, height = image.size
-        target_ratio = 1.0  # Instagram square format
         
         logger.info(f"Dimensiones originales: {width}x{height}")
         
+        # Caja de recorte explícita (motor local), normalizada a la imagen
+        if analysis.get("caja_corte"):
+            crop_area = normalized_box_to_square(analysis["caja_corte"], width, height)
+            logger.info(f"Área de corte calculada (caja explícita): {crop_area}")
+            return crop_area
+        
         # Si la imagen está dividida, aplicar reglas de prioridad
         if analysis.get("imagen_dividida", False):
-            lado_importante = analysis.get("lado_importante", "centro")
-            razon = analysis.get("razon_lado_elegido", "no especificada")
-            personas_izq = analysis.get("personas_izquierda", False)
-            personas_der = analysis.get("personas_derecha", False)
-            
-            logger.info(f"Imagen dividida detectada, lado importante: {lado_importante}")
-            logger.info(f"Personas izquierda: {personas_izq}, Personas derecha: {personas_der}")
-            logger.info(f"Razón de elección: {razon}")
-            
-            # Aplicar reglas de prioridad para personas
-            if personas_izq and not personas_der:
-                lado_importante = "izquierda"
-                logger.info("REGLA APLICADA: Solo lado izquierdo tiene personas - eligiendo izquierda")
-            elif personas_der and not personas_izq:
-                lado_importante = "derecha"
-                logger.info("REGLA APLICADA: Solo lado derecho tiene personas - eligiendo derecha")
-            elif personas_izq and personas_der:
-                lado_importante = "izquierda"
-                logger.info("REGLA APLICADA: Ambos lados tienen personas - eligiendo izquierda por defecto")
-            
-            if lado_importante == "izquierda":
-                # Enfocar completamente en el lado izquierdo
-                crop_width = min(width // 2, height)  # Usar solo la mitad izquierda
-                crop_height = crop_width
-                left = 0
-                top = (height - crop_height) // 2
-                right = crop_width
-                bottom = top + crop_height
-                logger.info("Corte aplicado: Lado izquierdo completo")
-                
-            elif lado_importante == "derecha":
-                # Enfocar completamente en el lado derecho
-                crop_width = min(width // 2, height)  # Usar solo la mitad derecha
-                crop_height = crop_width
-                left = width - crop_width
-                top = (height - crop_height) // 2
-                right = width
-                bottom = top + crop_height
-                logger.info("Corte aplicado: Lado derecho completo")
-                
-            else:  # centro
-                # Corte centrado normal
-                crop_size = min(width, height)
-                left = (width - crop_size) // 2
-                top = (height - crop_size) // 2
-                right = left + crop_size
-                bottom = top + crop_size
+            logger.info(f"Imagen dividida detectada, lado importante: {analysis.get('lado_importante', 'centro')}")
+            logger.info(f"Personas izquierda: {analysis.get('personas_izquierda', False)}, "
+                        f"Personas derecha: {analysis.get('personas_derecha', False)}")
+            logger.info(f"Razón de elección: {analysis.get('razon_lado_elegido', 'no especificada')}")
+            lado_importante, regla = important_side(analysis)
+            if regla:
+                logger.info(f"REGLA APLICADA: {regla}")
+            if lado_importante in ("izquierda", "derecha"):
+                logger.info(f"Corte aplicado: Lado {lado_importante} (división en {seam_position(analysis):.3f})")
+            else:
                 logger.info("Corte aplicado: Centrado")
+        elif analysis.get("caja_sujeto"):
+            logger.info("Corte aplicado: Centrado en el sujeto (imagen no dividida)")
         else:
-            # Corte centrado normal
-            crop_size = min(width, height)
-            left = (width - crop_size) // 2
-            top = (height - crop_size) // 2
-            right = left + crop_size
-            bottom = top + crop_size
             logger.info("Corte aplicado: Centrado (imagen no dividida)")
         
-        logger.info(f"Área de corte calculada: ({left}, {top}, {right}, {bottom})")
-        return (left, top, right, bottom)
+        # Mayor cuadrado dentro de la región que conserva el sujeto y las zonas marcadas
+        crop_area = solve_crop(crop_constraints(analysis), width, height)
+        logger.info(f"Área de corte calculada: {crop_area}")
+        return crop_area
     
     def crop_image(self, image: Image.Image, crop_area: Tuple[int, int, int, int]) -> Image.Image:
         """Cortar imagen según el área calculada"""
@@ -202,75 +656,526 @@ class ImageProcessor:
         cropped = image.crop((left, top, right, bottom))
         
         # Redimensionar a tamaño estándar de Instagram si es necesario
-        target_size = (1080, 1080)  # Tamaño recomendado para Instagram
+        target_size = OUTPUT_SIZE  # Tamaño recomendado para Instagram
         if cropped.size != target_size:
             cropped = cropped.resize(target_size, Image.Resampling.LANCZOS)
         
         logger.info(f"Imagen cortada a: {cropped.size[0]}x{cropped.size[1]} píxeles")
         return cropped
     
-    def process_image(self, source: str, output_path: str = None) -> str:
-        """Procesar imagen completa: cargar, analizar y cortar"""
+    @staticmethod
+    def original_coordinates(image: Image.Image, crop_area: Tuple[int, int, int, int]) -> Dict[str, int]:
+        """Coordenadas del corte en la imagen original (antes de la decodificación reducida)"""
+        original_width, original_height = image.info.get("original_size", image.size)
+        scale_x = original_width / image.size[0]
+        scale_y = original_height / image.size[1]
+        left, top, right, bottom = crop_area
+        return {
+            "left": round(left * scale_x),
+            "top": round(top * scale_y),
+            "right": round(right * scale_x),
+            "bottom": round(bottom * scale_y)
+        }
+
+    def local_analysis(self, image: Image.Image) -> Dict[str, Any]:
+        """Análisis y recorte con el motor local (saliencia), sin llamar a Gemini"""
+        # local_analysis importa NumPy: solo se carga si se usa el motor o el detector local
+        from local_analysis import DETECTOR_WIDTH, local_crop_analysis
+        start = time.time()
+        analysis = local_crop_analysis(make_analysis_proxy(image, DETECTOR_WIDTH), OUTPUT_SIZE[0], image.size)
+        logger.info(f"Análisis local completado en {(time.time() - start) * 1000:.0f} ms")
+        return analysis
+
+    def analyze_with_cache(self, image: Image.Image,
+                           engine: Optional[str] = None) -> Tuple[Dict[str, Any], Tuple[int, int, int, int], str]:
+        """Obtener análisis y área de corte, consultando la caché antes que a Gemini
+
+        Devuelve (análisis, área de corte, origen), con el origen de SERVED_BY_*.
+        Solo se guardan en la caché los análisis de Gemini: ni los del detector
+        local (baratos de repetir) ni los de respaldo generados tras un fallo.
+        Con `single_flight`, las imágenes con el mismo contenido que se analizan
+        a la vez (aunque vengan de URLs distintas) comparten un único análisis.
+        El motor `local` y los backends sin clave nunca consultan la caché, para
+        no servir como suyo un análisis de Gemini guardado por otra petición.
+        """
+        engine = engine or self.engine
+        if engine == "local":
+            analysis, served_by = self.fresh_analysis(image, engine)
+            with metrics.stage("crop"):
+                crop_area = self.calculate_crop_area(image, analysis)
+            return analysis, crop_area, served_by
+
+        cache = self.cache if requires_api_key(self.analyzer_spec) else None
+        cache_key = None
+        if cache is not None or self.single_flight is not None:
+            cache_key = AnalysisCache.key_for(image, analysis_identity(self.analyzer_spec))
+        if cache is not None:
+            cached = cache.get(cache_key)
+            metrics.inc("cropper_cache_requests_total", cache="analysis",
+                        result="miss" if cached is None else "hit")
+            if cached is not None:
+                analysis = cached["analysis"]
+                if cached["size"] == image.size:
+                    crop_area = cached["crop_box"]
+                else:
+                    # Misma imagen con otra resolución: recalcular el corte localmente
+                    with metrics.stage("crop"):
+                        crop_area = self.calculate_crop_area(image, analysis)
+                return analysis, crop_area, SERVED_BY_CACHE
+
+        if self.single_flight is not None:
+            (analysis, served_by), shared = self.single_flight.do(
+                f"analysis:{engine}:{self.analyzer_spec}:{self.limiter_key}:{cache_key}",
+                lambda: self.fresh_analysis(image, engine),
+                encode=list, decode=tuple
+            )
+            if shared:
+                # El análisis (y la caché) ya los resolvió la petición líder
+                with metrics.stage("crop"):
+                    crop_area = self.calculate_crop_area(image, analysis)
+                return analysis, crop_area, SERVED_BY_COALESCED
+        else:
+            analysis, served_by = self.fresh_analysis(image, engine)
+        with metrics.stage("crop"):
+            crop_area = self.calculate_crop_area(image, analysis)
+        if cache is not None and served_by == SERVED_BY_GEMINI:
+            cache.put(cache_key, analysis, crop_area, image.size)
+        return analysis, crop_area, served_by
+
+    def fresh_analysis(self, image: Image.Image, engine: Optional[str] = None) -> Tuple[Dict[str, Any], str]:
+        """Analizar la imagen sin caché; devuelve (análisis, origen)
+
+        Con el motor `local` no se llama a Gemini. Con el detector local en modo
+        `auto`, los casos claros (sin costura, o díptico con personas evidentes)
+        se resuelven sin llamar a Gemini. En modo `compare` se ejecutan ambos,
+        se usa Gemini y se registran los desacuerdos. Mientras el circuit
+        breaker de Gemini está abierto se usa el motor local. Si Gemini falla
+        (tras los reintentos), el motor `hybrid` recurre al motor local y
+        `gemini` al corte centrado.
+        """
+        engine = engine or self.engine
+        if engine == "local":
+            with metrics.stage("local_analysis"):
+                return self.local_analysis(image), SERVED_BY_LOCAL
+
+        local = None
+        if self.local_detector in ("auto", "compare"):
+            from local_analysis import DETECTOR_WIDTH, local_split_analysis
+            local = local_split_analysis(make_analysis_proxy(image, DETECTOR_WIDTH))
+            if local is not None and self.local_detector == "auto":
+                logger.info("Análisis resuelto con el detector local, sin llamar a Gemini")
+                return local, SERVED_BY_LOCAL_DETECTOR
+
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow():
+            logger.warning("Gemini no disponible (circuit breaker abierto): usando el motor local")
+            metrics.inc("cropper_fallbacks_total", reason="breaker_open", served_by=SERVED_BY_LOCAL_FALLBACK)
+            with metrics.stage("local_analysis"):
+                return self.local_analysis(image), SERVED_BY_LOCAL_FALLBACK
+
         try:
-            # Cargar imagen (URL o archivo local)
-            image = self.load_image(source)
-            
-            # Analizar con Gemini
-            analysis = self.analyze_image_with_gemini(image)
-            logger.info(f"Análisis: {analysis}")
+            with metrics.stage("analysis_backend"):
+                analysis = self._request_analysis(image)
+        except Exception as e:
+            logger.error(f"Error al analizar imagen con Gemini: {e}")
+            if breaker is not None:
+                breaker.record_failure()
+            if engine == "hybrid":
+                logger.warning("Usando el motor local como respaldo de Gemini")
+                metrics.inc("cropper_fallbacks_total", reason="gemini_error", served_by=SERVED_BY_LOCAL_FALLBACK)
+                with metrics.stage("local_analysis"):
+                    return self.local_analysis(image), SERVED_BY_LOCAL_FALLBACK
+            metrics.inc("cropper_fallbacks_total", reason="gemini_error", served_by=SERVED_BY_DEFAULT)
+            return self.default_analysis(), SERVED_BY_DEFAULT
+
+        if breaker is not None:
+            breaker.record_success()
+        if self.local_detector == "compare":
+            log_detector_disagreement(local, analysis)
+        # Los análisis de otros backends (local, fake, replay) se identifican por
+        # su nombre y no se guardan en la caché
+        if not requires_api_key(self.analyzer_spec):
+            return analysis, self.analyzer.name
+        return analysis, SERVED_BY_GEMINI
+
+    def prepare(self, source: Union[str, bytes], engine: Optional[str], names: Tuple[str, ...],
+                held: Optional[ExitStack] = None):
+        """Cargar y analizar la imagen; devuelve (imagen, análisis, área de corte, origen)
+
+        La imagen se decodifica reducida suponiendo que el corte más pequeño es
+        la mitad de un díptico. Si el corte resuelto resulta menor (división
+        descentrada, sujeto pequeño) y la imagen original tiene más píxeles,
+        se vuelve a decodificar a resolución completa para no ampliar la salida;
+        antes se libera la reducida (y su reserva de memoria), para no retener
+        una reserva mientras se espera la segunda.
+        """
+        # Reserva de la decodificación reducida: se libera con `held` o antes de la completa
+        reduced = None
+        if held is not None:
+            reduced = held.enter_context(ExitStack())
+        # Cargar imagen con resolución suficiente para el mayor formato
+        image, open_source = self._load(source, max(max(RENDITIONS[name]) for name in names), reduced)
+        
+        # Analizar con Gemini (o recuperar de la caché) y calcular área de corte
+        with metrics.stage("analysis"):
+            analysis, crop_area, served_by = self.analyze_with_cache(image, engine)
+        metrics.inc("cropper_images_total", served_by=served_by)
+        logger.info(f"Análisis ({served_by}): {analysis}")
+
+        if image.size != image.info["original_size"] and needs_more_pixels(crop_area, image.size, names, analysis):
+            logger.info(f"El corte no cubre la salida a {image.size[0]}x{image.size[1]}: "
+                        f"decodificando a resolución completa")
+            content_hash = image.info["content_hash"]
+            image.close()
+            if reduced is not None:
+                reduced.close()
+            image = self._decode(open_source(), 0, held)
+            image.info["content_hash"] = content_hash
+            with metrics.stage("crop"):
+                crop_area = self.calculate_crop_area(image, analysis)
+        return image, analysis, crop_area, served_by
+
+    def process_to_bytes(self, source: Union[str, bytes], engine: Optional[str] = None, renditions=None,
+                         encoding: Optional[EncodeOptions] = None) -> Tuple[ProcessingResult, Dict[str, bytes]]:
+        """Procesar una imagen sin escribir en disco: devuelve el resultado y cada formato codificado
+
+        `source` puede ser una URL, una ruta o los bytes de la imagen. Las salidas
+        se codifican en memoria con `encoding` (por defecto la del procesador) y
+        el resultado no tiene `output_path`.
+        """
+        encoding = (encoding or self.encoding).validate()
+        try:
+            with request_timings() as timings, ExitStack() as held:
+                names = parse_renditions(renditions)
+                image, analysis, crop_area, served_by = self.prepare(source, engine, names, held)
             
-            # Calcular área de corte
-            crop_area = self.calculate_crop_area(image, analysis)
+                encoded = {}
+                outputs = {}
+                with metrics.stage("resize"):
+                    rendered = render_renditions(image, crop_area, names, analysis)
+                for name, (output, box) in rendered.items():
+                    with metrics.stage("encode"):
+                        encoded[name], quality = encode_image(output, encoding)
+                    metrics.inc("cropper_bytes_out_total", len(encoded[name]), format=encoding.format)
+                    outputs[name] = {
+                        "output_path": "",
+                        "width": output.size[0],
+                        "height": output.size[1],
+                        "crop_coordinates": self.original_coordinates(image, box),
+                        "format": encoding.format,
+                        "quality": quality,
+                        "bytes": len(encoded[name]),
+                    }
+                    logger.info(f"Imagen codificada en memoria: {name}, {len(encoded[name])} bytes")
             
-            # Guardar datos para la API
-            self._last_analysis = analysis
-            self._last_crop_coordinates = {
-                "left": crop_area[0],
-                "top": crop_area[1], 
-                "right": crop_area[2],
-                "bottom": crop_area[3]
-            }
+                result = ProcessingResult(
+                    output_path="",
+                    analysis=analysis,
+                    crop_coordinates=outputs[names[0]]["crop_coordinates"],
+                    cache_hit=served_by == SERVED_BY_CACHE,
+                    served_by=served_by,
+                    renditions=outputs,
+                    timings={stage: round(ms, 1) for stage, ms in timings.items()}
+                )
+                return result, encoded
+        except Exception as e:
+            logger.error(f"Error al procesar imagen: {e}")
+            raise
+
+    def process_image(self, source: Union[str, bytes], output_path: str = None, engine: Optional[str] = None,
+                      renditions=None, encoding: Optional[EncodeOptions] = None) -> ProcessingResult:
+        """Procesar imagen completa: cargar, analizar y cortar
+
+        `renditions` es la lista de formatos de RENDITIONS a generar (por defecto
+        solo `square`). Todos salen de una única descarga, decodificación y
+        análisis; el primero se guarda en `output_path` y el resto con sufijo.
+        Sin `output_path` y con almacén de salidas, cada formato se guarda en el
+        almacén y, si ya existe (misma imagen y mismo corte), se reutiliza sin
+        volver a codificarlo. `encoding` elige formato y calidad (por defecto
+        la del procesador). No guarda estado en el procesador, así que una
+        misma instancia puede atender peticiones concurrentes.
+        """
+        encoding = (encoding or self.encoding).validate()
+        try:
+            with request_timings() as timings, ExitStack() as held:
+                names = parse_renditions(renditions)
+                image, analysis, crop_area, served_by = self.prepare(source, engine, names, held)
             
-            # Cortar imagen
-            cropped_image = self.crop_image(image, crop_area)
+                boxes = rendition_boxes(crop_area, image.size, names, analysis)
+                paths = {}
+                store = self.output_store if output_path is None else None
+                if store is not None:
+                    store_names = {
+                        name: store.name_for(image.info["content_hash"], boxes[name], RENDITIONS[name],
+                                             encoding.key(), encoding.extension)
+                        for name in names
+                    }
+                    for name in names:
+                        existing = store.lookup(store_names[name])
+                        metrics.inc("cropper_cache_requests_total", cache="output",
+                                    result="miss" if existing is None else "hit")
+                        if existing is not None:
+                            paths[name] = existing
+                            logger.info(f"Salida reutilizada del almacén: {existing} ({name})")
+                elif output_path is None:
+                    if isinstance(source, str):
+                        source_hash = hashlib.sha1(source.encode("utf-8")).hexdigest()[:10]
+                    else:
+                        source_hash = image.info["content_hash"][:10]
+                    output_path = f"instagram_crop_{source_hash}.{encoding.extension}"
             
-            # Guardar imagen procesada
-            if output_path is None:
-                output_path = f"instagram_crop_{hash(source) % 10000}.jpg"
+                # Cortar, redimensionar y guardar los formatos que aún no existen
+                missing = [name for name in names if name not in paths]
+                with metrics.stage("resize"):
+                    rendered = render_renditions(image, crop_area, missing, analysis)
+                for name, (output, box) in rendered.items():
+                    with metrics.stage("encode"):
+                        data, quality = encode_image(output, encoding)
+                    metrics.inc("cropper_bytes_out_total", len(data), format=encoding.format)
+                    with metrics.stage("save"):
+                        if store is not None:
+                            path = store.save(store_names[name], data)
+                        else:
+                            path = rendition_path(output_path, name, primary=name == names[0],
+                                                  extension=encoding.extension)
+                            with open(path, "wb") as f:
+                                f.write(data)
+                    paths[name] = path
+                    logger.info(f"Imagen guardada en: {path} ({name}, {output.size[0]}x{output.size[1]}, "
+                                f"{encoding.format} q{quality}, {len(data)} bytes)")
             
-            cropped_image.save(output_path, "JPEG", quality=95)
-            logger.info(f"Imagen guardada en: {output_path}")
+                outputs = {
+                    name: {
+                        "output_path": paths[name],
+                        "width": RENDITIONS[name][0],
+                        "height": RENDITIONS[name][1],
+                        "crop_coordinates": self.original_coordinates(image, boxes[name]),
+                        "format": encoding.format,
+                        "bytes": os.path.getsize(paths[name]),
+                    }
+                    for name in names
+                }
             
-            return output_path
+                return ProcessingResult(
+                    output_path=paths[names[0]],
+                    analysis=analysis,
+                    crop_coordinates=outputs[names[0]]["crop_coordinates"],
+                    cache_hit=served_by == SERVED_BY_CACHE,
+                    served_by=served_by,
+                    renditions=outputs,
+                    timings={stage: round(ms, 1) for stage, ms in timings.items()}
+                )
             
         except Exception as e:
             logger.error(f"Error al procesar imagen: {e}")
             raise
 
+    def process_batch(self, sources: List[str], output_dir: Optional[str] = None,
+                      max_workers: int = 4, renditions=None,
+                      encoding: Optional[EncodeOptions] = None) -> Iterator[Dict[str, Any]]:
+        """Procesar un lote de imágenes en paralelo, entregando cada resultado al terminar
+
+        Las descargas y el trabajo de Pillow se solapan entre hilos; las llamadas a
+        Gemini quedan sujetas al limitador del procesador. Un error en una imagen
+        no detiene el resto: se entrega como un resultado con success=False.
+        `encoding` elige formato y calidad (por defecto la del procesador).
+        """
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        extension = (encoding or self.encoding).extension
+
+        def run(index: int, source: str) -> Dict[str, Any]:
+            start = time.time()
+            output_path = os.path.join(output_dir, f"instagram_crop_{index:04d}.{extension}") if output_dir else None
+            try:
+                result = self.process_image(source, output_path, renditions=renditions, encoding=encoding)
+                item = {"success": True, **result.to_dict()}
+            except Exception as e:
+                item = {"success": False, "error": str(e)}
+            item.update(index=index, source=source, processing_time=round(time.time() - start, 2))
+            return item
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="lote") as executor:
+            futures = [executor.submit(run, index, source) for index, source in enumerate(sources)]
+            for future in as_completed(futures):
+                yield future.result()
+
+def run_batch(processor: ImageProcessor, spec: str, output_dir: Optional[str], workers: int,
+              renditions=None) -> bool:
+    """Procesar un lote desde la línea de comandos; devuelve True si todas las imágenes salieron bien"""
+    sources = list_batch_sources(spec)
+    if not sources:
+        print(f"❌ No se encontraron imágenes en: {spec}")
+        return False
+
+    print(f"📦 Procesando {len(sources)} imágenes con {workers} hilos...")
+    start = time.time()
+    ok = 0
+    for item in processor.process_batch(sources, output_dir, max_workers=workers, renditions=renditions):
+        if item["success"]:
+            ok += 1
+            print(f"✅ [{item['index']}] {item['source']} -> {item['output_path']} ({item['processing_time']}s)")
+        else:
+            print(f"❌ [{item['index']}] {item['source']}: {item['error']}")
+    elapsed = time.time() - start
+
+    print(f"\n📈 {ok}/{len(sources)} imágenes en {elapsed:.2f}s ({len(sources) / elapsed:.2f} img/s)")
+    return ok == len(sources)
+
+# Subdirectorio de la carpeta vigilada donde van las salidas y el manifiesto
+WATCH_OUTPUT_SUBDIR = "recortes"
+
+def watch_handler(processor: ImageProcessor, output_dir: str, names: List[str]) -> Callable[[str], Dict[str, Any]]:
+    """Función que procesa una imagen de la carpeta vigilada y escribe sus versiones
+
+    El nombre de salida conserva la extensión de origen (`foto.jpg` ->
+    `foto.jpg.webp`) para que `foto.jpg` y `foto.png` no se pisen.
+    """
+    extension = processor.encoding.extension
+
+    def handle(path: str) -> Dict[str, Any]:
+        result, encoded = processor.process_to_bytes(path, renditions=names)
+        base = os.path.join(output_dir, f"{os.path.basename(path)}.{extension}")
+        outputs = {}
+        for name in names:
+            output_path = rendition_path(base, name, primary=name == names[0], extension=extension)
+            write_atomic(output_path, encoded[name])
+            outputs[name] = os.path.basename(output_path)
+        print(f"✅ {os.path.basename(path)} -> {', '.join(outputs.values())} ({result.served_by})")
+        return {"outputs": outputs, "served_by": result.served_by, "crop_coordinates": result.crop_coordinates}
+
+    return handle
+
+def run_watch(processor: ImageProcessor, directory: str, output_dir: Optional[str], workers: int,
+              renditions=None, max_in_flight: Optional[int] = None,
+              poll_interval: Optional[float] = None) -> bool:
+    """Vigilar un directorio y procesar las imágenes que lleguen hasta Ctrl+C o SIGTERM
+
+    Las salidas se escriben de forma atómica en `output_dir` (por defecto el
+    subdirectorio `recortes`) junto al manifiesto, que permite reanudar sin
+    repetir las imágenes ya terminadas. Devuelve True si ninguna falló.
+    """
+    if not os.path.isdir(directory):
+        print(f"❌ No existe el directorio: {directory}")
+        return False
+    output_dir = output_dir or os.path.join(directory, WATCH_OUTPUT_SUBDIR)
+    if os.path.abspath(output_dir) == os.path.abspath(directory):
+        print("❌ El directorio de salida no puede ser el vigilado")
+        return False
+    os.makedirs(output_dir, exist_ok=True)
+    names = parse_renditions(renditions)
+    manifest = Manifest(os.path.join(output_dir, MANIFEST_NAME))
+
+    handle = watch_handler(processor, output_dir, names)
+    folder = HotFolder(directory, handle, manifest, IMAGE_EXTENSIONS, workers=workers,
+                       max_in_flight=max_in_flight, poll_interval=poll_interval)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: folder.stop.set())
+    done = sum(1 for entry in manifest.entries.values() if entry.get("status") == "ok")
+    print(f"👀 Vigilando {directory} con {workers} hilos (salidas en {output_dir}, "
+          f"{done} ya procesadas). Ctrl+C para salir")
+    folder.run()
+    print(f"\n📈 {folder.processed} imágenes procesadas, {folder.failed} con error")
+    return folder.failed == 0
+
 def main():
     """Función principal"""
     parser = argparse.ArgumentParser(description="Cortar imágenes para Instagram usando Gemini AI")
-    parser.add_argument("source", help="URL de la imagen o ruta del archivo local a procesar")
+    parser.add_argument("source", nargs="?",
+                        help="URL de la imagen o ruta del archivo local a procesar, o `watch` para vigilar DIR")
+    parser.add_argument("watch_dir", nargs="?", metavar="DIR",
+                        help="Con `watch`: directorio cuyas imágenes nuevas se procesan según llegan")
     parser.add_argument("-o", "--output", help="Ruta de salida para la imagen procesada")
+    parser.add_argument("--batch", metavar="ARCHIVO|DIR",
+                        help="Procesar un lote: archivo con una URL/ruta por línea o directorio de imágenes")
+    parser.add_argument("--output-dir",
+                        help=f"Directorio de salida para el modo lote o watch (en watch, por defecto DIR/{WATCH_OUTPUT_SUBDIR})")
+    parser.add_argument("--workers", type=int, default=4, help="Imágenes procesadas en paralelo en modo lote o watch")
+    parser.add_argument("--max-in-flight", type=int,
+                        help="En watch, imágenes en curso o en cola como máximo (por defecto 2 por hilo)")
+    parser.add_argument("--poll-interval", type=float,
+                        help="En watch, revisar el directorio cada N segundos en lugar de usar inotify")
     parser.add_argument("-k", "--api-key", help="API key de Google Gemini", 
                        default=os.getenv("GEMINI_API_KEY"))
     parser.add_argument("-v", "--verbose", action="store_true", help="Mostrar información detallada")
+    parser.add_argument("--no-cache", action="store_true", help="No usar la caché de análisis ni la de descargas")
+    parser.add_argument("--analysis-size", type=int, default=DEFAULT_ANALYSIS_MAX_SIDE,
+                        help="Lado mayor (px) de la imagen enviada a Gemini; 0 envía la resolución completa")
+    parser.add_argument("--engine", choices=ENGINES, default=DEFAULT_ENGINE,
+                        help="Motor de recorte: gemini, local (sin Gemini, por saliencia) o hybrid")
+    parser.add_argument("--analyzer", default=DEFAULT_ANALYZER,
+                        help=f"Backend de análisis: backend[:argumento] ({', '.join(BACKENDS)}), "
+                             "p. ej. gemini:gemini-2.5-flash-lite o replay:grabacion.jsonl")
+    parser.add_argument("--local-detector", choices=LOCAL_DETECTOR_MODES, default=DEFAULT_LOCAL_DETECTOR,
+                        help="Detector local de dípticos: off, auto (evita Gemini si está seguro) o compare")
+    parser.add_argument("--renditions", default=",".join(DEFAULT_RENDITIONS),
+                        help=f"Formatos a generar, separados por comas ({', '.join(RENDITIONS)})")
+    parser.add_argument("--format", dest="image_format", choices=FORMATS,
+                        help="Formato de las salidas (por defecto OUTPUT_FORMAT o jpeg)")
+    parser.add_argument("--quality", type=int, help="Calidad de codificación, 1-100 (por defecto 95)")
+    parser.add_argument("--progressive", action="store_true", help="JPEG progresivo (y optimizado)")
+    parser.add_argument("--optimize", action="store_true",
+                        help="Codificación más lenta y más compacta (tablas Huffman óptimas en JPEG)")
+    parser.add_argument("--subsampling", choices=SUBSAMPLING_MODES, help="Submuestreo de croma (JPEG y AVIF)")
+    parser.add_argument("--target-ssim", type=float,
+                        help="Buscar la calidad más baja con al menos este SSIM (p. ej. 0.98); --quality es el máximo")
     
     args = parser.parse_args()
     
+    if not args.source and not args.batch:
+        parser.error("se requiere una imagen (source), --batch o watch DIR")
+    if args.source == "watch" and not args.watch_dir:
+        parser.error("watch requiere el directorio a vigilar")
+    if args.watch_dir and args.source != "watch":
+        parser.error(f"argumento no reconocido: {args.watch_dir}")
+    
+    try:
+        renditions = parse_renditions(args.renditions)
+        parse_analyzer_spec(args.analyzer)
+        overrides = {
+            "format": args.image_format,
+            "quality": args.quality,
+            "progressive": args.progressive or None,
+            "optimize": args.optimize or None,
+            "subsampling": args.subsampling,
+            "target_ssim": args.target_ssim,
+        }
+        encoding = replace(get_default_encoding(),
+                           **{key: value for key, value in overrides.items() if value is not None}).validate()
+    except ValueError as e:
+        parser.error(str(e))
+    
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
     
-    if not args.api_key:
+    if not args.api_key and args.engine != "local" and requires_api_key(args.analyzer):
         print("Error: Se requiere una API key de Gemini. Usa -k o configura GEMINI_API_KEY")
         sys.exit(1)
     
     try:
-        processor = ImageProcessor(args.api_key)
-        output_file = processor.process_image(args.source, args.output)
+        cache = None if args.no_cache else get_analysis_cache()
+        download_cache = None if args.no_cache else get_download_cache()
+        processor = ImageProcessor(args.api_key or "", cache=cache, rate_limiter=get_gemini_rate_limiter(),
+                                   download_cache=download_cache, encoding=encoding,
+                                   circuit_breaker=get_gemini_circuit_breaker(),
+                                   analysis_max_side=args.analysis_size,
+                                   local_detector=args.local_detector,
+                                   engine=args.engine, analyzer=args.analyzer,
+                                   memory_budget=get_memory_budget())
+        
+        if args.batch:
+            sys.exit(0 if run_batch(processor, args.batch, args.output_dir, args.workers, renditions) else 1)
+        
+        if args.source == "watch":
+            sys.exit(0 if run_watch(processor, args.watch_dir, args.output_dir, args.workers, renditions,
+                                    max_in_flight=args.max_in_flight, poll_interval=args.poll_interval) else 1)
+        
+        result = processor.process_image(args.source, args.output, renditions=renditions)
+        output_file = result.output_path
         
         print(f"\n✅ ¡Imagen procesada exitosamente!")
-        print(f"📁 Archivo guardado: {output_file}")
+        for name, rendition in result.renditions.items():
+            print(f"📁 Archivo guardado ({name}, {rendition['width']}x{rendition['height']}): {rendition['output_path']}")
         print(f"📱 Lista para Instagram: {output_file}")
         
     except Exception as e:
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Métricas del servicio en formato Prometheus
+Contadores e histogramas en memoria de cada proceso; con SQLite, cada worker de
+uvicorn vuelca periódicamente su instantánea y /metrics suma las de todos. Los
+gauges no se suman: los fija el worker que atiende /metrics (p. ej. a partir
+del estado compartido de la cola de trabajos). Los
+tiempos de cada etapa del pipeline se acumulan además en la petición en curso
+para devolver el desglose en la respuesta.
+"""
+
+import os
+import json
+import time
+import uuid
+import bisect
+import sqlite3
+import tempfile
+import threading
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Dict, Any, List, Tuple, Iterator
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_PATH = os.path.join(tempfile.gettempdir(), "instagram-cropper", "metrics.sqlite3")
+
+# Límites superiores (segundos) de los buckets de los histogramas
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Nombre -> (tipo, ayuda) de las métricas exportadas
+DEFINITIONS = {
+    "cropper_http_request_seconds": ("histogram", "Duración de las peticiones HTTP por ruta y estado"),
+    "cropper_stage_seconds": ("histogram", "Duración de cada etapa del procesamiento de una imagen"),
+    "cropper_images_total": ("counter", "Imágenes procesadas según quién resolvió el análisis"),
+    "cropper_fallbacks_total": ("counter", "Análisis que no vinieron de Gemini por un fallo o el circuit breaker"),
+    "cropper_cache_requests_total": ("counter", "Consultas a las cachés de análisis, descargas y salidas"),
+    "cropper_gemini_requests_total": ("counter", "Llamadas a Gemini (cada intento) por resultado"),
+    "cropper_gemini_repairs_total": ("counter", "Respuestas de Gemini no válidas que se pidió corregir, por resultado"),
+    "cropper_bytes_in_total": ("counter", "Bytes de las imágenes recibidas, por origen"),
+    "cropper_bytes_out_total": ("counter", "Bytes de las salidas codificadas, por formato"),
+    "cropper_admission_total": ("counter", "Reservas del presupuesto de memoria de las imágenes, por resultado"),
+    "cropper_jobs_queue_depth": ("gauge", "Trabajos en cola pendientes de empezar"),
+    "cropper_job_wait_seconds": ("histogram", "Tiempo de espera de los trabajos en la cola hasta empezar"),
+    "cropper_job_run_seconds": ("histogram", "Duración de la ejecución de los trabajos, por estado final"),
+}
+
+# Tiempos por etapa (ms) de la petición que se está procesando en este hilo
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("timings", default=None)
+
+
+def _key(name: str, labels: Dict[str, Any]) -> str:
+    return json.dumps([name, sorted((key, str(value)) for key, value in labels.items())])
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metrics:
+    """Registro de contadores, histogramas y gauges
+
+    Las actualizaciones solo tocan memoria. Con `path`, `flush` guarda la
+    instantánea de este proceso en SQLite (una fila por proceso) y `collect`
+    suma las de todos los procesos, así que los contadores de un worker que
+    se reinicia no se pierden. Los gauges son solo de este proceso.
+    """
+
+    def __init__(self, path: Optional[str] = None, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.path = path
+        self.buckets = tuple(buckets)
+        self._counters: Dict[str, float] = {}
+        # Por clave: conteos por bucket (el último es +Inf), suma y número de observaciones
+        self._histograms: Dict[str, List[float]] = {}
+        self._gauges: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._worker = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._table_ready = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = _key(name, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 3)
+            histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Medir una etapa del pipeline: histograma y desglose de la petición en curso"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe("cropper_stage_seconds", elapsed, stage=name)
+            timings = _timings.get()
+            if timings is not None:
+                timings[name] = timings.get(name, 0.0) + elapsed * 1000
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "histograms": {key: list(values) for key, values in self._histograms.items()},
+            }
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        if not self._table_ready:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS samples (
+                    worker TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self._table_ready = True
+        return conn
+
+    def flush(self) -> None:
+        """Guardar la instantánea de este proceso en SQLite"""
+        if not self.path:
+            return
+        data = json.dumps(self.snapshot())
+        try:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO samples (worker, data, updated_at) VALUES (?, ?, ?)",
+                             (self._worker, data, time.time()))
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Error guardando las métricas: {e}")
+
+    def collect(self) -> Dict[str, Any]:
+        """Métricas de todos los procesos (o solo de este, sin SQLite) y gauges de este"""
+        with self._lock:
+            gauges = dict(self._gauges)
+        if not self.path:
+            return dict(self.snapshot(), gauges=gauges)
+        self.flush()
+        try:
+            with self._connect() as conn:
+                rows = [json.loads(row[0]) for row in conn.execute("SELECT data FROM samples")]
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Error leyendo las métricas de los workers: {e}")
+            return dict(self.snapshot(), gauges=gauges)
+
+        merged: Dict[str, Any] = {"counters": {}, "histograms": {}, "gauges": gauges}
+        size = len(self.buckets) + 3
+        for row in rows:
+            for key, value in row["counters"].items():
+                merged["counters"][key] = merged["counters"].get(key, 0) + value
+            for key, values in row["histograms"].items():
+                if len(values) != size:
+                    continue  # Buckets distintos (otra versión del servicio)
+                total = merged["histograms"].setdefault(key, [0] * size)
+                for index, value in enumerate(values):
+                    total[index] += value
+        return merged
+
+    def render(self) -> str:
+        """Métricas en el formato de texto de Prometheus"""
+        data = self.collect()
+        series: Dict[str, List[Tuple[List[Tuple[str, str]], Any]]] = {}
+        for kind in ("counters", "histograms", "gauges"):
+            for key, value in data[kind].items():
+                name, labels = json.loads(key)
+                series.setdefault(name, []).append(([tuple(label) for label in labels], value))
+
+        lines = []
+        for name in list(DEFINITIONS) + sorted(set(series) - set(DEFINITIONS)):
+            kind, help_text = DEFINITIONS.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(series.get(name, []), key=lambda item: item[0]):
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), value):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else _format_value(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + [('le', le)])} {_format_value(cumulative)}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value[-2])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {_format_value(value[-1])}")
+        return "\n".join(lines) + "\n"
+
+    def start_flush(self, interval: float) -> None:
+        """Volcar las métricas a SQLite en segundo plano cada `interval` segundos"""
+        if not self.path or interval <= 0 or self._thread is not None:
+            return
+
+        def loop():
+            while not self._stop.wait(interval):
+                self.flush()
+
+        self._thread = threading.Thread(target=loop, name="volcado-metricas", daemon=True)
+        self._thread.start()
+
+    def stop_flush(self) -> None:
+        self._stop.set()
+        self.flush()
+
+
+@contextmanager
+def request_timings() -> Iterator[Dict[str, float]]:
+    """Recoger los tiempos por etapa (ms) de lo que se procese dentro del bloque"""
+    timings: Dict[str, float] = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def get_metrics() -> Metrics:
+    """Crear el registro según METRICS_BACKEND (sqlite, compartido entre workers, o memory)"""
+    if os.getenv("METRICS_BACKEND", "sqlite").lower() == "memory":
+        return Metrics()
+    return Metrics(path=os.getenv("METRICS_PATH", DEFAULT_METRICS_PATH))
+
+
+# Registro del proceso, compartido por todos los módulos
+metrics = get_metrics()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Almacén de imágenes generadas, direccionado por contenido
+Cada salida se nombra con un hash del contenido de la imagen de origen y de los
+parámetros del formato (caja de corte, tamaño, calidad), así que una petición
+idéntica reutiliza el archivo ya codificado. Los archivos se reparten en
+subdirectorios, se escriben de forma atómica y una limpieza periódica los
+expulsa por antigüedad, número y tamaño total. Con varios workers, un turno en
+SQLite hace que en cada intervalo limpie uno solo.
+"""
+
+import os
+import re
+import time
+import uuid
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import logging
+from typing import Optional, Dict, Any, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Cambiar esta versión invalida las salidas anteriores (p. ej. si cambia el redimensionado)
+OUTPUT_STORE_VERSION = "v1"
+
+DEFAULT_OUTPUT_DIR = os.path.join(tempfile.gettempdir(), "instagram-cropper", "outputs")
+DEFAULT_OUTPUT_MAX_AGE = 7 * 24 * 3600  # 7 días sin usarse
+DEFAULT_MAX_OUTPUT_FILES = 1000
+DEFAULT_MAX_OUTPUT_BYTES = 1024 * 1024 * 1024  # 1GB
+# Fuera de OUTPUT_DIR: la limpieza no debe tratarlo como una salida
+DEFAULT_CLEANUP_LEASE_PATH = os.path.join(tempfile.gettempdir(), "instagram-cropper", "cleanup.sqlite3")
+
+_NAME_PATTERN = re.compile(r"^[0-9a-f]{40}\.[a-z0-9]+$")
+# Nombres elegidos por el cliente (output_filename): sin rutas ni archivos ocultos
+_CUSTOM_NAME_PATTERN = re.compile(r"^[\w][\w.-]{0,127}$")
+
+# Subdirectorio del almacén para las salidas con nombre elegido por el cliente
+NAMED_DIR = "named"
+
+# Segundos tras los que un .tmp se considera huérfano (escritura interrumpida);
+# antes puede ser un `save` en curso de otro hilo o worker
+TEMP_GRACE_PERIOD = 3600
+
+
+class CleanupLease:
+    """Turno de limpieza compartido por los workers de uvicorn en SQLite
+
+    `acquire(min_gap)` toma el turno si nadie lo tomó en los últimos `min_gap`
+    segundos. Cada worker lo intenta en su intervalo y solo el primero limpia;
+    si ese worker muere, el turno lo toma otro en el siguiente intervalo. Si
+    SQLite falla, se limpia igualmente (la limpieza es idempotente).
+    """
+
+    def __init__(self, path: str = DEFAULT_CLEANUP_LEASE_PATH, name: str = "outputs"):
+        self.path = path
+        self.name = name
+        self.owner = uuid.uuid4().hex
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    acquired_at REAL NOT NULL
+                )
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def acquire(self, min_gap: float) -> bool:
+        """Tomar el turno si el último se tomó hace al menos `min_gap` segundos"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT acquired_at FROM leases WHERE name = ?", (self.name,)).fetchone()
+            if row is not None and now - row[0] < min_gap:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute("INSERT OR REPLACE INTO leases (name, owner, acquired_at) VALUES (?, ?, ?)",
+                         (self.name, self.owner, now))
+            conn.execute("COMMIT")
+            return True
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            logger.warning(f"Error en el turno de limpieza, se limpia sin coordinar: {e}")
+            return True
+        finally:
+            conn.close()
+
+
+class OutputStore:
+    """Salidas en `directory/ab/cd/<hash>.<ext>` con expulsión por edad, número y bytes
+
+    La fecha de modificación hace de último uso: reutilizar una salida la
+    actualiza, así que la limpieza expulsa primero las menos usadas.
+    """
+
+    def __init__(self, directory: str = DEFAULT_OUTPUT_DIR, max_age: float = DEFAULT_OUTPUT_MAX_AGE,
+                 max_files: int = DEFAULT_MAX_OUTPUT_FILES, max_bytes: int = DEFAULT_MAX_OUTPUT_BYTES):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.reused = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._etags: Dict[Tuple[str, int, int], str] = {}
+        os.makedirs(os.path.join(directory, NAMED_DIR), exist_ok=True)
+
+    @staticmethod
+    def name_for(content_hash: str, crop_box: Tuple[int, int, int, int], size: Tuple[int, int],
+                 encoding: str, extension: str = "jpg") -> str:
+        """Nombre de la salida: hash del contenido de origen, del formato y de la codificación"""
+        params = f"{OUTPUT_STORE_VERSION}:{content_hash}:{list(crop_box)}:{size[0]}x{size[1]}:{encoding}"
+        return f"{hashlib.sha1(params.encode('utf-8')).hexdigest()}.{extension}"
+
+    @staticmethod
+    def is_valid_name(name: str) -> bool:
+        return bool(_NAME_PATTERN.match(name))
+
+    def path_for(self, name: str) -> str:
+        """Ruta (repartida en subdirectorios) de una salida del almacén"""
+        if not self.is_valid_name(name):
+            raise ValueError(f"Nombre de salida no válido: {name}")
+        return os.path.join(self.directory, name[:2], name[2:4], name)
+
+    def named_path(self, filename: str) -> str:
+        """Ruta dentro del almacén para una salida con nombre elegido por el cliente"""
+        if not _CUSTOM_NAME_PATTERN.match(filename):
+            raise ValueError(f"Nombre de archivo no válido: {filename}")
+        return os.path.join(self.directory, NAMED_DIR, filename)
+
+    def resolve(self, filename: str) -> Optional[str]:
+        """Ruta en disco de una salida a partir de su nombre público, o None si no existe
+
+        Solo se resuelven nombres del almacén (hash o nombre elegido, sin rutas),
+        así que no se puede salir de `directory`.
+        """
+        try:
+            path = self.path_for(filename) if self.is_valid_name(filename) else self.named_path(filename)
+        except ValueError:
+            return None
+        root = os.path.realpath(self.directory)
+        if not os.path.realpath(path).startswith(root + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def public_name(self, path: str) -> Optional[str]:
+        """Nombre público de una salida del almacén, o None si la ruta está fuera del almacén"""
+        directory = os.path.dirname(os.path.abspath(path))
+        name = os.path.basename(path)
+        if self.is_valid_name(name) and directory == os.path.dirname(os.path.abspath(self.path_for(name))):
+            return name
+        if directory == os.path.abspath(os.path.join(self.directory, NAMED_DIR)):
+            return name
+        return None
+
+    def etag_for(self, path: str) -> str:
+        """ETag fuerte de una salida
+
+        En las direccionadas por contenido es el propio hash del nombre; en las
+        de nombre elegido (que pueden sobrescribirse) el SHA-256 del archivo.
+        """
+        name = os.path.basename(path)
+        if self.is_valid_name(name):
+            return f'"{name.split(".")[0]}"'
+        stat = os.stat(path)
+        cache_key = (path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            etag = self._etags.get(cache_key)
+        if etag is None:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            etag = f'"{digest.hexdigest()[:40]}"'
+            with self._lock:
+                if len(self._etags) >= 1024:
+                    self._etags.clear()
+                self._etags[cache_key] = etag
+        return etag
+
+    def is_immutable(self, path: str) -> bool:
+        """Las salidas direccionadas por contenido nunca cambian de contenido"""
+        return self.is_valid_name(os.path.basename(path))
+
+    def lookup(self, name: str) -> Optional[str]:
+        """Ruta de una salida existente (marcándola como usada), o None"""
+        path = self.path_for(name)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        with self._lock:
+            self.reused += 1
+        return path
+
+    def save(self, name: str, data: bytes) -> str:
+        """Guardar una salida ya codificada de forma atómica; devuelve su ruta"""
+        path = self.path_for(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self.written += 1
+        return path
+
+    def _scan(self) -> List[Tuple[float, int, str]]:
+        """(mtime, bytes, ruta) de cada salida del almacén"""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def cleanup(self) -> Dict[str, int]:
+        """Eliminar salidas caducadas y, de las más antiguas a las más nuevas, las que excedan los límites
+
+        Los .tmp no cuentan para los límites ni se expulsan con las salidas: solo
+        se borran pasado TEMP_GRACE_PERIOD, para no romper un `save` en curso.
+        """
+        now = time.time()
+        removed = 0
+        files = []
+        for mtime, size, path in sorted(self._scan()):
+            if not path.endswith(".tmp"):
+                files.append((mtime, size, path))
+            elif now - mtime > TEMP_GRACE_PERIOD:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+        total_bytes = sum(size for _, size, _ in files)
+        remaining = len(files)
+        for mtime, size, path in files:
+            expired = self.max_age and now - mtime > self.max_age
+            over_count = self.max_files and remaining > self.max_files
+            over_bytes = self.max_bytes and total_bytes > self.max_bytes
+            if not (expired or over_count or over_bytes):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+            remaining -= 1
+            total_bytes -= size
+        with self._lock:
+            self.evicted += removed
+        if removed:
+            logger.info(f"Limpieza de salidas: {removed} archivos eliminados, quedan {remaining}")
+        return {"removed": removed, "files": remaining, "bytes": total_bytes}
+
+    def start_cleanup(self, interval: float, lease: Optional[CleanupLease] = None) -> None:
+        """Ejecutar la limpieza en segundo plano cada `interval` segundos
+
+        Con `lease`, solo cuando este proceso obtiene el turno (uno por intervalo
+        entre todos los workers).
+        """
+        if interval <= 0 or self._thread is not None:
+            return
+
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    # Medio intervalo de margen: los workers no se despiertan a la vez
+                    if lease is None or lease.acquire(interval / 2):
+                        self.cleanup()
+                except Exception as e:
+                    logger.warning(f"Error en la limpieza de salidas: {e}")
+
+        self._thread = threading.Thread(target=loop, name="limpieza-salidas", daemon=True)
+        self._thread.start()
+
+    def stop_cleanup(self) -> None:
+        self._stop.set()
+
+    def stats(self) -> Dict[str, Any]:
+        """Salidas escritas, reutilizadas y expulsadas por este proceso"""
+        with self._lock:
+            return {"written": self.written, "reused": self.reused, "evicted": self.evicted}
+
+
+def get_cleanup_lease() -> Optional[CleanupLease]:
+    """Turno de limpieza compartido (CLEANUP_LEASE_PATH), o None si no se puede crear"""
+    try:
+        return CleanupLease(os.getenv("CLEANUP_LEASE_PATH", DEFAULT_CLEANUP_LEASE_PATH))
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"No se pudo inicializar el turno de limpieza: {e}")
+        return None
+
+
+def get_output_store() -> OutputStore:
+    """Crear el almacén de salidas a partir de variables de entorno"""
+    return OutputStore(
+        directory=os.getenv("OUTPUT_DIR", DEFAULT_OUTPUT_DIR),
+        max_age=float(os.getenv("MAX_OUTPUT_AGE", DEFAULT_OUTPUT_MAX_AGE)),
+        max_files=int(os.getenv("MAX_OUTPUT_FILES", DEFAULT_MAX_OUTPUT_FILES)),
+        max_bytes=int(os.getenv("MAX_OUTPUT_BYTES", DEFAULT_MAX_OUTPUT_BYTES)),
+    )
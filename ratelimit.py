@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Control del tráfico hacia Gemini
+- Token bucket por API key, en el proceso o compartido entre workers vía SQLite
+- Reintentos con backoff exponencial y jitter
+- Circuit breaker para dejar de llamar a Gemini mientras falla
+"""
+
+import os
+import time
+import random
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import logging
+from typing import Callable, Dict, Any, Tuple, Type, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+DEFAULT_RATE_LIMIT_PATH = os.path.join(tempfile.gettempdir(), "instagram-cropper", "ratelimit.sqlite3")
+
+
+def bucket_key(api_key: str) -> str:
+    """Identificador del bucket de una API key (no se guarda la key en claro)"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+class RateLimiter:
+    """Token bucket por clave: `rate_per_minute` peticiones sostenidas con ráfagas de hasta `burst`
+
+    El estado vive en memoria, así que cada worker de uvicorn tiene su propia cuota.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int = 1):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def _take(self, key: str, now: float) -> float:
+        """Consumir un token si hay; devuelve 0 o los segundos hasta el siguiente token"""
+        tokens, updated = self._buckets.get(key, (float(self.capacity), now))
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now)
+            return 0.0
+        self._buckets[key] = (tokens, now)
+        return (1 - tokens) / self.rate
+
+    def acquire(self, key: str = "") -> float:
+        """Bloquear hasta obtener un token; devuelve los segundos esperados"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                wait = self._take(key, time.monotonic())
+            if not wait:
+                if waited:
+                    logger.info(f"Límite de Gemini: esperados {waited:.2f}s")
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+
+class SharedRateLimiter(RateLimiter):
+    """Token bucket por clave guardado en SQLite, compartido por todos los workers de uvicorn
+
+    Cada toma de token es una transacción BEGIN IMMEDIATE, así que los procesos
+    se serializan sobre el lock de escritura de la base de datos. Si SQLite
+    falla, se deja pasar la petición antes que bloquear el procesamiento.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int = 1, path: str = DEFAULT_RATE_LIMIT_PATH):
+        super().__init__(rate_per_minute, burst)
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def _take(self, key: str, now: float) -> float:
+        # Reloj de pared: time.monotonic() no es comparable entre procesos
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (float(self.capacity), now)
+            tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                         (key, tokens, now))
+            conn.execute("COMMIT")
+            return wait
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            logger.warning(f"Error en el limitador compartido, se omite el límite: {e}")
+            return 0.0
+        finally:
+            conn.close()
+
+
+def retry_with_backoff(func: Callable[[], T], attempts: int = 3, base_delay: float = 1.0,
+                       max_delay: float = 30.0, retry_on: Tuple[Type[BaseException], ...] = (Exception,)) -> T:
+    """Ejecutar `func` reintentando los errores `retry_on` con backoff exponencial
+
+    Se usa "full jitter": cada espera es aleatoria entre 0 y base*2^intento, para
+    que los workers que fallan a la vez no reintenten todos al mismo tiempo.
+    """
+    for attempt in range(attempts):
+        try:
+            return func()
+        except retry_on as e:
+            if attempt == attempts - 1:
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            logger.warning(f"Reintentando en {delay:.2f}s (intento {attempt + 1}/{attempts}): {e}")
+            time.sleep(delay)
+
+
+# Estados del circuit breaker
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Circuit breaker: tras `failure_threshold` fallos seguidos deja de llamar a Gemini
+
+    Abierto durante `reset_timeout` segundos; después deja pasar una petición de
+    prueba (half_open) y se cierra si sale bien o se vuelve a abrir si falla.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """¿Se puede llamar a Gemini ahora?"""
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = HALF_OPEN
+                self._probing = False
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info("Circuit breaker de Gemini cerrado")
+            self._state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    logger.warning(f"Circuit breaker de Gemini abierto tras {self._failures} fallos")
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def stats(self) -> Dict[str, Any]:
+        state = self.state
+        with self._lock:
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "retry_in_seconds": round(max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at)), 1)
+                if state == OPEN else 0.0,
+            }
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Deduplicación de peticiones idénticas simultáneas (single-flight)
+Si varias peticiones piden lo mismo a la vez, solo una (la líder) hace el
+trabajo; el resto espera y comparte su resultado. Dentro de un proceso se
+coordina con eventos, y entre workers de uvicorn con una tabla SQLite.
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import tempfile
+import threading
+import logging
+from typing import Optional, Dict, Any, Callable, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+DEFAULT_FLIGHTS_PATH = os.path.join(tempfile.gettempdir(), "instagram-cropper", "flights.sqlite3")
+
+
+class _Call:
+    """Cómputo en curso dentro de este proceso"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.failed = False
+
+
+class SingleFlight:
+    """Coalescer llamadas concurrentes con la misma clave
+
+    `do(key, func)` ejecuta `func` una sola vez por clave mientras esté en
+    curso. Con `path`, la coordinación se extiende a otros procesos: el
+    resultado se guarda serializado (`encode`/`decode`) en SQLite y los
+    seguidores lo sondean. Si la líder muere, su turno caduca tras
+    `lease_timeout` segundos. Si la líder falla, cada seguidor ejecuta `func`
+    por su cuenta (igual que sin deduplicación).
+
+    Solo se comparte con quien llegó mientras la llamada estaba en curso: una
+    llamada posterior con la misma clave hace su propio trabajo aunque el
+    resultado anterior siga en SQLite. Esa fila solo se conserva `result_ttl`
+    segundos para que los seguidores de otros workers alcancen a leerla.
+    """
+
+    def __init__(self, path: Optional[str] = None, lease_timeout: float = 120,
+                 poll_interval: float = 0.05, result_ttl: float = 5):
+        self.path = path
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl
+        self.leaders = 0
+        self.shared = 0
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS flights (
+                        key TEXT PRIMARY KEY,
+                        owner TEXT NOT NULL,
+                        started_at REAL NOT NULL,
+                        finished_at REAL,
+                        result TEXT,
+                        failed INTEGER NOT NULL DEFAULT 0
+                    )
+                """)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def do(self, key: str, func: Callable[[], T], encode: Callable[[T], Any] = lambda value: value,
+           decode: Callable[[Any], T] = lambda value: value) -> Tuple[T, bool]:
+        """Ejecutar `func` o esperar a la llamada en curso; devuelve (resultado, compartido)"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.failed:
+                return func(), False
+            self._count(shared=True)
+            logger.info(f"Petición coalescida con otra en curso: {key}")
+            return call.result, True
+
+        try:
+            result, shared = self._run(key, func, encode, decode)
+            call.result = result
+        except BaseException:
+            call.failed = True
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        self._count(shared=shared)
+        return result, shared
+
+    def _run(self, key, func, encode, decode) -> Tuple[Any, bool]:
+        """Líder de este proceso: coordinarse con los demás procesos (si hay SQLite)"""
+        if not self.path:
+            return func(), False
+
+        owner = uuid.uuid4().hex
+        # Dueña de la llamada en curso a la que esperamos (None: aún no esperamos a ninguna)
+        waiting_for = None
+        while True:
+            try:
+                row = self._claim(key, owner, waiting_for)
+            except sqlite3.Error as e:
+                logger.warning(f"Error en el registro de single-flight, se ejecuta sin coalescer: {e}")
+                return func(), False
+            if row is None:
+                break
+            if row["finished_at"] is not None:
+                if row["failed"]:
+                    return func(), False
+                logger.info(f"Resultado compartido por otro worker: {key}")
+                return decode(json.loads(row["result"])), True
+            waiting_for = row["owner"]
+            time.sleep(self.poll_interval)
+
+        try:
+            result = func()
+        except BaseException:
+            self._finish(key, owner, None, failed=True)
+            raise
+        self._finish(key, owner, json.dumps(encode(result), ensure_ascii=False))
+        return result, False
+
+    def _claim(self, key: str, owner: str, waiting_for: Optional[str] = None) -> Optional[sqlite3.Row]:
+        """Tomar el turno de `key`; devuelve None si lo obtuvimos o la fila de la líder actual
+
+        Una llamada ya terminada solo se devuelve si es la que `waiting_for`
+        vio en curso; si no, su resultado es de una petición anterior y se
+        toma el turno.
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM flights WHERE finished_at < ?", (now - self.result_ttl,))
+            row = conn.execute("SELECT * FROM flights WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                running = finished = False
+            else:
+                finished = row["finished_at"] is not None
+                running = not finished and now - row["started_at"] < self.lease_timeout
+            if running or (finished and row["owner"] == waiting_for):
+                conn.execute("COMMIT")
+                return row
+            conn.execute(
+                "INSERT OR REPLACE INTO flights (key, owner, started_at) VALUES (?, ?, ?)",
+                (key, owner, now)
+            )
+            conn.execute("COMMIT")
+            return None
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _finish(self, key: str, owner: str, result: Optional[str], failed: bool = False) -> None:
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "UPDATE flights SET finished_at = ?, result = ?, failed = ? WHERE key = ? AND owner = ?",
+                    (time.time(), result, int(failed), key, owner)
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Error guardando el resultado de single-flight: {e}")
+
+    def _count(self, shared: bool) -> None:
+        with self._lock:
+            if shared:
+                self.shared += 1
+            else:
+                self.leaders += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Peticiones ejecutadas y coalescidas en este proceso"""
+        with self._lock:
+            return {"executed": self.leaders, "coalesced": self.shared, "in_flight": len(self._calls)}
+
+
+def get_single_flight() -> Optional[SingleFlight]:
+    """Crear el coalescedor según SINGLE_FLIGHT_BACKEND (sqlite, memory u off)"""
+    backend = os.getenv("SINGLE_FLIGHT_BACKEND", "sqlite").lower()
+    if backend == "off":
+        return None
+    lease_timeout = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", "120"))
+    if backend == "memory":
+        return SingleFlight(lease_timeout=lease_timeout)
+    try:
+        return SingleFlight(path=os.getenv("SINGLE_FLIGHT_PATH", DEFAULT_FLIGHTS_PATH), lease_timeout=lease_timeout)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"No se pudo inicializar single-flight en SQLite, se usa solo en memoria: {e}")
+        return SingleFlight(lease_timeout=lease_timeout)
@@ -6,6 +6,7 @@ Cliente de ejemplo para probar la API de Instagram Image Cropper
 import requests
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Configuración de la API
 API_BASE_URL = "http://localhost:8000"
@@ -78,6 +79,547 @@ def test_download():
         print(f"Error: {response.text}")
     print()
 
+def _api_in_process(monkeypatch, tmp_path, analyzer):
+    """Importar la API con estado aislado en `tmp_path` y `analyzer` como backend de todos los procesadores"""
+    import api
+    from main import ImageProcessor
+    from outputs import OutputStore
+    from singleflight import SingleFlight
+
+    def processor_with_analyzer(*args, **kwargs):
+        kwargs["analyzer"] = analyzer
+        return ImageProcessor(*args, **kwargs)
+
+    monkeypatch.setattr(api, "ImageProcessor", processor_with_analyzer)
+    monkeypatch.setattr(api, "processor_pool", api.ProcessorPool())
+    monkeypatch.setattr(api, "single_flight", SingleFlight(path=str(tmp_path / "flights.sqlite3")))
+    monkeypatch.setattr(api, "analysis_cache", None)
+    monkeypatch.setattr(api, "download_cache", None)
+    monkeypatch.setattr(api, "output_store", OutputStore(str(tmp_path / "outputs")))
+    return api
+
+def _sample_image(tmp_path):
+    from PIL import Image
+    path = tmp_path / "diptico.jpg"
+    Image.new("RGB", (2400, 1200), (90, 30, 160)).save(path, "JPEG")
+    return str(path)
+
+def test_single_flight(monkeypatch, tmp_path, n=8):
+    """N peticiones idénticas simultáneas hacen un solo análisis y reciben el mismo resultado"""
+    from analyzers import FakeAnalyzer
+    analyzer = FakeAnalyzer(latency=0.5, spec="fake")
+    api = _api_in_process(monkeypatch, tmp_path, analyzer)
+    source = _sample_image(tmp_path)
+    
+    with ThreadPoolExecutor(max_workers=n) as executor:
+        results = list(executor.map(lambda _: api.process_url("key", source, None, "gemini"), range(n)))
+    
+    assert analyzer.calls == 1
+    served_by = [result.served_by for result in results]
+    assert served_by.count("coalesced") == n - 1
+    assert len({result.output_path for result in results}) == 1
+    assert all(result.crop_coordinates == results[0].crop_coordinates for result in results)
+    assert all(result.analysis == results[0].analysis for result in results)
+    
+    # Una petición posterior (no simultánea) hace su propio trabajo
+    later = api.process_url("key", source, None, "gemini")
+    assert later.served_by != "coalesced"
+
+def test_single_flight_distinct_requests(monkeypatch, tmp_path):
+    """Peticiones simultáneas con otro motor u otra codificación no comparten el resultado"""
+    from analyzers import FakeAnalyzer
+    from encoding import EncodeOptions
+    api = _api_in_process(monkeypatch, tmp_path, FakeAnalyzer(latency=0.5, spec="fake"))
+    source = _sample_image(tmp_path)
+    # Si cada petición a nivel de URL fue líder o compartió el resultado de otra
+    url_shared = []
+    do = api.single_flight.do
+    
+    def recording_do(key, func, **kwargs):
+        result, shared = do(key, func, **kwargs)
+        if key.startswith("url:"):
+            url_shared.append(shared)
+        return result, shared
+    
+    monkeypatch.setattr(api.single_flight, "do", recording_do)
+    variants = [
+        ("gemini", EncodeOptions(format="jpeg")),
+        ("gemini", EncodeOptions(format="webp")),
+        ("local", EncodeOptions(format="jpeg")),
+    ]
+    
+    with ThreadPoolExecutor(max_workers=len(variants)) as executor:
+        results = list(executor.map(
+            lambda variant: api.process_url("key", source, None, variant[0], encoding=variant[1]), variants
+        ))
+    
+    # El análisis de la imagen puede compartirse, pero cada petición genera su propio resultado
+    assert url_shared == [False] * len(variants)
+    assert results[0].renditions["square"]["format"] == "jpeg"
+    assert results[1].renditions["square"]["format"] == "webp"
+    assert results[2].served_by == "local"
+
+def test_watch_same_stem(tmp_path):
+    """En la carpeta vigilada, `foto.jpg` y `foto.png` generan salidas distintas"""
+    import threading
+    import time
+    from PIL import Image
+    from analyzers import FakeAnalyzer
+    from main import IMAGE_EXTENSIONS, ImageProcessor, watch_handler
+    from watcher import MANIFEST_NAME, HotFolder, Manifest
+    watched, output_dir = tmp_path / "exportacion", tmp_path / "recortes"
+    watched.mkdir()
+    output_dir.mkdir()
+    Image.new("RGB", (1200, 800), (200, 40, 40)).save(watched / "foto.jpg", "JPEG")
+    Image.new("RGB", (800, 1200), (40, 40, 200)).save(watched / "foto.png", "PNG")
+    processor = ImageProcessor("", analyzer=FakeAnalyzer(spec="fake"))
+    manifest = Manifest(str(output_dir / MANIFEST_NAME))
+    folder = HotFolder(str(watched), watch_handler(processor, str(output_dir), ["square", "story"]), manifest,
+                       IMAGE_EXTENSIONS, workers=2, poll_interval=0.1, settle=0)
+    
+    thread = threading.Thread(target=folder.run)
+    thread.start()
+    deadline = time.time() + 30
+    while folder.processed + folder.failed < 2 and time.time() < deadline:
+        time.sleep(0.05)
+    folder.stop.set()
+    thread.join()
+    
+    assert (folder.processed, folder.failed) == (2, 0)
+    outputs = [entry["outputs"] for entry in Manifest(str(output_dir / MANIFEST_NAME)).entries.values()]
+    names = [name for entry in outputs for name in entry.values()]
+    assert len(set(names)) == 4
+    assert all((output_dir / name).is_file() for name in names)
+    assert {entry["square"] for entry in outputs} == {"foto.jpg.jpg", "foto.png.jpg"}
+
+def test_analysis_cache_engine(tmp_path):
+    """El motor local no recibe análisis de Gemini guardados en la caché"""
+    from PIL import Image
+    from analyzers import FakeAnalyzer
+    from cache import AnalysisCache
+    from main import ImageProcessor
+    image = Image.open(_sample_image(tmp_path))
+    analyzer = FakeAnalyzer(spec="gemini:fake")
+    processor = ImageProcessor("key", cache=AnalysisCache(str(tmp_path / "cache.sqlite3")), analyzer=analyzer)
+    
+    assert processor.analyze_with_cache(image, "gemini")[2] == "gemini"
+    assert processor.analyze_with_cache(image, "gemini")[2] == "cache"
+    assert processor.analyze_with_cache(image, "local")[2] == "local"
+    assert analyzer.calls == 1
+
+def test_analysis_cache_key():
+    """Fotos distintas con el mismo hash perceptual no comparten entrada en la caché"""
+    from PIL import Image
+    from cache import AnalysisCache, perceptual_hash
+    dark = Image.new("RGB", (1200, 800), (10, 10, 10))
+    light = Image.new("RGB", (1200, 800), (240, 240, 240))
+    
+    assert perceptual_hash(dark) == perceptual_hash(light)
+    assert AnalysisCache.key_for(dark, "gemini") != AnalysisCache.key_for(light, "gemini")
+    assert AnalysisCache.key_for(dark, "gemini") == AnalysisCache.key_for(dark.copy(), "gemini")
+    dark.info["content_hash"] = "abc"
+    assert AnalysisCache.key_for(dark, "gemini").endswith(":abc")
+
+def test_full_decode_releases_reduced(tmp_path):
+    """Al volver a decodificar a resolución completa se libera antes la reserva de la reducida"""
+    from PIL import Image
+    from admission import MemoryBudget, estimate_decoded_bytes
+    from analyzers import FakeAnalyzer
+    from main import ImageProcessor
+    path = tmp_path / "grande.jpg"
+    Image.new("RGB", (4800, 2400), (90, 30, 160)).save(path, "JPEG")
+    full = estimate_decoded_bytes((4800, 2400), "RGB")
+    # Caben la completa o la reducida, pero no las dos a la vez
+    budget = MemoryBudget(capacity=full + full // 8, timeout=0.2)
+    analyzer = FakeAnalyzer(responses=[{"caja_corte": [0.4, 0.4, 0.6, 0.6]}], spec="fake")
+    processor = ImageProcessor("", analyzer=analyzer, memory_budget=budget)
+    
+    result, encoded = processor.process_to_bytes(str(path), renditions=["square"])
+    
+    assert result.crop_coordinates and encoded["square"]
+    assert budget.peak == full and budget.in_use == 0 and budget.rejected == 0
+
+def test_solve_crop():
+    """Prioridad de las cajas a conservar, escala 0-1000 y centrado en el lado del díptico"""
+    from crop_solver import CropConstraints, normalize_box, solve_crop
+    from main import crop_constraints
+    left_box, right_box = (0.05, 0.2, 0.15, 0.4), (0.85, 0.2, 0.95, 0.4)
+    
+    # Las dos cajas no caben en el mismo cuadrado: manda la primera
+    crop = solve_crop(CropConstraints(must_keep=(left_box, right_box), margin=0), 3000, 1000)
+    assert crop[2] - crop[0] == crop[3] - crop[1] == 1000
+    assert crop[0] <= 150 and crop[2] >= 450
+    crop = solve_crop(CropConstraints(must_keep=(right_box, left_box), margin=0), 3000, 1000)
+    assert crop[0] <= 2550 and crop[2] >= 2850
+    
+    # Cajas en la escala 0-1000 que Gemini usa por defecto
+    assert normalize_box([100, 200, 300, 400]) == [0.1, 0.2, 0.3, 0.4]
+    assert normalize_box([0, 0, 1001, 10]) is None
+    assert crop_constraints({"caja_sujeto": [100, 200, 300, 400]}).must_keep == ((0.1, 0.2, 0.3, 0.4),)
+    
+    # Díptico: centrado en el lado elegido, cortado por la división real
+    diptych = {"imagen_dividida": True, "lado_importante": "derecha"}
+    assert solve_crop(crop_constraints(diptych), 3000, 1000) == (1750, 0, 2750, 1000)
+    diptych["posicion_division"] = 0.6
+    assert solve_crop(crop_constraints(diptych), 3000, 1000) == (1900, 0, 2900, 1000)
+
+def test_search_quality():
+    """La bisección elige la calidad más baja cuyo SSIM alcanza el umbral"""
+    from io import BytesIO
+    from PIL import Image
+    from encoding import EncodeOptions, _luma, encode_image, ssim
+    size = (512, 512)
+    image = Image.merge("RGB", (Image.linear_gradient("L").resize(size), Image.effect_noise(size, 30),
+                                Image.radial_gradient("L").resize(size)))
+    reference = _luma(image)
+    score = lambda data: ssim(reference, _luma(Image.open(BytesIO(data))))
+    options = EncodeOptions(quality=95, target_ssim=0.95, min_quality=20)
+    
+    data, quality = encode_image(image, options)
+    
+    assert options.min_quality < quality < options.quality
+    assert score(data) >= options.target_ssim
+    assert score(encode_image(image, EncodeOptions(quality=quality - 1))[0]) < options.target_ssim
+    # Si ni la calidad máxima alcanza el umbral, se usa esa
+    assert encode_image(image, EncodeOptions(quality=30, target_ssim=0.9999, min_quality=20))[1] == 30
+
+def test_download_cache_revalidation(tmp_path):
+    """La caché de descargas respeta max-age y Expires y revalida con ETag/Last-Modified"""
+    import time
+    from email.utils import formatdate
+    from httpcache import DownloadCache
+    cache = DownloadCache(str(tmp_path / "descargas"))
+    sent = []
+    
+    def server(status, headers, body=None):
+        def download(validators):
+            sent.append(validators)
+            return status, headers, body
+        return download
+    
+    def unreachable(validators):
+        raise AssertionError("No debería descargar")
+    
+    # max-age: fresca, se sirve sin descargar
+    assert cache.fetch("https://cdn/a.jpg", server(200, {"Cache-Control": "max-age=60"}, b"a")) == b"a"
+    assert cache.fetch("https://cdn/a.jpg", unreachable) == b"a"
+    
+    # no-cache: se revalida en cada uso y el 304 sirve el cuerpo guardado (y renueva la frescura)
+    modified = formatdate(time.time() - 3600, usegmt=True)
+    headers = {"Cache-Control": "no-cache", "ETag": '"b1"', "Last-Modified": modified}
+    cache.fetch("https://cdn/b.jpg", server(200, headers, b"b"))
+    assert cache.fetch("https://cdn/b.jpg", server(304, {"Cache-Control": "max-age=60"})) == b"b"
+    assert sent[-1] == {"If-None-Match": '"b1"', "If-Modified-Since": modified}
+    assert cache.fetch("https://cdn/b.jpg", unreachable) == b"b"
+    
+    # Expires futuro: fresca; Expires pasado: se revalida y un 200 reemplaza el cuerpo
+    cache.fetch("https://cdn/c.jpg", server(200, {"Expires": formatdate(time.time() + 60, usegmt=True)}, b"c"))
+    assert cache.fetch("https://cdn/c.jpg", unreachable) == b"c"
+    cache.fetch("https://cdn/d.jpg", server(200, {"Expires": formatdate(time.time() - 60, usegmt=True),
+                                                  "ETag": '"d1"'}, b"d1"))
+    assert cache.fetch("https://cdn/d.jpg", server(200, {"ETag": '"d2"'}, b"d2")) == b"d2"
+    assert sent[-1] == {"If-None-Match": '"d1"'}
+    assert (cache.hits, cache.revalidated, cache.misses) == (3, 1, 5)
+
+def test_output_store_cleanup(tmp_path):
+    """La limpieza expulsa por edad, número y bytes (las más antiguas primero) y respeta los .tmp en curso"""
+    import os
+    import time
+    from outputs import TEMP_GRACE_PERIOD, OutputStore
+    now = time.time()
+    
+    def fill(store, ages, size=100):
+        paths = []
+        for index, age in enumerate(ages):
+            path = store.save(OutputStore.name_for(f"h{index}", (0, 0, 1, 1), (1, 1), "95"), b"x" * size)
+            os.utime(path, (now - age, now - age))
+            paths.append(path)
+        return paths
+    
+    store = OutputStore(str(tmp_path / "edad"), max_age=3600, max_files=0, max_bytes=0)
+    old, new = fill(store, [7200, 60])
+    assert store.cleanup()["removed"] == 1
+    assert not os.path.exists(old) and os.path.exists(new)
+    
+    store = OutputStore(str(tmp_path / "numero"), max_age=0, max_files=2, max_bytes=0)
+    paths = fill(store, [30, 20, 10])
+    assert store.cleanup() == {"removed": 1, "files": 2, "bytes": 200}
+    assert [os.path.exists(path) for path in paths] == [False, True, True]
+    
+    store = OutputStore(str(tmp_path / "bytes"), max_age=0, max_files=0, max_bytes=250)
+    paths = fill(store, [30, 20, 10])
+    assert store.cleanup() == {"removed": 1, "files": 2, "bytes": 200}
+    assert [os.path.exists(path) for path in paths] == [False, True, True]
+    
+    # Un .tmp reciente (escritura en curso) no cuenta ni se borra; uno huérfano sí se borra
+    store = OutputStore(str(tmp_path / "tmp"), max_age=0, max_files=2, max_bytes=0)
+    paths = fill(store, [20, 10])
+    writing, orphan = paths[0] + ".1.2.tmp", paths[1] + ".3.4.tmp"
+    for path, age in ((writing, 0), (orphan, TEMP_GRACE_PERIOD + 60)):
+        with open(path, "wb") as f:
+            f.write(b"x" * 100)
+        os.utime(path, (now - age, now - age))
+    assert store.cleanup() == {"removed": 1, "files": 2, "bytes": 200}
+    assert os.path.exists(writing) and not os.path.exists(orphan)
+    assert all(os.path.exists(path) for path in paths)
+
+def test_rate_limiting(monkeypatch):
+    """Token bucket, reintentos con backoff y estados del circuit breaker, con un reloj simulado"""
+    import time
+    from types import SimpleNamespace
+    import ratelimit
+    from ratelimit import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, RateLimiter, retry_with_backoff
+    clock, sleeps = [1000.0], []
+    
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+    
+    # Solo el reloj de ratelimit: los hilos de otras pruebas siguen con el real
+    monkeypatch.setattr(ratelimit, "time", SimpleNamespace(monotonic=lambda: clock[0], sleep=sleep, time=time.time))
+    
+    # 60/min con ráfagas de 2: dos tokens inmediatos, el tercero espera 1s; cada key tiene su bucket
+    limiter = RateLimiter(rate_per_minute=60, burst=2)
+    assert [limiter.acquire("a") for _ in range(3)] == [0.0, 0.0, 1.0]
+    assert limiter.acquire("b") == 0.0
+    
+    # Backoff con full jitter: esperas aleatorias acotadas por base*2^intento
+    sleeps.clear()
+    outcomes = iter([ValueError("1"), ValueError("2"), "ok"])
+    
+    def flaky():
+        outcome = next(outcomes)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    
+    assert retry_with_backoff(flaky, attempts=3, base_delay=1.0, retry_on=(ValueError,)) == "ok"
+    assert len(sleeps) == 2 and 0 <= sleeps[0] <= 1.0 and 0 <= sleeps[1] <= 2.0
+    sleeps.clear()
+    try:
+        retry_with_backoff(lambda: int("x"), attempts=3, base_delay=1.0, retry_on=(ValueError,))
+        assert False, "Debería lanzar ValueError"
+    except ValueError:
+        pass
+    assert len(sleeps) == 2
+    try:
+        retry_with_backoff(lambda: {}["x"], attempts=3, retry_on=(ValueError,))
+        assert False, "Debería lanzar KeyError"
+    except KeyError:
+        pass
+    assert len(sleeps) == 2
+    
+    # Circuit breaker: se abre tras 2 fallos, deja pasar una prueba y se cierra si sale bien
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    assert breaker.state == CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN and not breaker.allow()
+    clock[0] += 11
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow() and not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    clock[0] += 11
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.allow()
+
+def test_parse_analysis_text():
+    """Se interpreta el JSON rodeado de texto y, si no es válido, se pide una vez que se corrija"""
+    from types import SimpleNamespace
+    from analyzers import REPAIR_PROMPT, GeminiAnalyzer, parse_analysis_text
+    assert parse_analysis_text('{"imagen_dividida": true}') == {"imagen_dividida": True}
+    assert parse_analysis_text('Aquí está:\n```json\n{"a": [1, 2,],}\n```\nGracias') == {"a": [1, 2]}
+    assert parse_analysis_text('Respuesta: {"a": 1} fin') == {"a": 1}
+    try:
+        parse_analysis_text("sin json")
+        assert False, "Debería lanzar ValueError"
+    except ValueError:
+        pass
+    
+    class ScriptedModel:
+        def __init__(self, texts):
+            self.texts = list(texts)
+            self.requests = []
+        
+        def generate_content(self, contents, generation_config=None, request_options=None):
+            self.requests.append(contents)
+            return SimpleNamespace(text=self.texts.pop(0))
+    
+    model = ScriptedModel(["no es json", '{"imagen_dividida": false, "lado_importante": "centro"}'])
+    analysis = GeminiAnalyzer("key", model_name="fake", model=model).analyze(b"jpeg")
+    assert analysis["imagen_dividida"] is False
+    assert model.requests[1] == [REPAIR_PROMPT.format(expected="un objeto JSON", text="no es json")]
+    
+    model = ScriptedModel(["no es json", "tampoco"])
+    try:
+        GeminiAnalyzer("key", model_name="fake", model=model).analyze(b"jpeg")
+        assert False, "Debería lanzar ValueError"
+    except ValueError:
+        pass
+    assert len(model.requests) == 2
+
+def test_admission_http(monkeypatch, tmp_path):
+    """Una imagen que no cabe en el presupuesto da 413; con el presupuesto ocupado, 503 y Retry-After"""
+    from fastapi.testclient import TestClient
+    from PIL import Image
+    from admission import MemoryBudget
+    from analyzers import FakeAnalyzer
+    api = _api_in_process(monkeypatch, tmp_path, FakeAnalyzer(spec="fake"))
+    path = tmp_path / "grande.png"
+    Image.new("RGB", (2000, 1000), (90, 30, 160)).save(path, "PNG")
+    client = TestClient(api.app)
+    
+    def post(budget):
+        monkeypatch.setattr(api, "memory_budget", budget)
+        monkeypatch.setattr(api, "processor_pool", api.ProcessorPool())
+        with open(path, "rb") as f:
+            return client.post("/analyze-file", files={"file": ("grande.png", f, "image/png")},
+                               data={"api_key": "key"})
+    
+    # 6 MB decodificada: no cabe nunca en 4 MB
+    assert post(MemoryBudget(capacity=4 * 2 ** 20, timeout=0.1)).status_code == 413
+    
+    budget = MemoryBudget(capacity=16 * 2 ** 20, timeout=0.1, retry_after=7)
+    budget.acquire(12 * 2 ** 20)
+    response = post(budget)
+    assert response.status_code == 503 and response.headers["Retry-After"] == "7"
+    budget.release(12 * 2 ** 20)
+    assert post(budget).status_code == 200
+    assert budget.in_use == 0
+
+def test_manifest_torn_line(tmp_path):
+    """Una línea a medias del manifiesto se ignora y la siguiente escritura empieza en una línea nueva"""
+    import json
+    from watcher import Manifest
+    path = tmp_path / "manifest.jsonl"
+    path.write_text(json.dumps({"key": "a", "status": "ok"}) + '\n{"key": "b", "sta', encoding="utf-8")
+    
+    manifest = Manifest(str(path))
+    assert manifest.done("a") and not manifest.done("b")
+    manifest.record({"key": "b", "status": "ok"})
+    
+    reloaded = Manifest(str(path))
+    assert reloaded.done("a") and reloaded.done("b")
+    assert path.read_text(encoding="utf-8").splitlines()[-1] == json.dumps({"key": "b", "status": "ok"})
+
+def test_webhook_retries(monkeypatch):
+    """El webhook se reintenta con backoff, sin esperar tras el último intento"""
+    import time
+    from types import SimpleNamespace
+    import requests
+    import jobs
+    sleeps = []
+    monkeypatch.setattr(jobs, "time", SimpleNamespace(sleep=sleeps.append, time=time.time, monotonic=time.monotonic))
+    
+    def failing_post(*args, **kwargs):
+        raise requests.ConnectionError("sin conexión")
+    
+    monkeypatch.setattr(requests, "post", failing_post)
+    assert jobs.notify_webhook("https://cliente/webhook", {"job_id": "1"}, attempts=3) is False
+    assert sleeps == [1, 2]
+
+def test_job_metrics(monkeypatch, tmp_path):
+    """/metrics exporta la profundidad de la cola y los histogramas de espera y ejecución de los trabajos"""
+    from fastapi.testclient import TestClient
+    from analyzers import FakeAnalyzer
+    from jobs import JobQueue, MemoryJobStore
+    from metrics import Metrics
+    api = _api_in_process(monkeypatch, tmp_path, FakeAnalyzer(spec="fake"))
+    registry = Metrics()
+    monkeypatch.setattr(api, "metrics", registry)
+    monkeypatch.setattr("jobs.metrics", registry)
+    queue = JobQueue(MemoryJobStore(), lambda payload: {"ok": True})
+    monkeypatch.setattr(api, "job_queue", queue)
+    for _ in range(3):
+        queue.submit({})
+    
+    text = TestClient(api.app).get("/metrics").text
+    assert "# TYPE cropper_jobs_queue_depth gauge" in text
+    assert "cropper_jobs_queue_depth 3" in text
+    
+    queue._run(queue.store.claim())
+    text = TestClient(api.app).get("/metrics").text
+    assert "cropper_jobs_queue_depth 2" in text
+    assert "cropper_job_wait_seconds_count 1" in text
+    assert 'cropper_job_run_seconds_count{status="completed"} 1' in text
+
+def test_cleanup_lease(monkeypatch, tmp_path):
+    """En cada intervalo limpia un solo worker; la API arranca y para la limpieza con su lifespan"""
+    from fastapi.testclient import TestClient
+    from analyzers import FakeAnalyzer
+    from jobs import JobQueue, MemoryJobStore
+    from metrics import Metrics
+    from outputs import CleanupLease
+    path = str(tmp_path / "cleanup.sqlite3")
+    workers = [CleanupLease(path) for _ in range(4)]
+    
+    assert [lease.acquire(60) for lease in workers] == [True, False, False, False]
+    assert workers[2].acquire(0)
+    
+    api = _api_in_process(monkeypatch, tmp_path, FakeAnalyzer(spec="fake"))
+    monkeypatch.setattr(api, "job_queue", JobQueue(MemoryJobStore(), lambda payload: {}))
+    monkeypatch.setattr(api, "processing_executor", api.ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setattr(api, "metrics", Metrics())
+    monkeypatch.setenv("CLEANUP_LEASE_PATH", path)
+    monkeypatch.setenv("PRELOAD_GEMINI_SDK", "false")
+    with TestClient(api.app) as client:
+        assert client.get("/health").status_code == 200
+        assert api.output_store._thread is not None and api.output_store._thread.is_alive()
+    assert api.output_store._stop.is_set()
+
+def test_download_cache_unexpected_304(tmp_path):
+    """Un 304 sin haber enviado validadores no cuenta como acierto: se descarta la entrada y se descarga de nuevo"""
+    from httpcache import DownloadCache
+    cache = DownloadCache(str(tmp_path / "descargas"))
+    sent = []
+    
+    def server(*responses):
+        responses = iter(responses)
+        
+        def download(validators):
+            sent.append(validators)
+            return next(responses)
+        return download
+    
+    def expire():
+        with cache._connect() as conn:
+            conn.execute("UPDATE responses SET fresh_until = 0")
+    
+    # Entrada sin ETag ni Last-Modified: al caducar se pide sin cabeceras condicionales
+    cache.fetch("https://cdn/a.jpg", server((200, {"Cache-Control": "max-age=60"}, b"viejo")))
+    expire()
+    download = server((304, {}, None), (200, {"Cache-Control": "max-age=60"}, b"nuevo"))
+    assert cache.fetch("https://cdn/a.jpg", download) == b"nuevo"
+    assert sent[1:] == [{}, {}]
+    assert cache.fetch("https://cdn/a.jpg", server()) == b"nuevo"
+    assert cache.revalidated == 0
+    
+    expire()
+    try:
+        cache.fetch("https://cdn/a.jpg", server((304, {}, None), (304, {}, None)))
+        assert False, "Debería lanzar ValueError"
+    except ValueError:
+        pass
+    assert cache.stats()["entries"] == 0
+
+def test_cold_start_imports(tmp_path):
+    """Ni la CLI ni los workers de la API importan al arrancar las dependencias que se cargan en el primer uso"""
+    import os
+    import subprocess
+    import sys
+    from benchmark import LAZY_MODULES, STARTUP_COMMANDS, _parse_importtime
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, OUTPUT_DIR=str(tmp_path / "outputs"), METRICS_BACKEND="memory",
+               JOB_QUEUE_BACKEND="memory", SINGLE_FLIGHT_BACKEND="memory")
+    
+    for name, command in STARTUP_COMMANDS.items():
+        traced = subprocess.run([sys.executable, "-X", "importtime", *command], cwd=root, env=env,
+                                capture_output=True, text=True, check=True)
+        loaded = {module for module, _, _ in _parse_importtime(traced.stderr)}
+        assert not [module for module in LAZY_MODULES if module in loaded], name
+
 if __name__ == "__main__":
     print("🚀 Cliente de prueba para Instagram Image Cropper API")
     print("=" * 60)
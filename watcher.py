@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Carpeta vigilada (hot folder): procesar las imágenes que van llegando
+Un solo proceso de larga duración vigila un directorio con inotify (o, si no
+está disponible, revisándolo periódicamente) y reparte las imágenes nuevas en
+un pool de hilos persistente con un número acotado de imágenes en curso. Cada
+resultado se registra en un manifiesto JSONL junto a las salidas, así que al
+reiniciar no se vuelven a procesar las imágenes ya terminadas.
+"""
+
+import os
+import json
+import time
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Callable, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.jsonl"
+
+# Segundos sin modificarse para dar por terminado un archivo visto al revisar el directorio
+DEFAULT_SETTLE_SECONDS = 2.0
+DEFAULT_POLL_INTERVAL = 2.0
+# Con inotify también se revisa el directorio de vez en cuando (eventos perdidos)
+DEFAULT_RESCAN_INTERVAL = 60.0
+
+# inotify(7): archivo cerrado tras escribirlo o movido al directorio
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_Q_OVERFLOW = 0x00004000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct("iIII")
+
+# handler(ruta) -> datos del resultado para el manifiesto (lanza excepción si falla)
+Handler = Callable[[str], Dict[str, Any]]
+
+
+def file_key(name: str, stat: os.stat_result) -> str:
+    """Identidad de una versión de un archivo: nombre, tamaño y fecha de modificación"""
+    return f"{name}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Escribir un archivo de forma atómica (temporal + rename en el mismo directorio)"""
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+class Manifest:
+    """Registro JSONL de las imágenes procesadas (una línea por resultado, la última manda)
+
+    Cada línea se añade con O_APPEND y fsync; una línea a medias por un corte
+    de luz se ignora al leer, y esa imagen simplemente se vuelve a procesar.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        # Tras una línea a medias, la siguiente empieza en una línea nueva
+        self._torn = False
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    self._torn = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(entry, dict) and "key" in entry:
+                        self.entries[entry["key"]] = entry
+        except FileNotFoundError:
+            pass
+
+    def done(self, key: str) -> bool:
+        entry = self.entries.get(key)
+        return entry is not None and entry.get("status") == "ok"
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._torn:
+                line, self._torn = "\n" + line, False
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode("utf-8"))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.entries[entry["key"]] = entry
+
+
+class InotifyWatcher:
+    """Eventos de inotify del directorio (solo Linux), con ctypes y sin dependencias"""
+
+    def __init__(self, directory: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify no disponible")
+        self.fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), _IN_CLOSE_WRITE | _IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"inotify_add_watch: {directory}")
+
+    def wait(self, timeout: float) -> Optional[List[str]]:
+        """Nombres de archivos terminados en los próximos `timeout` s; None si hay que revisar el directorio"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                return None
+            if name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Alternativa a inotify: no hay eventos, solo revisiones periódicas del directorio"""
+
+    def __init__(self, interval: float = DEFAULT_POLL_INTERVAL, stop: Optional[threading.Event] = None):
+        self.interval = interval
+        self.stop = stop or threading.Event()
+        self._next_scan = time.time() + interval
+
+    def wait(self, timeout: float) -> Optional[List[str]]:
+        if self.stop.wait(timeout) or time.time() < self._next_scan:
+            return []
+        self._next_scan = time.time() + self.interval
+        return None
+
+    def close(self) -> None:
+        pass
+
+
+class HotFolder:
+    """Procesar las imágenes de `directory` a medida que llegan
+
+    Las imágenes se reparten en un pool de `workers` hilos; como mucho hay
+    `max_in_flight` en curso o en cola, y el bucle de vigilancia espera
+    (sin leer más eventos) mientras el pool está lleno. Cada versión de un
+    archivo (nombre, tamaño y fecha) se procesa una sola vez: las que ya
+    constan como terminadas en el manifiesto se saltan, y las que fallaron se
+    reintentan al reiniciar o si el archivo cambia.
+    """
+
+    def __init__(self, directory: str, handler: Handler, manifest: Manifest, extensions: Tuple[str, ...],
+                 workers: int = 4, max_in_flight: Optional[int] = None, poll_interval: Optional[float] = None,
+                 settle: float = DEFAULT_SETTLE_SECONDS, rescan_interval: float = DEFAULT_RESCAN_INTERVAL):
+        self.directory = directory
+        self.handler = handler
+        self.manifest = manifest
+        self.extensions = extensions
+        self.workers = workers
+        self.max_in_flight = max_in_flight or workers * 2
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.rescan_interval = rescan_interval
+        self.stop = threading.Event()
+        self.processed = 0
+        self.failed = 0
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._lock = threading.Lock()
+        self._in_flight: Set[str] = set()
+        self._failed_keys: Set[str] = set()
+
+    def _open_watcher(self):
+        """inotify salvo que se pida revisión periódica (`poll_interval`) o no esté disponible"""
+        if self.poll_interval is None:
+            try:
+                watcher = InotifyWatcher(self.directory)
+                logger.info(f"Vigilando {self.directory} con inotify")
+                return watcher
+            except (OSError, AttributeError) as e:
+                logger.warning(f"inotify no disponible ({e}): revisando el directorio periódicamente")
+        interval = self.poll_interval or DEFAULT_POLL_INTERVAL
+        logger.info(f"Vigilando {self.directory} cada {interval}s")
+        return PollingWatcher(interval, self.stop)
+
+    def _candidate(self, name: str) -> Optional[Tuple[str, str]]:
+        """(ruta, clave) si `name` es una imagen pendiente de procesar"""
+        if name.startswith(".") or not name.lower().endswith(self.extensions):
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        key = file_key(name, stat)
+        with self._lock:
+            if key in self._in_flight or key in self._failed_keys or self.manifest.done(key):
+                return None
+        return path, key
+
+    def scan(self) -> Tuple[List[Tuple[str, str]], bool]:
+        """Imágenes del directorio listas para procesar y si quedan otras aún escribiéndose"""
+        ready, pending = [], False
+        now = time.time()
+        for name in sorted(os.listdir(self.directory)):
+            candidate = self._candidate(name)
+            if candidate is None:
+                continue
+            try:
+                age = now - os.stat(candidate[0]).st_mtime
+            except OSError:
+                continue
+            if age >= self.settle:
+                ready.append(candidate)
+            else:
+                pending = True
+        return ready, pending
+
+    def submit(self, executor: ThreadPoolExecutor, path: str, key: str) -> None:
+        """Encolar una imagen, esperando a que haya hueco en el pool"""
+        while not self._slots.acquire(timeout=0.5):
+            if self.stop.is_set():
+                return
+        with self._lock:
+            if key in self._in_flight:
+                self._slots.release()
+                return
+            self._in_flight.add(key)
+        executor.submit(self._run, path, key)
+
+    def _run(self, path: str, key: str) -> None:
+        start = time.time()
+        entry: Dict[str, Any] = {"key": key, "source": os.path.basename(path)}
+        try:
+            entry.update(self.handler(path))
+            entry["status"] = "ok"
+        except Exception as e:
+            logger.error(f"Error procesando {path}: {e}")
+            entry.update(status="error", error=str(e))
+        entry.update(processing_time=round(time.time() - start, 2), finished_at=round(time.time(), 3))
+        try:
+            self.manifest.record(entry)
+        except OSError as e:
+            logger.error(f"Error escribiendo el manifiesto: {e}")
+        with self._lock:
+            self._in_flight.discard(key)
+            if entry["status"] == "ok":
+                self.processed += 1
+            else:
+                self.failed += 1
+                self._failed_keys.add(key)
+        self._slots.release()
+
+    def run(self) -> None:
+        """Vigilar el directorio hasta que se active `stop`; espera a las imágenes en curso al salir"""
+        watcher = self._open_watcher()
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="carpeta")
+        try:
+            rescan_at = 0.0
+            while not self.stop.is_set():
+                if time.time() >= rescan_at:
+                    ready, pending = self.scan()
+                    for path, key in ready:
+                        self.submit(executor, path, key)
+                    delay = self.settle if pending else self.rescan_interval
+                    rescan_at = time.time() + delay
+                names = watcher.wait(max(0.0, min(1.0, rescan_at - time.time())))
+                if names is None:
+                    rescan_at = 0.0
+                    continue
+                for name in names:
+                    candidate = self._candidate(name)
+                    if candidate is not None:
+                        self.submit(executor, *candidate)
+        finally:
+            watcher.close()
+            executor.shutdown(wait=True)